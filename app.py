@@ -1,18 +1,295 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, Response, stream_with_context, g, has_app_context, send_file
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
 import json
+import sys
+import gzip
+import hashlib
+import hmac
+import html
+import re
+import difflib
+import zlib
+import click
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import os
+import math
+import shutil
+import multiprocessing
+import queue
+import random
+import signal
+import socket
+import threading
+import time
+import zipfile
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial, wraps
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# Optional modules: faster JSON encoding, Brotli compression, file locks and
+# the note retrieval index
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not on Windows; startup migrations then rely on BEGIN IMMEDIATE alone
+try:
+    import numpy
+except ImportError:
+    numpy = None  # "ask my notes" chats then answer 503
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
 
+# Behind TRUSTED_PROXIES reverse proxies, the client address (used by the
+# login and register rate limits) and scheme come from their X-Forwarded-*
+# headers. Leave it at 0 when clients connect directly, or they could spoof it.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES)
+
+# JSON encoding
+# orjson is used when it is installed; NOTEBUDDY_JSON=stdlib forces the
+# standard library encoder
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        # Hooks such as the session serializer's object_hook need the stdlib decoder
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+if orjson is not None and os.environ.get('NOTEBUDDY_JSON', 'auto') != 'stdlib':
+    app.json = OrjsonProvider(app)
+
+# Metrics
+# Request latency, SQL and LLM timings are collected in-process and served
+# in the Prometheus text format at /metrics. Each worker process keeps its
+# own numbers. Queries slower than SLOW_QUERY_MS are logged.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Loopback scrapers get in without credentials only when opted in; behind a
+# local reverse proxy every request looks local
+METRICS_ALLOW_LOCAL = os.environ.get('METRICS_ALLOW_LOCAL', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))  # 0 disables the slow query log
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._buckets = {}
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # name -> callable returning {labels: value}
+
+    def histogram(self, name, help_text, buckets):
+        self._help[name] = ('histogram', help_text)
+        self._buckets[name] = buckets
+
+    def counter(self, name, help_text):
+        self._help[name] = ('counter', help_text)
+
+    def gauge(self, name, help_text, collect):
+        self._help[name] = ('gauge', help_text)
+        self._gauges[name] = collect
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets[name]
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            histograms = {key: list(series) for key, series in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name, (kind, help_text) in sorted(self._help.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for (series_name, labels), series in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    for bound, count in zip(self._buckets[name], series):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {series[-1]}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {series[-2]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {series[-1]}')
+            elif kind == 'counter':
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+            else:
+                for labels, value in sorted(self._gauges[name]().items()):
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+metrics = MetricsRegistry()
+metrics.histogram('http_request_duration_seconds', 'Time to produce a response (streams: until the first byte).',
+                  LATENCY_BUCKETS)
+metrics.histogram('http_request_sql_queries', 'SQL statements executed per request.', COUNT_BUCKETS)
+metrics.histogram('http_request_sql_seconds', 'Time spent in SQL per request.', QUERY_BUCKETS)
+metrics.histogram('sqlite_query_duration_seconds', 'SQL statement execution time by statement type.', QUERY_BUCKETS)
+metrics.counter('sqlite_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.')
+metrics.histogram('llm_queue_wait_seconds', 'Time chat jobs waited in the LLM gateway queue.', LATENCY_BUCKETS)
+metrics.histogram('llm_request_duration_seconds', 'Duration of Ollama generate calls.', LATENCY_BUCKETS)
+metrics.histogram('llm_time_to_first_token_seconds', 'Time from sending a streamed prompt to its first token.',
+                  LATENCY_BUCKETS)
+metrics.histogram('llm_tokens_per_second', 'Generation speed reported by Ollama.', RATE_BUCKETS)
+metrics.histogram('password_hash_seconds', 'Time to hash or verify a password, including the pool round trip.',
+                  LATENCY_BUCKETS)
+metrics.counter('auth_rejected_total', 'Login and register attempts turned away before checking the password.')
+metrics.histogram('rag_search_seconds', 'Time to score and look up note chunks for an "ask my notes" chat.',
+                  QUERY_BUCKETS)
+
+SQL_VERBS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'CREATE'}
+
+def record_query(sql, seconds):
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else ''
+    metrics.observe('sqlite_query_duration_seconds', seconds, statement=verb if verb in SQL_VERBS else 'OTHER')
+    if has_app_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += seconds
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        metrics.inc('sqlite_slow_queries_total')
+        app.logger.warning('Slow query (%.1f ms): %s', seconds * 1000, ' '.join(sql.split())[:500])
+
+class TimedConnection(sqlite3.Connection):
+    # Times each statement up to its first result row
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_query(sql_script, time.perf_counter() - started)
+
+def record_generation(mode, started, result):
+    # result is Ollama's final (done) message
+    metrics.observe('llm_request_duration_seconds', time.perf_counter() - started, mode=mode)
+    if result.get('eval_count') and result.get('eval_duration'):
+        metrics.observe('llm_tokens_per_second', result['eval_count'] / (result['eval_duration'] / 1e9))
+
+@app.before_request
+def start_request_metrics():
+    if not METRICS_ENABLED:
+        return
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_started,
+                        method=request.method, route=route, status=response.status_code)
+        metrics.observe('http_request_sql_queries', g.sql_queries, route=route)
+        metrics.observe('http_request_sql_seconds', g.sql_seconds, route=route)
+    return response
+
+# Ollama settings
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_URLS = [url.strip().rstrip('/') for url in os.environ.get('OLLAMA_URLS', OLLAMA_URL).split(',') if url.strip()]
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3.2:3b')  # Change this to your preferred model
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', '3.05'))
+OLLAMA_READ_TIMEOUT = float(os.environ.get('OLLAMA_READ_TIMEOUT', '30'))
+OLLAMA_RETRIES = int(os.environ.get('OLLAMA_RETRIES', '2'))
+OLLAMA_BALANCING = os.environ.get('OLLAMA_BALANCING', 'least_loaded')  # or 'round_robin'
+
 # Database setup
-def init_db():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+DATABASE = os.environ.get('NOTEBUDDY_DB', 'database.db')
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', '16384'))
+SQLITE_MMAP_BYTES = int(os.environ.get('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', '16'))  # idle connections kept per process
+
+def connect_db():
+    # cached_statements keeps hot queries prepared for the life of the connection.
+    # Pooled connections move between threads, one thread at a time.
+    conn = sqlite3.connect(DATABASE, timeout=10, cached_statements=256, check_same_thread=False,
+                           factory=TimedConnection if METRICS_ENABLED else sqlite3.Connection)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while a writer commits; NORMAL is durable in WAL mode
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_BYTES}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+# Schema migrations
+# Each migration runs once, in version order, and is recorded in the
+# schema_version table. Append new ones with the next version number.
+# A migration and its schema_version row commit together, so migrations
+# run one statement per execute(): executescript() would commit first.
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(apply):
+        MIGRATIONS.append((version, description, apply))
+        return apply
+    return register
+
+@migration(1, 'Initial schema')
+def create_initial_schema(cursor):
+    # Also upgrades databases created before migrations were tracked,
+    # hence IF NOT EXISTS and the role_id column check below
     
     # Roles table
     cursor.execute('''
@@ -109,30 +386,1028 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+
+@migration(2, 'Chat response cache table')
+def create_response_cache(cursor):
+    # Persistent tier of the chat response cache
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+@migration(3, 'Index user_id and sort columns')
+def create_user_indexes(cursor):
+    # Every list query filters on user_id and orders by a timestamp; the index
+    # serves both the filter and the sort (scanned backwards for DESC, with the
+    # implicit rowid as the id tie-breaker)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_todos_user_created ON todos (user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_notes_user_updated ON notes (user_id, updated_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_user_timestamp ON chat_messages (user_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user_id, updated_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users (role_id)')
+
+@migration(4, 'Store conversation messages as rows')
+def create_conversation_messages(cursor):
+    # Conversations used to keep their whole history as one JSON blob that was
+    # rewritten on every turn; messages are now appended as individual rows
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_conversation_messages_position
+        ON conversation_messages (conversation_id, position)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation_messages_user ON conversation_messages (user_id)')
+    
+    # Explode existing blobs in batches; unreadable ones are left untouched
+    last_id = 0
+    while True:
+        conversations = cursor.execute('''
+            SELECT id, user_id, messages, updated_at FROM conversations
+            WHERE id > ? AND messages != '[]' ORDER BY id LIMIT 100
+        ''', (last_id,)).fetchall()
+        if not conversations:
+            break
+        for conversation in conversations:
+            try:
+                messages = json.loads(conversation['messages'])
+            except json.JSONDecodeError:
+                continue
+            cursor.executemany('''
+                INSERT INTO conversation_messages (conversation_id, user_id, position, sender, content, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(conversation['id'], conversation['user_id'], position, message.get('sender', 'user'),
+                   message.get('content', ''), conversation['updated_at'])
+                  for position, message in enumerate(messages)])
+            cursor.execute("UPDATE conversations SET messages = '[]' WHERE id = ?", (conversation['id'],))
+        last_id = conversations[-1]['id']
+
+@migration(5, 'Full-text search indexes')
+def create_search_indexes(cursor):
+    # FTS5 tables keyed by the source row id. owner holds the user id as a
+    # token so a search only walks that user's postings; it is excluded from
+    # ranking and from the user's query terms.
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(owner, title, body, tokenize = 'unicode61 remove_diacritics 2')")
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5(owner, title, tokenize = 'unicode61 remove_diacritics 2')")
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(owner, content, tokenize = 'unicode61 remove_diacritics 2')")
+    
+    # Only the plain-text part of rich text notes is indexed
+    note_text = "CASE WHEN json_valid({0}.content) THEN json_extract({0}.content, '$.text') ELSE {0}.content END"
+    triggers = [
+        f'''CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, owner, title, body) VALUES (new.id, new.user_id, new.title, {note_text.format('new')});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content ON notes BEGIN
+            UPDATE notes_fts SET title = new.title, body = {note_text.format('new')} WHERE rowid = old.id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            DELETE FROM notes_fts WHERE rowid = old.id;
+        END''',
+        
+        '''CREATE TRIGGER IF NOT EXISTS todos_fts_insert AFTER INSERT ON todos BEGIN
+            INSERT INTO todos_fts (rowid, owner, title) VALUES (new.id, new.user_id, new.title);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS todos_fts_update AFTER UPDATE OF title ON todos BEGIN
+            UPDATE todos_fts SET title = new.title WHERE rowid = old.id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS todos_fts_delete AFTER DELETE ON todos BEGIN
+            DELETE FROM todos_fts WHERE rowid = old.id;
+        END''',
+        
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON conversation_messages BEGIN
+            INSERT INTO messages_fts (rowid, owner, content) VALUES (new.id, new.user_id, new.content);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON conversation_messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+        END'''
+    ]
+    for trigger in triggers:
+        cursor.execute(trigger)
+    
+    cursor.execute(f'INSERT INTO notes_fts (rowid, owner, title, body) SELECT id, user_id, title, {note_text.format("notes")} FROM notes')
+    cursor.execute('INSERT INTO todos_fts (rowid, owner, title) SELECT id, user_id, title FROM todos')
+    cursor.execute('INSERT INTO messages_fts (rowid, owner, content) SELECT id, user_id, content FROM conversation_messages')
+
+STATS_TABLES = ('users', 'todos', 'notes', 'conversations', 'chat_messages', 'conversation_messages')
+
+def recount_stats(cursor):
+    # Rebuild every counter from the tables themselves (full scans)
+    cursor.execute('DELETE FROM stats_counters')
+    for table in STATS_TABLES:
+        cursor.execute(f"INSERT INTO stats_counters (scope, name, value) SELECT 0, '{table}', COUNT(*) FROM {table}")
+        if table != 'users':
+            cursor.execute(f'''
+                INSERT INTO stats_counters (scope, name, value)
+                SELECT user_id, '{table}', COUNT(*) FROM {table} GROUP BY user_id
+            ''')
+
+@migration(6, 'Incrementally maintained stats counters')
+def create_stats_counters(cursor):
+    # scope 0 holds global totals, any other scope is a user id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            scope INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, name)
+        ) WITHOUT ROWID
+    ''')
+    # Buckets are 'YYYY-MM-DD' for daily series and 'YYYY-MM-DD HH:00' for hourly ones
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_buckets (
+            name TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, bucket)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_users_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    
+    bump = "INSERT INTO {0} VALUES ({1}) ON CONFLICT DO UPDATE SET value = value {2} 1;"
+    day = "date('now')"
+    hour = "strftime('%Y-%m-%d %H:00', 'now')"
+    # Series fed by inserts into each table, besides the plain counters
+    activity = {
+        'todos': [('todos_created', day)],
+        'notes': [('notes_created', day)],
+        'chat_messages': [('chat_messages', hour)],
+        'conversation_messages': [('conversation_messages', hour)]
+    }
+    
+    for table in STATS_TABLES:
+        on_insert = [bump.format('stats_counters', f"0, '{table}', 1", '+')]
+        on_delete = [bump.format('stats_counters', f"0, '{table}', 0", '-')]
+        if table == 'users':
+            # Per-user counters of a deleted user are dropped with them
+            on_delete.append('DELETE FROM stats_counters WHERE scope = old.id;')
+        else:
+            on_insert.append(bump.format('stats_counters', f"new.user_id, '{table}', 1", '+'))
+            on_delete.append(bump.format('stats_counters', f"old.user_id, '{table}', 0", '-'))
+            on_insert.append(f"INSERT OR IGNORE INTO active_users_daily (day, user_id) VALUES ({day}, new.user_id);")
+        for name, bucket in activity.get(table, []):
+            on_insert.append(bump.format('activity_buckets', f"'{name}', {bucket}, 1", '+'))
+        
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{table}_insert AFTER INSERT ON {table} BEGIN
+                {' '.join(on_insert)}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{table}_delete AFTER DELETE ON {table} BEGIN
+                {' '.join(on_delete)}
+            END
+        ''')
+    
+    # Editing a note also counts as activity; a new row in active_users_daily
+    # means a user's first activity of the day
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stats_notes_update AFTER UPDATE OF title, content ON notes BEGIN
+            INSERT OR IGNORE INTO active_users_daily (day, user_id) VALUES ({day}, new.user_id);
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stats_active_users AFTER INSERT ON active_users_daily BEGIN
+            {bump.format('activity_buckets', "'active_users', new.day, 1", '+')}
+        END
+    ''')
     
+    # Seed counters and reconstruct past activity from row timestamps
+    recount_stats(cursor)
+    cursor.execute('''
+        INSERT INTO activity_buckets (name, bucket, value)
+            SELECT 'todos_created', date(created_at), COUNT(*) FROM todos GROUP BY 2
+    ''')
+    cursor.execute('''
+        INSERT INTO activity_buckets (name, bucket, value)
+            SELECT 'notes_created', date(created_at), COUNT(*) FROM notes GROUP BY 2
+    ''')
+    cursor.execute('''
+        INSERT INTO activity_buckets (name, bucket, value)
+            SELECT 'chat_messages', strftime('%Y-%m-%d %H:00', timestamp), COUNT(*) FROM chat_messages GROUP BY 2
+    ''')
+    cursor.execute('''
+        INSERT INTO activity_buckets (name, bucket, value)
+            SELECT 'conversation_messages', strftime('%Y-%m-%d %H:00', created_at), COUNT(*) FROM conversation_messages GROUP BY 2
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO active_users_daily (day, user_id)
+            SELECT date(created_at), user_id FROM notes
+            UNION SELECT date(updated_at), user_id FROM notes
+            UNION SELECT date(created_at), user_id FROM todos
+            UNION SELECT date(timestamp), user_id FROM chat_messages
+            UNION SELECT date(created_at), user_id FROM conversation_messages
+    ''')
+
+@migration(7, 'Rolling conversation summaries')
+def create_conversation_summaries(cursor):
+    # One summary per conversation covering its first summarized_count
+    # messages; later messages are sent to the model verbatim
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            summary TEXT NOT NULL,
+            summarized_count INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation_summaries_user ON conversation_summaries (user_id)')
+
+@migration(8, 'Saved Ollama context per conversation')
+def create_conversation_contexts(cursor):
+    # context holds the token ids Ollama returned after the last reply,
+    # packed as 32-bit integers; it is valid while the conversation still
+    # has message_count messages and the model is unchanged
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_contexts (
+            conversation_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            context BLOB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation_contexts_user ON conversation_contexts (user_id)')
+
+@migration(9, 'Export jobs')
+def create_export_jobs(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            note_id INTEGER,
+            format TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            artifact TEXT,
+            filename TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_export_jobs_user ON export_jobs (user_id)')
+
+# Collection each table's changes are versioned under
+VERSIONED_TABLES = {
+    'todos': 'todos',
+    'notes': 'notes',
+    'chat_messages': 'chat_messages',
+    'conversations': 'conversations',
+    'conversation_messages': 'conversations'
+}
+
+@migration(10, 'Per-user collection versions')
+def create_collection_versions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS collection_versions (
+            user_id INTEGER NOT NULL,
+            collection TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, collection)
+        ) WITHOUT ROWID
+    ''')
+    bump = ("INSERT INTO collection_versions (user_id, collection, version) VALUES ({0}.user_id, '{1}', 1) "
+            "ON CONFLICT DO UPDATE SET version = version + 1;")
+    for table, collection in VERSIONED_TABLES.items():
+        for event, row in (('insert', 'new'), ('update', 'new'), ('delete', 'old')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS version_{table}_{event} AFTER {event.upper()} ON {table} BEGIN
+                    {bump.format(row, collection)}
+                END
+            ''')
+
+@migration(11, 'Store note content as JSON objects')
+def normalize_note_content(cursor):
+    # Plain text notes from before the rich text editor become {"text", "html"}
+    last_id = 0
+    while True:
+        notes = cursor.execute('''
+            SELECT id, content FROM notes
+            WHERE id > ? AND (content IS NULL OR NOT json_valid(content) OR json_type(content) != 'object')
+            ORDER BY id LIMIT 500
+        ''', (last_id,)).fetchall()
+        if not notes:
+            break
+        cursor.executemany('UPDATE notes SET content = ? WHERE id = ?',
+                           [(note_content_json(note['content'] or ''), note['id']) for note in notes])
+        last_id = notes[-1]['id']
+
+@migration(12, 'Change events')
+def create_change_events(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            collection TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_events_user_seq ON change_events (user_id, seq)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_events_created ON change_events (created_at)')
+    record = ("INSERT INTO change_events (user_id, collection, item_id, action) "
+              "VALUES ({0}.user_id, '{1}', {0}.{2}, '{3}');")
+    for table in ('todos', 'notes', 'conversations'):
+        for event, row, action in (('insert', 'new', 'created'), ('update', 'new', 'updated'), ('delete', 'old', 'deleted')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS changes_{table}_{event} AFTER {event.upper()} ON {table} BEGIN
+                    {record.format(row, table, 'id', action)}
+                END
+            ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS changes_conversation_messages_insert AFTER INSERT ON conversation_messages BEGIN
+            {record.format('new', 'conversations', 'conversation_id', 'appended')}
+        END
+    ''')
+
+@migration(13, 'Auth rate limit buckets')
+def create_rate_limits(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+@migration(14, 'Note revisions')
+def create_note_revisions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_revisions (
+            id INTEGER PRIMARY KEY,
+            note_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            base_id INTEGER,
+            title TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_note_revisions_note ON note_revisions (note_id, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_note_revisions_base ON note_revisions (base_id)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS note_revisions_delete AFTER DELETE ON notes BEGIN
+            DELETE FROM note_revisions WHERE note_id = old.id;
+        END
+    ''')
+
+@migration(15, 'Note retrieval index')
+def create_vector_index(cursor):
+    # One index per user; chunk rows point into the user's vector file
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vector_indexes (
+            user_id INTEGER PRIMARY KEY,
+            embedder TEXT NOT NULL,
+            dims INTEGER NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            last_seq INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vector_chunks (
+            user_id INTEGER NOT NULL,
+            row INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (user_id, row)
+        ) WITHOUT ROWID
+    ''')
+    # Covers the per-item digest lookups (row, the key, is part of every index entry)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_vector_chunks_item ON vector_chunks (user_id, source, item_id, digest)')
+
+@migration(16, 'Export job owners')
+def add_export_job_worker(cursor):
+    cursor.execute('ALTER TABLE export_jobs ADD COLUMN worker_pid INTEGER')
+
+def migrate(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     conn.commit()
+    
+    applied = {row['version'] for row in conn.execute('SELECT version FROM schema_version')}
+    for version, description, apply in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        # BEGIN IMMEDIATE takes the write lock up front, so when several
+        # processes start together only one applies each migration
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                apply(conn.cursor())
+                conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                             (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+@contextmanager
+def schema_lock():
+    # Held while migrating so processes starting together wait for the first
+    # one instead of all racing through the migrations
+    if fcntl is None:
+        yield
+        return
+    with open(DATABASE + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def init_db():
+    with schema_lock():
+        conn = connect_db()
+        migrate(conn)
+        conn.close()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Apply any pending schema migrations."""
+    init_db()
+    print('Database is up to date.')
+
+
+# Requests borrow a connection from a per-process pool of idle ones and
+# hand it back in close_db(), so connections (and their PRAGMAs and prepared
+# statements) are reused even when every request gets a new thread, as under
+# the development server. Long-lived background threads (LLM gateway,
+# exports, indexing) keep one connection each instead.
+_db_local = threading.local()
+_db_pool = []
+_db_pool_lock = threading.Lock()
+_db_pool_pid = None
+
+def borrow_connection():
+    global _db_pool_pid
+    with _db_pool_lock:
+        # Connections are not carried across a fork
+        if _db_pool_pid != os.getpid():
+            _db_pool.clear()
+            _db_pool_pid = os.getpid()
+        if _db_pool:
+            return _db_pool.pop()
+    return connect_db()
+
+def return_connection(conn):
+    # Make sure nothing left a transaction (and its locks) open
+    if conn.in_transaction:
+        conn.rollback()
+    with _db_pool_lock:
+        if _db_pool_pid == os.getpid() and len(_db_pool) < SQLITE_POOL_SIZE:
+            _db_pool.append(conn)
+            return
     conn.close()
 
 def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
+    if has_app_context():
+        conn = g.get('db')
+        if conn is None:
+            conn = g.db = borrow_connection()
+        return conn
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = _db_local.conn = connect_db()
+        _db_local.pid = os.getpid()
     return conn
 
-# Helper functions
-def is_admin():
-    if 'user_id' not in session:
-        return False
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        return_connection(conn)
+
+# Response compression
+# Buffered responses above COMPRESS_MIN_BYTES are sent with Brotli (when
+# the brotli package is installed) or gzip, whichever the client prefers.
+# Streamed responses and files are passed through untouched.
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/html', 'text/plain', 'text/markdown',
+                          'text/css', 'text/javascript', 'application/javascript'}
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding == 'br':
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    elif encoding == 'gzip':
+        data = gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Authorization
+# Roles are cached in-process per user id so authorizing a request doesn't
+# need a users/roles join. update_user_role() and delete_user() bump the
+# user's version, which invalidates the entry here; entries also expire
+# after IDENTITY_CACHE_TTL seconds so changes made through another worker
+# process are picked up.
+IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', '60'))
+
+_identity_lock = threading.Lock()
+_identity_cache = {}  # user_id -> (role_name, version, expires_at)
+_identity_versions = {}  # user_id -> version
+
+def get_user_role(user_id):
+    # Returns None for users that no longer exist
+    now = time.monotonic()
+    with _identity_lock:
+        version = _identity_versions.get(user_id, 0)
+        entry = _identity_cache.get(user_id)
+        if entry and entry[1] == version and entry[2] > now:
+            return entry[0]
     
     conn = get_db_connection()
     user = conn.execute('''
-        SELECT u.*, r.name as role_name 
+        SELECT r.name as role_name 
         FROM users u 
         JOIN roles r ON u.role_id = r.id 
         WHERE u.id = ?
-    ''', (session['user_id'],)).fetchone()
-    conn.close()
+    ''', (user_id,)).fetchone()
+    role_name = user['role_name'] if user else None
+    
+    with _identity_lock:
+        # Skip caching if the user changed while we were reading
+        if _identity_versions.get(user_id, 0) == version:
+            _identity_cache[user_id] = (role_name, version, now + IDENTITY_CACHE_TTL)
+    return role_name
+
+def invalidate_identity(user_id):
+    with _identity_lock:
+        _identity_versions[user_id] = _identity_versions.get(user_id, 0) + 1
+        _identity_cache.pop(user_id, None)
+
+def current_role():
+    if 'user_id' not in session:
+        return None
+    role_name = get_user_role(session['user_id'])
+    if role_name is None:
+        # The account was deleted; drop the stale session
+        session.clear()
+    elif session.get('user_role') != role_name:
+        session['user_role'] = role_name
+    return role_name
+
+def is_admin():
+    return current_role() == 'admin'
+
+def login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_role() is None:
+            return jsonify({'error': 'Not authenticated'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            return jsonify({'error': 'Access denied'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+# Conditional requests
+# GET responses for a user's collection carry a weak ETag built from the
+# collection's version, which triggers bump on every insert, update and
+# delete. A matching If-None-Match gets a 304 after a single primary key
+# lookup, without querying or serializing the collection.
+def collection_etag(collection):
+    user_id = session['user_id']
+    row = get_db_connection().execute('SELECT version FROM collection_versions WHERE user_id = ? AND collection = ?',
+                                      (user_id, collection)).fetchone()
+    # The path and query are part of the tag since they select what the body holds
+    variant = hashlib.sha1(request.full_path.encode()).hexdigest()[:10]
+    return f"{user_id}-{collection}-{row['version'] if row else 0}-{variant}"
+
+def conditional(collection):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = collection_etag(collection)
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # Browsers revalidate on every use, so edits show up immediately
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+# List pagination
+# List endpoints return one page at a time, newest first. The next page is
+# requested with ?after=<cursor> using the X-Next-Cursor header of the
+# previous response (the last row's sort value and id), ?limit= sets the page
+# size and ?fields= picks a subset of columns.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+NOTE_SNIPPET_SQL = ("substr(CASE WHEN json_valid(content) THEN json_extract(content, '$.text') "
+                    "ELSE content END, 1, 200)")
+
+def list_page(table, sort_column, columns, default_fields=None, default_limit=DEFAULT_PAGE_SIZE, json_fields=()):
+    # columns maps each selectable field name to its SQL expression;
+    # json_fields are stored as JSON text and returned decoded
+    fields = request.args.get('fields')
+    if fields:
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in columns]
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+    else:
+        fields = default_fields or list(columns)
+    
+    limit = min(max(request.args.get('limit', default_limit, type=int), 1), MAX_PAGE_SIZE)
+    
+    # The cursor needs the sort column and id even if the caller didn't ask for them
+    selected = list(dict.fromkeys(fields + [sort_column, 'id']))
+    select_sql = ', '.join(f'{columns[field]} AS {field}' for field in selected)
+    sql = f'SELECT {select_sql} FROM {table} WHERE user_id = ?'
+    params = [session['user_id']]
+    
+    after = request.args.get('after')
+    if after:
+        sort_value, _, after_id = after.rpartition(',')
+        if not after_id.isdigit():
+            return jsonify({'error': 'Invalid cursor'}), 400
+        sql += f' AND ({sort_column}, id) < (?, ?)'
+        params += [sort_value, int(after_id)]
+    
+    sql += f' ORDER BY {sort_column} DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    
+    conn = get_db_connection()
+    rows = conn.execute(sql, params).fetchall()
+    
+    page = rows[:limit]
+    decode = app.json.loads
+    response = jsonify([{field: decode(row[field]) if field in json_fields and row[field] else row[field]
+                         for field in fields} for row in page])
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = f'{page[-1][sort_column]},{page[-1]["id"]}'
+    return response
+
+# Batch mutations
+# Batch endpoints take a list of create/update/delete operations and apply
+# them in one transaction: creates one by one (each result needs its new
+# id), then updates and deletes with executemany. Invalid operations and
+# ids the user doesn't own are reported per item without failing the rest.
+BATCH_MAX_OPERATIONS = 1000
+SQLITE_MAX_PARAMS = 500
+
+def owned_ids(conn, table, user_id, ids):
+    owned = set()
+    ids = list(ids)
+    for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+        chunk = ids[i:i + SQLITE_MAX_PARAMS]
+        placeholders = ', '.join('?' * len(chunk))
+        rows = conn.execute(f'SELECT id FROM {table} WHERE user_id = ? AND id IN ({placeholders})',
+                            [user_id] + chunk).fetchall()
+        owned.update(row['id'] for row in rows)
+    return owned
+
+def apply_batch(conn, table, user_id, operations, create_sql, create_params, update, update_params):
+    # create_params/update_params turn an operation into SQL parameters and
+    # raise ValueError with a message when the operation is invalid. update is
+    # an UPDATE statement, or a function taking (conn, user_id, [(id, params)])
+    # for updates that need more than one statement
+    results = [None] * len(operations)
+    creates, updates, deletes = [], [], []
+    
+    for i, operation in enumerate(operations):
+        kind = operation.get('op') if isinstance(operation, dict) else None
+        try:
+            if kind == 'create':
+                creates.append((i, create_params(operation)))
+            elif kind in ('update', 'delete'):
+                item_id = operation.get('id')
+                if not isinstance(item_id, int):
+                    raise ValueError('id is required')
+                if kind == 'update':
+                    updates.append((i, item_id, update_params(operation)))
+                else:
+                    deletes.append((i, item_id))
+            else:
+                raise ValueError('op must be create, update or delete')
+        except ValueError as e:
+            results[i] = {'op': kind, 'status': 'error', 'error': str(e)}
+    
+    owned = owned_ids(conn, table, user_id, {item_id for _, item_id, _ in updates} | {item_id for _, item_id in deletes})
+    
+    for i, params in creates:
+        cursor = conn.execute(create_sql, (user_id,) + params)
+        results[i] = {'op': 'create', 'status': 'created', 'id': cursor.lastrowid}
+    
+    owned_updates = [(item_id, params) for _, item_id, params in updates if item_id in owned]
+    if callable(update):
+        update(conn, user_id, owned_updates)
+    else:
+        conn.executemany(update, [params + (item_id, user_id) for item_id, params in owned_updates])
+    conn.executemany(f'DELETE FROM {table} WHERE id = ? AND user_id = ?',
+                     [(item_id, user_id) for _, item_id in deletes if item_id in owned])
+    
+    for kind, items in (('update', [(i, item_id) for i, item_id, _ in updates]), ('delete', deletes)):
+        for i, item_id in items:
+            status = ('updated' if kind == 'update' else 'deleted') if item_id in owned else 'not_found'
+            results[i] = {'op': kind, 'status': status, 'id': item_id}
+    
+    return results
+
+def batch_response(table, data, create_sql, create_params, update, update_params):
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'operations must be a non-empty list'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'At most {BATCH_MAX_OPERATIONS} operations per batch'}), 400
     
-    return user and user['role_name'] == 'admin'
+    conn = get_db_connection()
+    results = apply_batch(conn, table, session['user_id'], operations,
+                          create_sql, create_params, update, update_params)
+    conn.commit()
+    
+    return jsonify({'results': results})
+
+# Password hashing
+# scrypt is deliberately slow, so hashes are computed on a small process
+# pool instead of the request thread. At most HASH_WORKERS hashes run at
+# once across all processes sharing the database, and HASH_MAX_PENDING are
+# in flight per server (`serve` splits it between its workers); beyond that
+# login and register answer 503 right away rather than queueing CPU work
+# behind a burst. Stored hashes made with other parameters than
+# PASSWORD_HASH_METHOD are replaced on the next successful login.
+# HASH_WORKERS=0 hashes on the request thread.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', str(max(1, HASH_WORKERS) * 4)))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', '10'))
+
+class HashingBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Password hashing is saturated')
+        self.retry_after = retry_after
+
+_hash_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(HASH_MAX_PENDING)
+_hash_executor = None
+_hash_pid = None
+_hash_prefix = None
+_hash_slot_lock = threading.Lock()
+_hash_slot_file = None
+_hash_slot_owner = None
+_hash_slots_held = set()
+
+def share_hash_budget(workers):
+    # Called by `serve` before forking so the pending limit covers all workers
+    global HASH_MAX_PENDING, _hash_slots
+    HASH_MAX_PENDING = max(1, HASH_MAX_PENDING // workers)
+    _hash_slots = threading.BoundedSemaphore(HASH_MAX_PENDING)
+
+def take_hash_slot():
+    # One of HASH_WORKERS byte locks on a file next to the database. The
+    # locks belong to the process, so the kernel drops them if it dies, and
+    # _hash_slots_held keeps this process's threads off each other's bytes.
+    global _hash_slot_file, _hash_slot_owner
+    with _hash_slot_lock:
+        if _hash_slot_owner != (os.getpid(), DATABASE):
+            _hash_slot_file = open(DATABASE + '.hash-slots', 'a')
+            _hash_slot_owner = (os.getpid(), DATABASE)
+            _hash_slots_held.clear()
+        for slot in range(HASH_WORKERS):
+            if slot in _hash_slots_held:
+                continue
+            try:
+                fcntl.lockf(_hash_slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+            except OSError:
+                continue
+            _hash_slots_held.add(slot)
+            return slot
+    return None
+
+def release_hash_slot(slot):
+    with _hash_slot_lock:
+        fcntl.lockf(_hash_slot_file, fcntl.LOCK_UN, 1, slot)
+        _hash_slots_held.discard(slot)
+
+@contextmanager
+def hash_cpu_slot(deadline):
+    if fcntl is None:
+        yield
+        return
+    slot = take_hash_slot()
+    while slot is None:
+        if time.monotonic() >= deadline:
+            raise HashingBusy(1)
+        time.sleep(0.02)
+        slot = take_hash_slot()
+    try:
+        yield
+    finally:
+        release_hash_slot(slot)
+
+def hash_executor():
+    global _hash_executor, _hash_pid
+    with _hash_lock:
+        # Pool processes belong to the process that started them. They are
+        # spawned rather than forked so they don't inherit threads, database
+        # handles or the serve command's listening socket.
+        if _hash_pid != os.getpid():
+            _hash_executor = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _hash_pid = os.getpid()
+        return _hash_executor
+
+def discard_hash_executor(executor):
+    # The next caller starts a fresh pool. The old one's processes are
+    # stopped, hung ones included, so repeated timeouts don't pile them up.
+    global _hash_executor, _hash_pid
+    with _hash_lock:
+        if _hash_executor is executor:
+            _hash_executor = None
+            _hash_pid = None
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+def run_hashing(fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        metrics.inc('auth_rejected_total', reason='hashing_busy')
+        raise HashingBusy(1)
+    started = time.perf_counter()
+    try:
+        if HASH_WORKERS <= 0:
+            return fn(*args)
+        deadline = time.monotonic() + HASH_TIMEOUT
+        with hash_cpu_slot(deadline):
+            executor = hash_executor()
+            try:
+                return executor.submit(fn, *args).result(timeout=max(deadline - time.monotonic(), 0))
+            except (BrokenProcessPool, FutureTimeoutError):
+                discard_hash_executor(executor)
+                metrics.inc('auth_rejected_total', reason='hashing_failed')
+                raise HashingBusy(1)
+    finally:
+        _hash_slots.release()
+        metrics.observe('password_hash_seconds', time.perf_counter() - started)
+
+def hash_password(password):
+    return run_hashing(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(password_hash, password):
+    return run_hashing(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+    # Werkzeug stores the method and its parameters before the first '$'
+    global _hash_prefix
+    if _hash_prefix is None:
+        _hash_prefix = hash_password('').split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _hash_prefix
+
+def upgrade_password_hash(conn, user_id, old_hash, password):
+    try:
+        if not needs_rehash(old_hash):
+            return
+        new_hash = hash_password(password)
+    except HashingBusy:
+        return  # try again on a later login
+    # Only replace the hash that was verified, in case the password changed meanwhile
+    conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+                 (new_hash, user_id, old_hash))
+    conn.commit()
+
+# Rate limiting
+# Login and register attempts draw from token buckets per client IP and,
+# for failed logins, per username and client IP. A bucket holds up to `burst` tokens and refills
+# at `per_minute`; an empty bucket gets a 429 with Retry-After. Buckets are
+# kept in memory per process, or in the rate_limits table with
+# AUTH_RATE_LIMIT_STORE=sqlite so all worker processes share them.
+AUTH_RATE_LIMIT_STORE = os.environ.get('AUTH_RATE_LIMIT_STORE', 'memory')
+AUTH_RATE_LIMITS = {
+    'login_ip': (int(os.environ.get('LOGIN_IP_BURST', '20')), float(os.environ.get('LOGIN_IP_PER_MINUTE', '10'))),
+    'login_user': (int(os.environ.get('LOGIN_USER_BURST', '5')), float(os.environ.get('LOGIN_USER_PER_MINUTE', '2'))),
+    'register_ip': (int(os.environ.get('REGISTER_IP_BURST', '5')), float(os.environ.get('REGISTER_IP_PER_MINUTE', '1'))),
+}
+RATE_LIMIT_MAX_KEYS = 10000
+
+def refill(tokens, updated_at, now, burst, per_minute):
+    return min(burst, tokens + (now - updated_at) * per_minute / 60)
+
+def retry_after_seconds(tokens, per_minute):
+    return max(1, math.ceil((1 - tokens) * 60 / per_minute))
+
+class MemoryBuckets:
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    def take(self, key, burst, per_minute, cost=1):
+        # Returns 0 when a token was available (and cost tokens were taken),
+        # otherwise seconds until one is
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated_at, now, burst, per_minute)
+            wait = 0 if tokens >= 1 else retry_after_seconds(tokens, per_minute)
+            self._buckets[key] = (tokens - cost if not wait else tokens, now)
+            # Evicting the least recently used bucket only ever hands out extra tokens
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+class SQLiteBuckets:
+    def take(self, key, burst, per_minute, cost=1):
+        now = time.time()
+        conn = get_db_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (key,)).fetchone()
+            tokens = refill(row['tokens'], row['updated_at'], now, burst, per_minute) if row else burst
+            wait = 0 if tokens >= 1 else retry_after_seconds(tokens, per_minute)
+            conn.execute('INSERT OR REPLACE INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)',
+                         (key, tokens - cost if not wait else tokens, now))
+            # A bucket untouched for an hour is full again (with the defaults), so it can go
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM rate_limits WHERE updated_at < ?', (now - 3600,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return wait
+
+auth_buckets = SQLiteBuckets() if AUTH_RATE_LIMIT_STORE == 'sqlite' else MemoryBuckets(RATE_LIMIT_MAX_KEYS)
+
+def rate_limit(*scopes, cost=1):
+    # scopes are (name, key) pairs; every bucket is charged cost tokens
+    # (cost=0 only checks), and the longest wait wins
+    wait = 0
+    for name, key in scopes:
+        burst, per_minute = AUTH_RATE_LIMITS[name]
+        wait = max(wait, auth_buckets.take(f'{name}:{key}', burst, per_minute, cost))
+    if wait:
+        metrics.inc('auth_rejected_total', reason='rate_limited')
+    return wait
+
+def auth_unavailable(template, message, status, retry_after):
+    flash(message)
+    response = app.make_response((render_template(template), status))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
 
 # Authentication routes
 @app.route('/login', methods=['GET', 'POST'])
@@ -141,6 +1416,16 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
+        # Every attempt costs the client IP a token. The username's bucket is
+        # only checked here and charged for failed attempts below, so logging
+        # in successfully never uses it up. It is per client too, so someone
+        # guessing a password can't lock the owner out from everywhere else.
+        user_key = f'{username.lower()}@{request.remote_addr}'
+        wait = max(rate_limit(('login_ip', request.remote_addr)),
+                   rate_limit(('login_user', user_key), cost=0))
+        if wait:
+            return auth_unavailable('login.html', 'Too many login attempts, please try again later', 429, wait)
+        
         conn = get_db_connection()
         user = conn.execute('''
             SELECT u.*, r.name as role_name 
@@ -148,9 +1433,14 @@ def login():
             JOIN roles r ON u.role_id = r.id 
             WHERE u.username = ?
         ''', (username,)).fetchone()
-        conn.close()
         
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            valid = user is not None and verify_password(user['password_hash'], password)
+        except HashingBusy as e:
+            return auth_unavailable('login.html', 'The server is busy, please try again shortly', 503, e.retry_after)
+        
+        if valid:
+            upgrade_password_hash(conn, user['id'], user['password_hash'], password)
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['user_role'] = user['role_name']
@@ -161,6 +1451,7 @@ def login():
             else:
                 return redirect(url_for('index'))
         else:
+            rate_limit(('login_user', user_key))
             flash('Invalid username or password')
     
     return render_template('login.html')
@@ -176,19 +1467,24 @@ def register():
             flash('Password must be at least 6 characters long')
             return render_template('register.html')
         
-        password_hash = generate_password_hash(password)
+        wait = rate_limit(('register_ip', request.remote_addr))
+        if wait:
+            return auth_unavailable('register.html', 'Too many sign-ups, please try again later', 429, wait)
+        
+        try:
+            password_hash = hash_password(password)
+        except HashingBusy as e:
+            return auth_unavailable('register.html', 'The server is busy, please try again shortly', 503, e.retry_after)
         
         conn = get_db_connection()
         try:
             conn.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
                         (username, email, password_hash))
             conn.commit()
-            conn.close()
             flash('Registration successful! Please log in.')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             flash('Username or email already exists')
-            conn.close()
     
     return render_template('register.html')
 
@@ -200,7 +1496,7 @@ def logout():
 # Main application routes
 @app.route('/')
 def index():
-    if 'user_id' not in session:
+    if current_role() is None:
         return redirect(url_for('login'))
     return render_template('index.html')
 
@@ -214,10 +1510,8 @@ def admin_dashboard():
 
 # Admin API routes
 @app.route('/api/admin/users', methods=['GET'])
+@admin_required
 def get_all_users():
-    if not is_admin():
-        return jsonify({'error': 'Access denied'}), 403
-    
     conn = get_db_connection()
     users = conn.execute('''
         SELECT u.id, u.username, u.email, u.created_at, r.name as role_name, r.id as role_id
@@ -225,15 +1519,12 @@ def get_all_users():
         JOIN roles r ON u.role_id = r.id 
         ORDER BY u.created_at DESC
     ''').fetchall()
-    conn.close()
     
     return jsonify([dict(user) for user in users])
 
 @app.route('/api/admin/users/<int:user_id>/role', methods=['PUT'])
+@admin_required
 def update_user_role(user_id):
-    if not is_admin():
-        return jsonify({'error': 'Access denied'}), 403
-    
     data = request.get_json()
     role_id = data.get('role_id')
     
@@ -243,15 +1534,13 @@ def update_user_role(user_id):
     conn = get_db_connection()
     conn.execute('UPDATE users SET role_id = ? WHERE id = ?', (role_id, user_id))
     conn.commit()
-    conn.close()
+    invalidate_identity(user_id)
     
     return jsonify({'success': True})
 
 @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
+@admin_required
 def delete_user(user_id):
-    if not is_admin():
-        return jsonify({'error': 'Access denied'}), 403
-    
     # Prevent deleting the admin user
     if user_id == session['user_id']:
         return jsonify({'error': 'Cannot delete your own account'}), 400
@@ -261,70 +1550,96 @@ def delete_user(user_id):
     conn.execute('DELETE FROM todos WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM notes WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM chat_messages WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM conversation_messages WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM conversation_summaries WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM conversation_contexts WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM export_jobs WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM vector_chunks WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM vector_indexes WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM conversations WHERE user_id = ?', (user_id,))
+    # Written by triggers on the deletes above, so cleared last
+    conn.execute('DELETE FROM collection_versions WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM change_events WHERE user_id = ?', (user_id,))
     conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
-    conn.close()
+    invalidate_identity(user_id)
+    remove_vector_files(user_id)
     
     return jsonify({'success': True})
 
 @app.route('/api/admin/roles', methods=['GET'])
+@admin_required
 def get_all_roles():
-    if not is_admin():
-        return jsonify({'error': 'Access denied'}), 403
-    
     conn = get_db_connection()
     roles = conn.execute('SELECT * FROM roles ORDER BY id').fetchall()
-    conn.close()
     
     return jsonify([dict(role) for role in roles])
 
+def activity_series(conn, name, since):
+    rows = conn.execute('SELECT bucket, value FROM activity_buckets WHERE name = ? AND bucket >= ? ORDER BY bucket',
+                        (name, since)).fetchall()
+    return [{'bucket': row['bucket'], 'value': row['value']} for row in rows]
+
 @app.route('/api/admin/stats', methods=['GET'])
+@admin_required
 def get_admin_stats():
-    if not is_admin():
-        return jsonify({'error': 'Access denied'}), 403
-    
     conn = get_db_connection()
     
-    # Get user count
-    user_count = conn.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
+    # Counters are global (scope 0) unless a user_id is given
+    scope = request.args.get('user_id', 0, type=int)
+    counters = {table: 0 for table in STATS_TABLES}
+    for row in conn.execute('SELECT name, value FROM stats_counters WHERE scope = ?', (scope,)):
+        counters[row['name']] = row['value']
+    if scope:
+        del counters['users']
     
-    # Get todos count
-    todos_count = conn.execute('SELECT COUNT(*) as count FROM todos').fetchone()['count']
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    hours = min(max(request.args.get('hours', 48, type=int), 1), 24 * 31)
+    since_day = conn.execute("SELECT date('now', ?)", (f'-{days - 1} days',)).fetchone()[0]
+    since_hour = conn.execute("SELECT strftime('%Y-%m-%d %H:00', 'now', ?)", (f'-{hours - 1} hours',)).fetchone()[0]
     
-    # Get notes count
-    notes_count = conn.execute('SELECT COUNT(*) as count FROM notes').fetchone()['count']
+    counters['activity'] = {
+        'notes_created_per_day': activity_series(conn, 'notes_created', since_day),
+        'todos_created_per_day': activity_series(conn, 'todos_created', since_day),
+        'active_users_per_day': activity_series(conn, 'active_users', since_day),
+        'chat_messages_per_hour': activity_series(conn, 'chat_messages', since_hour),
+        'conversation_messages_per_hour': activity_series(conn, 'conversation_messages', since_hour)
+    }
     
-    # Get conversations count
-    conversations_count = conn.execute('SELECT COUNT(*) as count FROM conversations').fetchone()['count']
-    
-    conn.close()
-    
-    return jsonify({
-        'users': user_count,
-        'todos': todos_count,
-        'notes': notes_count,
-        'conversations': conversations_count
-    })
+    return jsonify(counters)
+
+@app.route('/api/admin/stats/recount', methods=['POST'])
+@admin_required
+def recount_admin_stats():
+    # Reconciles the trigger-maintained counters with full table counts
+    conn = get_db_connection()
+    recount_stats(conn.cursor())
+    conn.commit()
+    return jsonify({'success': True})
+
+@app.route('/api/admin/cache', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/api/admin/cache', methods=['DELETE'])
+@admin_required
+def clear_cache():
+    response_cache.clear()
+    return jsonify({'success': True})
 
 # Todo API routes
+TODO_COLUMNS = {field: field for field in ('id', 'user_id', 'title', 'completed', 'created_at')}
+
 @app.route('/api/todos', methods=['GET'])
+@login_required
+@conditional('todos')
 def get_todos():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = get_db_connection()
-    todos = conn.execute('SELECT * FROM todos WHERE user_id = ? ORDER BY created_at DESC', 
-                        (session['user_id'],)).fetchall()
-    conn.close()
-    
-    return jsonify([dict(todo) for todo in todos])
+    return list_page('todos', 'created_at', TODO_COLUMNS)
 
 @app.route('/api/todos', methods=['POST'])
+@login_required
 def add_todo():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     title = data.get('title')
     
@@ -336,15 +1651,12 @@ def add_todo():
                          (session['user_id'], title))
     todo_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({'id': todo_id, 'title': title, 'completed': False})
 
 @app.route('/api/todos/<int:todo_id>', methods=['PUT'])
+@login_required
 def update_todo(todo_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     completed = data.get('completed')
     
@@ -352,153 +1664,1062 @@ def update_todo(todo_id):
     conn.execute('UPDATE todos SET completed = ? WHERE id = ? AND user_id = ?',
                 (completed, todo_id, session['user_id']))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
 @app.route('/api/todos/<int:todo_id>', methods=['DELETE'])
+@login_required
 def delete_todo(todo_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     conn = get_db_connection()
     conn.execute('DELETE FROM todos WHERE id = ? AND user_id = ?', (todo_id, session['user_id']))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
+TODO_CREATE_SQL = 'INSERT INTO todos (user_id, title, completed) VALUES (?, ?, ?)'
+TODO_UPDATE_SQL = 'UPDATE todos SET title = COALESCE(?, title), completed = COALESCE(?, completed) WHERE id = ? AND user_id = ?'
+
+def todo_create_params(operation):
+    if not operation.get('title'):
+        raise ValueError('Title is required')
+    return (operation['title'], bool(operation.get('completed', False)))
+
+def todo_update_params(operation):
+    completed = operation.get('completed')
+    return (operation.get('title') or None, None if completed is None else bool(completed))
+
+@app.route('/api/todos/batch', methods=['POST'])
+@login_required
+def batch_todos():
+    return batch_response('todos', request.get_json(),
+                          TODO_CREATE_SQL, todo_create_params, TODO_UPDATE_SQL, todo_update_params)
+
 # Notes API routes
+NOTE_COLUMNS = {field: field for field in ('id', 'user_id', 'title', 'content', 'created_at', 'updated_at')}
+NOTE_COLUMNS['snippet'] = NOTE_SNIPPET_SQL
+NOTE_FULL_FIELDS = ['id', 'user_id', 'title', 'content', 'created_at', 'updated_at']
+NOTE_SUMMARY_FIELDS = ['id', 'title', 'snippet', 'created_at', 'updated_at']
+
+def note_content_json(content):
+    # Note content is a {"text", "html", "delta"} object. Clients may send
+    # the object itself, the object as a JSON string (older clients) or
+    # plain text; all are stored as compact JSON.
+    if isinstance(content, str):
+        try:
+            parsed = json.loads(content)
+        except json.JSONDecodeError:
+            parsed = None
+        if not isinstance(parsed, dict):
+            paragraphs = ''.join(f'<p>{html.escape(line)}</p>' for line in content.splitlines())
+            parsed = {'text': content, 'html': paragraphs}
+        content = parsed
+    if not isinstance(content, dict):
+        raise ValueError('content must be an object or a string')
+    return json.dumps(content, separators=(',', ':'))
+
+def note_json(note):
+    note = dict(note)
+    note['content'] = app.json.loads(note['content']) if note.get('content') else {}
+    return note
+
+# Note revisions
+# Each save through PUT /api/notes/<id> records the note's new state in
+# note_revisions. Content is stored zlib-compressed, either whole (a
+# snapshot) or as a delta against the latest snapshot: copy ranges from the
+# snapshot plus inserted text, from a token-level difflib diff. A new
+# snapshot is taken every REVISION_SNAPSHOT_EVERY revisions, or sooner when
+# a delta would be more than half the size of a snapshot, so any revision is
+# rebuilt from at most one delta. Saves that land within
+# REVISION_COALESCE_SECONDS of the previous one rewrite that revision
+# instead of adding one, until it spans REVISION_MAX_SPAN_SECONDS. History
+# starts with the state a note had before its first recorded edit.
+REVISION_SNAPSHOT_EVERY = int(os.environ.get('REVISION_SNAPSHOT_EVERY', '20'))
+REVISION_COALESCE_SECONDS = int(os.environ.get('REVISION_COALESCE_SECONDS', '120'))
+REVISION_MAX_SPAN_SECONDS = int(os.environ.get('REVISION_MAX_SPAN_SECONDS', '900'))
+REVISION_PAGE_SIZE = 50
+
+# Whitespace runs, runs of other characters, and tag brackets on their own
+REVISION_TOKENS = re.compile(r'\s+|[^\s<>]+|[<>]')
+
+def make_delta(base, text):
+    # [start, end] copies base[start:end]; strings are inserted as they are
+    a = REVISION_TOKENS.findall(base)
+    b = REVISION_TOKENS.findall(text)
+    offsets = [0]
+    for token in a:
+        offsets.append(offsets[-1] + len(token))
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+        if tag == 'equal':
+            delta.append([offsets[i1], offsets[i2]])
+        elif j2 > j1:
+            delta.append(''.join(b[j1:j2]))
+    return delta
+
+def apply_delta(base, delta):
+    return ''.join(base[part[0]:part[1]] if isinstance(part, list) else part for part in delta)
+
+def compress(text):
+    return zlib.compress(text.encode(), 6)
+
+def decompress(data):
+    return zlib.decompress(data).decode()
+
+def revision_content(conn, revision):
+    # Content JSON text as of this revision
+    if revision['base_id'] is None:
+        return decompress(revision['data'])
+    base = conn.execute('SELECT data FROM note_revisions WHERE id = ?', (revision['base_id'],)).fetchone()
+    return apply_delta(decompress(base['data']), json.loads(decompress(revision['data'])))
+
+def encode_revision(conn, base_id, content):
+    # Returns (base_id, data): a delta against base_id, or a snapshot (None, data)
+    snapshot = compress(content)
+    if base_id is None:
+        return None, snapshot
+    base = decompress(conn.execute('SELECT data FROM note_revisions WHERE id = ?', (base_id,)).fetchone()['data'])
+    delta = compress(json.dumps(make_delta(base, content), separators=(',', ':')))
+    if len(delta) * 2 > len(snapshot):
+        return None, snapshot
+    return base_id, delta
+
+def record_revision(conn, note, title, content, coalesce=True):
+    # note is the row as it was before this save
+    latest = conn.execute('''
+        SELECT id, base_id,
+               updated_at > datetime('now', ?) AND created_at > datetime('now', ?) AS recent
+        FROM note_revisions WHERE note_id = ? ORDER BY id DESC LIMIT 1
+    ''', (f'-{REVISION_COALESCE_SECONDS} seconds', f'-{REVISION_MAX_SPAN_SECONDS} seconds', note['id'])).fetchone()
+    
+    if latest is None:
+        cursor = conn.execute('INSERT INTO note_revisions (note_id, user_id, title, data, size) VALUES (?, ?, ?, ?, ?)',
+                              (note['id'], note['user_id'], note['title'], compress(note['content']), len(note['content'])))
+        latest = {'id': cursor.lastrowid, 'base_id': None, 'recent': False}
+    
+    if coalesce and latest['recent']:
+        # Nothing is based on the latest revision yet, so it can be rewritten,
+        # even when it is a snapshot
+        base_id, data = encode_revision(conn, latest['base_id'], content)
+        conn.execute('''
+            UPDATE note_revisions SET base_id = ?, title = ?, data = ?, size = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (base_id, title, data, len(content), latest['id']))
+        return latest['id']
+    
+    base_id = latest['base_id'] or latest['id']
+    deltas = conn.execute('SELECT COUNT(*) FROM note_revisions WHERE base_id = ?', (base_id,)).fetchone()[0]
+    base_id, data = encode_revision(conn, base_id if deltas + 1 < REVISION_SNAPSHOT_EVERY else None, content)
+    cursor = conn.execute('''
+        INSERT INTO note_revisions (note_id, user_id, base_id, title, data, size) VALUES (?, ?, ?, ?, ?, ?)
+    ''', (note['id'], note['user_id'], base_id, title, data, len(content)))
+    return cursor.lastrowid
+
+def save_note(conn, note, title, content, coalesce=True):
+    # Returns False when nothing changed, in which case nothing is written
+    if title == note['title'] and content == note['content']:
+        return False
+    record_revision(conn, note, title, content, coalesce)
+    conn.execute('UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                 (title, content, note['id']))
+    return True
+
+def owned_note(conn, note_id):
+    return conn.execute('SELECT * FROM notes WHERE id = ? AND user_id = ?', (note_id, session['user_id'])).fetchone()
+
+def revision_json(revision):
+    return {
+        'id': revision['id'],
+        'title': revision['title'],
+        'kind': 'delta' if revision['base_id'] else 'snapshot',
+        'size': revision['size'],
+        'stored_bytes': revision['stored_bytes'],
+        'created_at': revision['created_at'],
+        'updated_at': revision['updated_at']
+    }
+
 @app.route('/api/notes', methods=['GET'])
+@login_required
+@conditional('notes')
 def get_notes():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
+    # ?view=summary is the sidebar listing: no content blob, just a text snippet
+    default_fields = NOTE_SUMMARY_FIELDS if request.args.get('view') == 'summary' else NOTE_FULL_FIELDS
+    return list_page('notes', 'updated_at', NOTE_COLUMNS, default_fields, json_fields=('content',))
+
+@app.route('/api/notes/<int:note_id>', methods=['GET'])
+@login_required
+@conditional('notes')
+def get_note(note_id):
     conn = get_db_connection()
-    notes = conn.execute('SELECT * FROM notes WHERE user_id = ? ORDER BY updated_at DESC', 
-                        (session['user_id'],)).fetchall()
-    conn.close()
+    note = conn.execute('SELECT * FROM notes WHERE id = ? AND user_id = ?', 
+                       (note_id, session['user_id'])).fetchone()
+    
+    if not note:
+        return jsonify({'error': 'Note not found'}), 404
     
-    return jsonify([dict(note) for note in notes])
+    return jsonify(note_json(note))
 
 @app.route('/api/notes', methods=['POST'])
+@login_required
 def add_note():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     title = data.get('title')
-    content = data.get('content', '')
     
     if not title:
         return jsonify({'error': 'Title is required'}), 400
+    try:
+        content = note_content_json(data.get('content', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     conn = get_db_connection()
     cursor = conn.execute('INSERT INTO notes (user_id, title, content) VALUES (?, ?, ?)',
                          (session['user_id'], title, content))
     note_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     
-    return jsonify({'id': note_id, 'title': title, 'content': content})
+    return jsonify({'id': note_id, 'title': title, 'content': json.loads(content)})
 
 @app.route('/api/notes/<int:note_id>', methods=['PUT'])
+@login_required
 def update_note(note_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     title = data.get('title')
-    content = data.get('content')
+    try:
+        content = note_content_json(data.get('content', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     conn = get_db_connection()
-    conn.execute('UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?',
-                (title, content, note_id, session['user_id']))
+    note = owned_note(conn, note_id)
+    if not note:
+        return jsonify({'error': 'Note not found'}), 404
+    save_note(conn, note, title or note['title'], content)
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
 @app.route('/api/notes/<int:note_id>', methods=['DELETE'])
+@login_required
 def delete_note(note_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     conn = get_db_connection()
     conn.execute('DELETE FROM notes WHERE id = ? AND user_id = ?', (note_id, session['user_id']))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
+@app.route('/api/notes/<int:note_id>/revisions', methods=['GET'])
+@login_required
+@conditional('notes')
+def get_note_revisions(note_id):
+    # Newest first; the next page is requested with ?after=<X-Next-Cursor>
+    conn = get_db_connection()
+    if not owned_note(conn, note_id):
+        return jsonify({'error': 'Note not found'}), 404
+    limit = min(max(request.args.get('limit', REVISION_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = request.args.get('after', type=int)
+    rows = conn.execute('''
+        SELECT id, base_id, title, size, LENGTH(data) AS stored_bytes, created_at, updated_at
+        FROM note_revisions WHERE note_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+    ''', (note_id, after or sys.maxsize, limit + 1)).fetchall()
+    
+    response = jsonify([revision_json(row) for row in rows[:limit]])
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = str(rows[limit - 1]['id'])
+    return response
+
+@app.route('/api/notes/<int:note_id>/revisions/<int:revision_id>', methods=['GET'])
+@login_required
+@conditional('notes')
+def get_note_revision(note_id, revision_id):
+    conn = get_db_connection()
+    revision = conn.execute('''
+        SELECT r.*, LENGTH(r.data) AS stored_bytes FROM note_revisions r
+        WHERE r.id = ? AND r.note_id = ? AND r.user_id = ?
+    ''', (revision_id, note_id, session['user_id'])).fetchone()
+    if not revision:
+        return jsonify({'error': 'Revision not found'}), 404
+    
+    result = revision_json(revision)
+    result['content'] = json.loads(revision_content(conn, revision))
+    return jsonify(result)
+
+@app.route('/api/notes/<int:note_id>/revisions/<int:revision_id>/restore', methods=['POST'])
+@login_required
+def restore_note_revision(note_id, revision_id):
+    conn = get_db_connection()
+    note = owned_note(conn, note_id)
+    revision = conn.execute('SELECT * FROM note_revisions WHERE id = ? AND note_id = ?',
+                            (revision_id, note_id)).fetchone()
+    if not note or not revision:
+        return jsonify({'error': 'Revision not found'}), 404
+    
+    # Restoring is itself recorded, as a revision of its own, so it can be undone
+    save_note(conn, note, revision['title'], revision_content(conn, revision), coalesce=False)
+    conn.commit()
+    return jsonify(note_json(owned_note(conn, note_id)))
+
+NOTE_CREATE_SQL = 'INSERT INTO notes (user_id, title, content) VALUES (?, ?, ?)'
+
+def update_notes(conn, user_id, updates):
+    # Same save path as PUT, so batch updates are recorded as revisions too
+    for note_id, (title, content) in updates:
+        note = conn.execute('SELECT * FROM notes WHERE id = ? AND user_id = ?', (note_id, user_id)).fetchone()
+        save_note(conn, note, title or note['title'], note['content'] if content is None else content)
+
+def note_create_params(operation):
+    if not operation.get('title'):
+        raise ValueError('Title is required')
+    return (operation['title'], note_content_json(operation.get('content', '')))
+
+def note_update_params(operation):
+    content = operation.get('content')
+    return (operation.get('title') or None, note_content_json(content) if content is not None else None)
+
+@app.route('/api/notes/batch', methods=['POST'])
+@login_required
+def batch_notes():
+    return batch_response('notes', request.get_json(),
+                          NOTE_CREATE_SQL, note_create_params, update_notes, note_update_params)
+
+def read_import_file(upload):
+    # .json: a list of {title, content} objects; .ndjson/.jsonl: one object
+    # per line; anything else is a plain text note titled after the file
+    filename = upload.filename or 'Imported note'
+    body = upload.read().decode('utf-8', errors='replace')
+    extension = os.path.splitext(filename)[1].lower()
+    
+    if extension == '.json':
+        items = json.loads(body)
+        if not isinstance(items, list):
+            items = [items]
+    elif extension in ('.ndjson', '.jsonl'):
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        items = [{'title': os.path.splitext(filename)[0], 'content': body}]
+    
+    return [{'op': 'create', 'title': item.get('title'), 'content': item.get('content', '')}
+            if isinstance(item, dict) else {'op': 'create'} for item in items]
+
+@app.route('/api/notes/import', methods=['POST'])
+@login_required
+def import_notes():
+    uploads = request.files.getlist('file')
+    if not uploads:
+        return jsonify({'error': 'No file uploaded'}), 400
+    
+    operations = []
+    try:
+        for upload in uploads:
+            operations.extend(read_import_file(upload))
+    except json.JSONDecodeError:
+        return jsonify({'error': 'Invalid JSON in import file'}), 400
+    
+    # Imports can exceed the per-request batch cap, but still land in one transaction
+    conn = get_db_connection()
+    results = []
+    for i in range(0, len(operations), BATCH_MAX_OPERATIONS):
+        results.extend(apply_batch(conn, 'notes', session['user_id'], operations[i:i + BATCH_MAX_OPERATIONS],
+                                   NOTE_CREATE_SQL, note_create_params, update_notes, note_update_params))
+    conn.commit()
+    
+    return jsonify({'results': results})
+
+# LLM gateway
+# Ollama calls run on a fixed pool of worker threads so slow generations
+# cannot tie up every web worker. Pending jobs are queued per user and
+# served round-robin, and the queue is bounded so callers get a 429 with
+# a Retry-After estimate instead of piling up behind the model.
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '2'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '32'))
+LLM_MAX_QUEUE_PER_USER = int(os.environ.get('LLM_MAX_QUEUE_PER_USER', '4'))
+# Chats waiting on the gateway per process; under `serve` they wait on threads
+# of their own, outside WEB_THREADS, so a burst of chats can't stall CRUD
+CHAT_REQUESTS_PER_WORKER = int(os.environ.get('CHAT_REQUESTS_PER_WORKER', str(LLM_MAX_QUEUE + LLM_MAX_CONCURRENCY)))
+
+class GatewayBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__('LLM queue is full')
+        self.retry_after = retry_after
+
+class LLMGateway:
+    def __init__(self, workers, max_queue, max_queue_per_user):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # user_id -> deque of (future, fn, args, enqueued_at)
+        self._queued = 0
+        self._active = 0
+        self._avg_seconds = 5.0  # moving average of time spent per job
+        self._pid = None
+
+    def _ensure_workers(self):
+        # Started lazily (and again after a fork) since threads don't survive fork()
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f'llm-worker-{i}', daemon=True).start()
+
+    def retry_after(self):
+        waiting = self._queued + self._active
+        return max(1, math.ceil(waiting / self.workers * self._avg_seconds))
+
+    def submit(self, user_id, fn, *args):
+        future = Future()
+        with self._cond:
+            self._ensure_workers()
+            user_queue = self._queues.get(user_id)
+            if self._queued >= self.max_queue or (user_queue and len(user_queue) >= self.max_queue_per_user):
+                raise GatewayBusy(self.retry_after())
+            if user_queue is None:
+                user_queue = self._queues[user_id] = deque()
+            user_queue.append((future, fn, args, time.monotonic()))
+            self._queued += 1
+            self._cond.notify()
+        return future
+
+    def _next_job(self):
+        # Take one job from the user at the head, then rotate them to the back
+        user_id, user_queue = next(iter(self._queues.items()))
+        job = user_queue.popleft()
+        if user_queue:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        self._queued -= 1
+        return job
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                future, fn, args, enqueued_at = self._next_job()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._active += 1
+
+            started = time.monotonic()
+            metrics.observe('llm_queue_wait_seconds', started - enqueued_at)
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.monotonic() - started)
+
+llm_gateway = LLMGateway(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_MAX_QUEUE_PER_USER)
+chat_slots = threading.BoundedSemaphore(CHAT_REQUESTS_PER_WORKER)
+
+def gateway_busy_response(e, status=429):
+    response = jsonify({'error': 'The assistant is busy, please try again shortly', 'retry_after': e.retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# Ollama client
+# One pooled keep-alive session shared by all threads. Requests are spread
+# over OLLAMA_URLS and transient failures (connection errors, 502/503/504)
+# are retried with jittered backoff, on another backend when there is one.
+RETRYABLE_STATUS = {502, 503, 504}
+
+class OllamaClient:
+    def __init__(self, base_urls, connect_timeout, read_timeout, retries, balancing, pool_size):
+        self.base_urls = base_urls
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.balancing = balancing
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._in_flight = {url: 0 for url in base_urls}
+        self._next = 0
+        self._session = None
+        self._pid = None
+
+    def _get_session(self):
+        # Pooled sockets must not be shared with a forked child
+        if self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.base_urls), pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    def _acquire(self, exclude):
+        with self._lock:
+            candidates = [url for url in self.base_urls if url not in exclude] or self.base_urls
+            if self.balancing == 'round_robin':
+                url = candidates[self._next % len(candidates)]
+                self._next += 1
+            else:
+                url = min(candidates, key=lambda u: self._in_flight[u])
+            self._in_flight[url] += 1
+            return url
+
+    def _release(self, url):
+        with self._lock:
+            self._in_flight[url] -= 1
+
+    def reachable(self, timeout):
+        # Base URLs that answer within timeout, for readiness checks
+        session = self._get_session()
+        up = []
+        for url in self.base_urls:
+            try:
+                with session.get(url + '/api/tags', timeout=timeout) as response:
+                    if response.status_code == 200:
+                        up.append(url)
+            except requests.exceptions.RequestException:
+                pass
+        return up
+
+    @contextmanager
+    def post(self, path, payload, stream=False):
+        session = self._get_session()
+        tried = set()
+        attempt = 0
+        while True:
+            url = self._acquire(tried)
+            handed_over = False
+            try:
+                response = session.post(url + path, json=payload, stream=stream, timeout=self.timeout)
+                if response.status_code not in RETRYABLE_STATUS or attempt >= self.retries:
+                    handed_over = True
+                    break
+                response.close()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.retries:
+                    raise
+            finally:
+                # Whatever goes wrong, the backend only stays counted while the caller holds its response
+                if not handed_over:
+                    self._release(url)
+            tried.add(url)
+            attempt += 1
+            time.sleep(random.uniform(0, 0.25 * 2 ** attempt))
+
+        try:
+            yield response
+        finally:
+            response.close()
+            self._release(url)
+
+ollama_client = OllamaClient(OLLAMA_URLS, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT, OLLAMA_RETRIES,
+                             OLLAMA_BALANCING, pool_size=LLM_MAX_CONCURRENCY + 2)
+
+OLLAMA_UNAVAILABLE_MESSAGE = 'Sorry, I am currently unavailable.'
+OLLAMA_DOWN_MESSAGE = 'Sorry, I am currently unavailable. Please make sure Ollama is running.'
+NO_RESPONSE_MESSAGE = 'No response from AI'
+FALLBACK_MESSAGES = {OLLAMA_UNAVAILABLE_MESSAGE, OLLAMA_DOWN_MESSAGE, NO_RESPONSE_MESSAGE}
+
+class ContextRejected(Exception):
+    pass
+
+def generate_payload(prompt, stream, context):
+    payload = {'model': OLLAMA_MODEL, 'prompt': prompt, 'stream': stream}
+    if context:
+        payload['context'] = context
+    return payload
+
+def check_context_accepted(ollama_response, context):
+    # A saved context that Ollama refuses (e.g. after a model reload with a
+    # smaller window) is reported so the caller can resend the full prompt
+    if context and ollama_response.status_code != 200 and ollama_response.status_code not in RETRYABLE_STATUS:
+        raise ContextRejected()
+
+def ollama_generate(prompt, context=None, on_context=None):
+    started = time.perf_counter()
+    try:
+        # Send message to Ollama API
+        with ollama_client.post('/api/generate', generate_payload(prompt, False, context)) as ollama_response:
+            check_context_accepted(ollama_response, context)
+            if ollama_response.status_code == 200:
+                result = ollama_response.json()
+                record_generation('generate', started, result)
+                if on_context and result.get('context'):
+                    on_context(result['context'])
+                return result.get('response', NO_RESPONSE_MESSAGE)
+            return OLLAMA_UNAVAILABLE_MESSAGE
+    
+    except requests.exceptions.RequestException:
+        return OLLAMA_DOWN_MESSAGE
+
+def ollama_stream(prompt, emit, stop, context=None, on_context=None):
+    # Push each generated token to emit() until done or the caller sets stop
+    emitted = False
+    started = time.perf_counter()
+    try:
+        with ollama_client.post('/api/generate', generate_payload(prompt, True, context), stream=True) as ollama_response:
+            check_context_accepted(ollama_response, context)
+            if ollama_response.status_code != 200:
+                emit(OLLAMA_UNAVAILABLE_MESSAGE)
+                return
+            for line in ollama_response.iter_lines():
+                if stop.is_set():
+                    return
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                token = chunk.get('response', '')
+                if token:
+                    if not emitted:
+                        metrics.observe('llm_time_to_first_token_seconds', time.perf_counter() - started)
+                    emitted = True
+                    emit(token)
+                if chunk.get('done'):
+                    record_generation('stream', started, chunk)
+                    if on_context and chunk.get('context'):
+                        on_context(chunk['context'])
+                    return
+    except (requests.exceptions.RequestException, ValueError):
+        if not emitted:
+            emit(OLLAMA_DOWN_MESSAGE)
+
+# Conversation context
+# Chats that belong to a conversation are prompted with its history, fitted
+# into CONTEXT_TOKEN_BUDGET (estimated at ~4 characters per token). Recent
+# turns are kept verbatim; once they no longer fit, the oldest are folded
+# into a rolling summary stored in conversation_summaries. Turns are folded
+# until the verbatim part is down to half its budget, so the summary is
+# rewritten every few turns rather than on every message.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '2048'))
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_TOKENS', '384'))
+CHARS_PER_TOKEN = 4
+SPEAKERS = {'user': 'User', 'ai': 'Assistant'}
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def format_turn(sender, content):
+    return f"{SPEAKERS.get(sender, 'User')}: {content.strip()}"
+
+def extractive_summary(summary, turns, max_chars):
+    # Used when the model can't summarize: keep the first sentence of each turn
+    lines = [summary] if summary else []
+    for sender, content in turns:
+        first_sentence = re.split(r'(?<=[.!?])\s', content.strip(), maxsplit=1)[0][:200]
+        lines.append(format_turn(sender, first_sentence))
+    text = '\n'.join(lines)
+    return text[-max_chars:] if len(text) > max_chars else text
+
+def summarize_turns(summary, turns):
+    max_chars = CONTEXT_SUMMARY_TOKENS * CHARS_PER_TOKEN
+    transcript = '\n'.join(format_turn(sender, content[:1000]) for sender, content in turns)
+    prompt = ('Update the summary of this conversation with the new messages. Keep names, facts, '
+              f'decisions and open questions. Answer with the summary only, in at most {max_chars // 6} words.\n\n'
+              f'Current summary:\n{summary or "(none)"}\n\nNew messages:\n{transcript}\n\nUpdated summary:')
+    try:
+        with ollama_client.post('/api/generate', {
+            'model': OLLAMA_MODEL,
+            'prompt': prompt,
+            'stream': False,
+            'options': {'num_predict': CONTEXT_SUMMARY_TOKENS}
+        }) as ollama_response:
+            if ollama_response.status_code == 200:
+                text = ollama_response.json().get('response', '').strip()
+                if text:
+                    return text[:max_chars]
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+    return extractive_summary(summary, turns, max_chars)
+
+def build_prompt(conversation_id, message):
+    conn = get_db_connection()
+    stored = conn.execute('SELECT summary, summarized_count FROM conversation_summaries WHERE conversation_id = ?',
+                          (conversation_id,)).fetchone()
+    summary = stored['summary'] if stored else ''
+    summarized_count = stored['summarized_count'] if stored else 0
+    rows = conn.execute('''
+        SELECT position, sender, content FROM conversation_messages
+        WHERE conversation_id = ? AND position >= ? ORDER BY position
+    ''', (conversation_id, summarized_count)).fetchall()
+    
+    budget = max(CONTEXT_TOKEN_BUDGET - CONTEXT_SUMMARY_TOKENS - estimate_tokens(message), 0)
+    costs = [estimate_tokens(format_turn(row['sender'], row['content'])) for row in rows]
+    if sum(costs) > budget:
+        # Keep the newest turns that fit in half the budget and fold the rest
+        keep, used = len(rows), 0
+        while keep > 0 and used + costs[keep - 1] <= budget // 2:
+            keep -= 1
+            used += costs[keep]
+        folded = [(row['sender'], row['content']) for row in rows[:keep]]
+        summary = summarize_turns(summary, folded)
+        summarized_count = rows[keep - 1]['position'] + 1
+        conn.execute('''
+            INSERT INTO conversation_summaries (conversation_id, user_id, summary, summarized_count)
+            SELECT id, user_id, ?, ? FROM conversations WHERE id = ?
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_count = excluded.summarized_count,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.summarized_count > conversation_summaries.summarized_count
+        ''', (summary, summarized_count, conversation_id))
+        conn.commit()
+        rows = rows[keep:]
+    
+    parts = ['You are NoteBuddy, a helpful assistant. Continue the conversation below.']
+    if summary:
+        parts.append(f'Summary of the earlier conversation:\n{summary}')
+    parts.append('\n'.join([format_turn(row['sender'], row['content']) for row in rows] +
+                           [format_turn('user', message), 'Assistant:']))
+    return '\n\n'.join(parts)
+
+def pack_context(context):
+    packed = array('I', context)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_context(blob):
+    context = array('I')
+    context.frombytes(blob)
+    if sys.byteorder == 'big':
+        context.byteswap()
+    return context.tolist()
+
+def saved_context(conn, conversation_id, message_count, message):
+    # Reusable only if nothing was added or removed since it was saved, the
+    # model is the same and the next turn still fits the token budget
+    row = conn.execute('SELECT model, message_count, context FROM conversation_contexts WHERE conversation_id = ?',
+                       (conversation_id,)).fetchone()
+    if not row or row['model'] != OLLAMA_MODEL or row['message_count'] != message_count:
+        return None
+    context = unpack_context(row['context'])
+    if len(context) + estimate_tokens(message) > CONTEXT_TOKEN_BUDGET:
+        return None
+    return context
+
+def save_context(conversation_id, message_count, context):
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO conversation_contexts (conversation_id, user_id, model, message_count, context)
+        SELECT id, user_id, ?, ?, ? FROM conversations WHERE id = ?
+        ON CONFLICT (conversation_id) DO UPDATE SET
+            model = excluded.model,
+            message_count = excluded.message_count,
+            context = excluded.context,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (OLLAMA_MODEL, message_count, pack_context(context), conversation_id))
+    conn.commit()
+
+def with_context(generate, conversation_id, message, *args):
+    # Runs on the gateway worker, so summarizing counts against the LLM
+    # concurrency limit. When Ollama's context from the previous reply is
+    # still valid only the new message is sent and the earlier turns aren't
+    # evaluated again; otherwise the full prompt is built from the history.
+    conn = get_db_connection()
+    message_count = conn.execute('SELECT COUNT(*) FROM conversation_messages WHERE conversation_id = ?',
+                                 (conversation_id,)).fetchone()[0]
+    # The client stores this message and the reply once the reply arrives
+    on_context = lambda context: save_context(conversation_id, message_count + 2, context)
+    
+    context = saved_context(conn, conversation_id, message_count, message)
+    if context:
+        try:
+            return generate(message, *args, context=context, on_context=on_context)
+        except ContextRejected:
+            conn.execute('DELETE FROM conversation_contexts WHERE conversation_id = ?', (conversation_id,))
+            conn.commit()
+    return generate(build_prompt(conversation_id, message), *args, on_context=on_context)
+
+# Chat response cache
+# Repeated prompts (canned greetings, "summarize my todos") are answered from
+# an in-memory LRU keyed on model + normalized prompt. Entries expire after
+# CHAT_CACHE_TTL seconds and the cache is capped both by entry count and by
+# total response size. With CHAT_CACHE_PERSIST=1 entries are also written to
+# the response_cache table so they survive restarts and are shared between
+# worker processes.
+CHAT_CACHE_MAX_ENTRIES = int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', '1000'))
+CHAT_CACHE_MAX_BYTES = int(os.environ.get('CHAT_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+CHAT_CACHE_TTL = int(os.environ.get('CHAT_CACHE_TTL', '3600'))
+CHAT_CACHE_PERSIST = os.environ.get('CHAT_CACHE_PERSIST', '0') == '1'
+
+def normalize_prompt(prompt):
+    # Case, whitespace and trailing punctuation don't change the answer
+    return ' '.join(prompt.lower().split()).rstrip('.!?')
+
+class ResponseCache:
+    def __init__(self, max_entries, max_bytes, ttl, persist):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._bytes = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def key(self, model, prompt):
+        return hashlib.sha256(f'{model}\0{normalize_prompt(prompt)}'.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                self._remove(key)
+
+        if self.persist:
+            conn = get_db_connection()
+            row = conn.execute('SELECT response, expires_at FROM response_cache WHERE key = ? AND expires_at > ?',
+                               (key, now)).fetchone()
+            if row:
+                with self._lock:
+                    self._store(key, row['response'], row['expires_at'])
+                    self.persistent_hits += 1
+                return row['response']
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, model, response):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, response, expires_at)
+
+        if self.persist:
+            conn = get_db_connection()
+            conn.execute('INSERT OR REPLACE INTO response_cache (key, model, response, expires_at) VALUES (?, ?, ?, ?)',
+                         (key, model, response, expires_at))
+            conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.persist:
+            conn = get_db_connection()
+            conn.execute('DELETE FROM response_cache')
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.persistent_hits) / lookups, 4) if lookups else 0.0,
+                'persistent': self.persist
+            }
+
+    def _store(self, key, response, expires_at):
+        if key in self._entries:
+            self._remove(key)
+        size = len(response.encode())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (response, expires_at)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        response, _ = self._entries.pop(key)
+        self._bytes -= len(response.encode())
+
+response_cache = ResponseCache(CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_MAX_BYTES, CHAT_CACHE_TTL, CHAT_CACHE_PERSIST)
+
+# Gateway and cache state, read when /metrics is scraped
+metrics.gauge('llm_gateway_jobs', 'Chat jobs in the LLM gateway.',
+              lambda: {(('state', 'queued'),): llm_gateway._queued, (('state', 'active'),): llm_gateway._active})
+metrics.gauge('chat_cache_entries', 'Entries in the in-memory chat response cache.',
+              lambda: {(): response_cache.stats()['entries']})
+metrics.gauge('chat_cache_hit_ratio', 'Share of chat cache lookups served from the cache.',
+              lambda: {(): response_cache.stats()['hit_rate']})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Open to admins, to METRICS_TOKEN bearers when a token is set, and to
+    # loopback scrapers with METRICS_ALLOW_LOCAL=1
+    authorized = bool(METRICS_TOKEN) and hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                             f'Bearer {METRICS_TOKEN}')
+    if METRICS_ALLOW_LOCAL and request.remote_addr in ('127.0.0.1', '::1'):
+        authorized = True
+    if not (authorized or ('user_id' in session and is_admin())):
+        return jsonify({'error': 'Access denied'}), 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Chat API routes
+def save_chat_message(user_id, message, response_text):
+    conn = get_db_connection()
+    conn.execute('INSERT INTO chat_messages (user_id, message, response) VALUES (?, ?, ?)',
+                (user_id, message, response_text))
+    conn.commit()
+
+def stream_chat(user_id, message, future, chunks, stop, cache_key, sources=None):
+    # Relay tokens from the gateway worker as they arrive, then persist the full response
+    tokens = []
+    finished = False
+    try:
+        while True:
+            token = chunks.get()
+            if token is None:
+                finished = True
+                break
+            tokens.append(token)
+            yield json.dumps({'token': token}) + '\n'
+    finally:
+        # Runs on normal completion and when the client disconnects mid-stream
+        stop.set()
+        future.cancel()
+        response_text = ''.join(tokens) or NO_RESPONSE_MESSAGE
+        save_chat_message(user_id, message, response_text)
+        if finished and cache_key and response_text not in FALLBACK_MESSAGES:
+            response_cache.put(cache_key, OLLAMA_MODEL, response_text)
+
+    done = {'done': True, 'response': response_text}
+    if sources is not None:
+        done['sources'] = sources
+    yield json.dumps(done) + '\n'
+
+def chat_generator(generate, user_id, conversation_id=None, sources=None):
+    # Wraps generate with the conversation history and, when sources is a
+    # list, the user's matching notes
+    if conversation_id:
+        generate = partial(with_context, generate, conversation_id)
+    if sources is not None:
+        generate = partial(with_notes, generate, user_id, sources)
+    return generate
+
+def stream_cached_chat(response_text):
+    yield json.dumps({'token': response_text}) + '\n'
+    yield json.dumps({'done': True, 'response': response_text, 'cached': True}) + '\n'
+
 @app.route('/api/chat', methods=['POST'])
+@login_required
 def chat():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     message = data.get('message')
     
     if not message:
         return jsonify({'error': 'Message is required'}), 400
     
-    try:
-        # Send message to Ollama API
-        ollama_response = requests.post('http://localhost:11434/api/generate', 
-                                      json={
-                                          'model': 'llama3.2:3b',  # Change this to your preferred model
-                                          'prompt': message,
-                                          'stream': False
-                                      }, timeout=30)
+    user_id = session['user_id']
+    stream_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    
+    # With a conversation_id the prompt includes that conversation's history
+    conversation_id = data.get('conversation_id')
+    has_history = False
+    if conversation_id:
+        conn = get_db_connection()
+        if not conn.execute('SELECT 1 FROM conversations WHERE id = ? AND user_id = ?',
+                            (conversation_id, user_id)).fetchone():
+            return jsonify({'error': 'Conversation not found'}), 404
+        has_history = conn.execute('SELECT 1 FROM conversation_messages WHERE conversation_id = ? LIMIT 1',
+                                   (conversation_id,)).fetchone() is not None
+    
+    # With "notes": true the prompt includes the best matching parts of the
+    # user's notes and todos, and the response lists them as sources
+    use_notes = bool(data.get('notes'))
+    if use_notes and numpy is None:
+        return jsonify({'error': 'Asking your notes needs numpy installed on the server'}), 503
+    sources = [] if use_notes else None
+    
+    # Answers that depend on history or notes are never cached. Pass "cache":
+    # false to skip the lookup; the fresh answer still refreshes the cache.
+    cache_key = None if has_history or use_notes else response_cache.key(OLLAMA_MODEL, message)
+    cached_text = response_cache.get(cache_key) if cache_key and data.get('cache', True) else None
+    if cached_text is not None:
+        save_chat_message(user_id, message, cached_text)
+        if data.get('stream'):
+            return Response(stream_cached_chat(cached_text), mimetype='application/x-ndjson', headers=stream_headers)
+        return jsonify({'response': cached_text, 'cached': True})
+    
+    if not chat_slots.acquire(blocking=False):
+        return gateway_busy_response(GatewayBusy(llm_gateway.retry_after()), 503)
+    
+    if data.get('stream'):
+        chunks = queue.Queue()
+        stop = threading.Event()
+        generate = chat_generator(ollama_stream, user_id, conversation_id if has_history else None, sources)
+        try:
+            future = llm_gateway.submit(user_id, generate, message, chunks.put, stop)
+        except GatewayBusy as e:
+            chat_slots.release()
+            return gateway_busy_response(e)
+        # Wakes the relay both when generation finishes and when the job is cancelled
+        future.add_done_callback(lambda f: chunks.put(None))
         
-        if ollama_response.status_code == 200:
-            response_text = ollama_response.json().get('response', 'No response from AI')
-        else:
-            response_text = 'Sorry, I am currently unavailable.'
+        response = Response(stream_with_context(stream_chat(user_id, message, future, chunks, stop, cache_key, sources)),
+                            mimetype='application/x-ndjson', headers=stream_headers)
+        response.call_on_close(chat_slots.release)
+        leave_request_slot()
+        return response
     
-    except requests.exceptions.RequestException:
-        response_text = 'Sorry, I am currently unavailable. Please make sure Ollama is running.'
+    generate = chat_generator(ollama_generate, user_id, conversation_id if has_history else None, sources)
+    try:
+        future = llm_gateway.submit(user_id, generate, message)
+        leave_request_slot()
+        response_text = future.result()
+    except GatewayBusy as e:
+        return gateway_busy_response(e)
+    finally:
+        chat_slots.release()
+    
+    if cache_key and response_text not in FALLBACK_MESSAGES:
+        response_cache.put(cache_key, OLLAMA_MODEL, response_text)
     
     # Save chat message to database
-    conn = get_db_connection()
-    conn.execute('INSERT INTO chat_messages (user_id, message, response) VALUES (?, ?, ?)',
-                (session['user_id'], message, response_text))
-    conn.commit()
-    conn.close()
+    save_chat_message(user_id, message, response_text)
     
+    if sources is not None:
+        return jsonify({'response': response_text, 'sources': sources})
     return jsonify({'response': response_text})
 
+CHAT_MESSAGE_COLUMNS = {field: field for field in ('id', 'user_id', 'message', 'response', 'timestamp')}
+
 @app.route('/api/chat/history', methods=['GET'])
+@login_required
+@conditional('chat_messages')
 def get_chat_history():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = get_db_connection()
-    messages = conn.execute('SELECT * FROM chat_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT 50', 
-                           (session['user_id'],)).fetchall()
-    conn.close()
-    
-    return jsonify([dict(msg) for msg in messages])
+    return list_page('chat_messages', 'timestamp', CHAT_MESSAGE_COLUMNS, default_limit=50)
 
 # Conversation management API routes
+CONVERSATION_COLUMNS = {field: field for field in ('id', 'title', 'created_at', 'updated_at')}
+
 @app.route('/api/conversations', methods=['GET'])
+@login_required
+@conditional('conversations')
 def get_conversations():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = get_db_connection()
-    conversations = conn.execute('SELECT id, title, created_at, updated_at FROM conversations WHERE user_id = ? ORDER BY updated_at DESC', 
-                               (session['user_id'],)).fetchall()
-    conn.close()
-    
-    return jsonify([dict(conv) for conv in conversations])
+    return list_page('conversations', 'updated_at', CONVERSATION_COLUMNS)
+
+def append_conversation_messages(conn, conversation_id, messages, start=None):
+    # Positions continue from the last stored message. When the caller says
+    # where its batch starts, messages we already have are skipped so retried
+    # or full-history saves don't duplicate turns.
+    count = conn.execute('SELECT COUNT(*) FROM conversation_messages WHERE conversation_id = ?',
+                         (conversation_id,)).fetchone()[0]
+    if start is None:
+        start = count
+    if start > count:
+        return None
+    new_messages = messages[count - start:]
+    conn.executemany('''
+        INSERT INTO conversation_messages (conversation_id, user_id, position, sender, content)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(conversation_id, session['user_id'], count + i, message.get('sender', 'user'), message.get('content', ''))
+          for i, message in enumerate(new_messages)])
+    return count + len(new_messages)
 
 @app.route('/api/conversations', methods=['POST'])
+@login_required
 def save_conversation():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     data = request.get_json()
     title = data.get('title')
     messages = data.get('messages')
@@ -510,134 +2731,1525 @@ def save_conversation():
     conn = get_db_connection()
     
     if conversation_id:
-        # Update existing conversation
-        conn.execute('UPDATE conversations SET title = ?, messages = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?',
-                    (title, json.dumps(messages), conversation_id, session['user_id']))
+        # Update existing conversation; messages is the full history, so only the tail is new
+        cursor = conn.execute('UPDATE conversations SET title = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?',
+                             (title, conversation_id, session['user_id']))
+        if cursor.rowcount == 0:
+            return jsonify({'error': 'Conversation not found'}), 404
+        message_count = append_conversation_messages(conn, conversation_id, messages, start=0)
     else:
         # Create new conversation
-        cursor = conn.execute('INSERT INTO conversations (user_id, title, messages) VALUES (?, ?, ?)',
-                             (session['user_id'], title, json.dumps(messages)))
+        cursor = conn.execute("INSERT INTO conversations (user_id, title, messages) VALUES (?, ?, '[]')",
+                             (session['user_id'], title))
         conversation_id = cursor.lastrowid
+        message_count = append_conversation_messages(conn, conversation_id, messages)
     
     conn.commit()
-    conn.close()
     
-    return jsonify({'id': conversation_id, 'title': title, 'success': True})
+    return jsonify({'id': conversation_id, 'title': title, 'message_count': message_count, 'success': True})
+
+@app.route('/api/conversations/<int:conversation_id>/messages', methods=['POST'])
+@login_required
+def append_conversation(conversation_id):
+    data = request.get_json()
+    messages = data.get('messages')
+    start = data.get('start')  # Position of the first message in this batch
+    
+    if not messages:
+        return jsonify({'error': 'Messages are required'}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.execute('UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?',
+                         (conversation_id, session['user_id']))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        return jsonify({'error': 'Conversation not found'}), 404
+    
+    message_count = append_conversation_messages(conn, conversation_id, messages, start)
+    if message_count is None:
+        conn.rollback()
+        return jsonify({'error': 'Messages are missing before this batch'}), 409
+    conn.commit()
+    
+    return jsonify({'id': conversation_id, 'message_count': message_count, 'success': True})
 
 @app.route('/api/conversations/<int:conversation_id>', methods=['GET'])
+@login_required
+@conditional('conversations')
 def get_conversation(conversation_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     conn = get_db_connection()
-    conversation = conn.execute('SELECT * FROM conversations WHERE id = ? AND user_id = ?', 
+    conversation = conn.execute('SELECT id, title, created_at, updated_at FROM conversations WHERE id = ? AND user_id = ?', 
                               (conversation_id, session['user_id'])).fetchone()
-    conn.close()
     
     if not conversation:
         return jsonify({'error': 'Conversation not found'}), 404
     
-    try:
-        messages = json.loads(conversation['messages'])
-        return jsonify({
-            'id': conversation['id'],
-            'title': conversation['title'],
-            'messages': messages,
-            'created_at': conversation['created_at'],
-            'updated_at': conversation['updated_at']
-        })
-    except json.JSONDecodeError:
-        return jsonify({'error': 'Invalid conversation data'}), 500
+    # Messages are returned oldest first, one page at a time; pass the returned
+    # next_after as ?after= to continue
+    after = request.args.get('after', -1, type=int)
+    limit = min(max(request.args.get('limit', MAX_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    rows = conn.execute('''
+        SELECT position, sender, content FROM conversation_messages
+        WHERE conversation_id = ? AND position > ?
+        ORDER BY position LIMIT ?
+    ''', (conversation_id, after, limit + 1)).fetchall()
+    
+    page = rows[:limit]
+    return jsonify({
+        'id': conversation['id'],
+        'title': conversation['title'],
+        'messages': [{'sender': row['sender'], 'content': row['content']} for row in page],
+        'next_after': page[-1]['position'] if len(rows) > limit else None,
+        'created_at': conversation['created_at'],
+        'updated_at': conversation['updated_at']
+    })
 
 @app.route('/api/conversations/<int:conversation_id>', methods=['DELETE'])
+@login_required
 def delete_conversation(conversation_id):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
     conn = get_db_connection()
-    conn.execute('DELETE FROM conversations WHERE id = ? AND user_id = ?', 
-                (conversation_id, session['user_id']))
+    cursor = conn.execute('DELETE FROM conversations WHERE id = ? AND user_id = ?', 
+                         (conversation_id, session['user_id']))
+    if cursor.rowcount:
+        conn.execute('DELETE FROM conversation_messages WHERE conversation_id = ?', (conversation_id,))
+        conn.execute('DELETE FROM conversation_summaries WHERE conversation_id = ?', (conversation_id,))
+        conn.execute('DELETE FROM conversation_contexts WHERE conversation_id = ?', (conversation_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
-# File export endpoints
-@app.route('/api/notes/<int:note_id>/export/<format_type>', methods=['GET'])
-def export_note(note_id, format_type):
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
+# Change feed
+# Triggers append a row to change_events for every todo, note and
+# conversation write. Clients catch up with /api/changes?since=<seq> or
+# follow /api/changes/stream (server-sent events) and apply the changes to
+# their lists instead of refetching them. Events are coalesced per item and
+# carry the item's current state, the same fields the list endpoints return.
+CHANGE_EVENTS_RETENTION_DAYS = int(os.environ.get('CHANGE_EVENTS_RETENTION_DAYS', '7'))
+CHANGE_STREAM_POLL_SECONDS = float(os.environ.get('CHANGE_STREAM_POLL_SECONDS', '1'))
+CHANGE_STREAM_MAX_SECONDS = int(os.environ.get('CHANGE_STREAM_MAX_SECONDS', '300'))
+CHANGE_STREAM_KEEPALIVE_SECONDS = 15
+CHANGE_STREAM_BUSY_RETRY_SECONDS = 30
+# Open streams per process; under `serve` they run on threads of their own, outside WEB_THREADS
+CHANGE_STREAMS_PER_WORKER = int(os.environ.get('CHANGE_STREAMS_PER_WORKER', '64'))
+CHANGE_PAGE_SIZE = 500
+
+CHANGE_ITEM_QUERIES = {
+    'todos': ('todos', TODO_COLUMNS, ['id', 'title', 'completed', 'created_at']),
+    'notes': ('notes', NOTE_COLUMNS, NOTE_SUMMARY_FIELDS),
+    'conversations': ('conversations', CONVERSATION_COLUMNS, list(CONVERSATION_COLUMNS))
+}
+
+# Writes made by this process wake its open streams without waiting for the next poll
+change_notifier = threading.Condition()
+change_stream_slots = threading.BoundedSemaphore(CHANGE_STREAMS_PER_WORKER)
+
+@app.after_request
+def notify_change_streams(response):
+    if request.method in ('POST', 'PUT', 'DELETE') and response.status_code < 400:
+        with change_notifier:
+            change_notifier.notify_all()
+    return response
+
+def change_floor(conn):
+    # Lowest seq still on record; a client behind it may have missed pruned events
+    row = conn.execute('SELECT MIN(seq) FROM change_events').fetchone()
+    if row[0] is not None:
+        return row[0]
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_events'").fetchone()
+    return row[0] + 1 if row else 1
+
+def prune_change_events(conn):
+    conn.execute("DELETE FROM change_events WHERE created_at < datetime('now', ?)",
+                 (f'-{CHANGE_EVENTS_RETENTION_DAYS} days',))
+    conn.commit()
+
+def read_changes(conn, user_id, since, limit=CHANGE_PAGE_SIZE):
+    # Returns (changes, last_seq, has_more); changes hold one entry per item
+    events = conn.execute('''
+        SELECT seq, collection, item_id, action FROM change_events
+        WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?
+    ''', (user_id, since, limit + 1)).fetchall()
+    has_more = len(events) > limit
+    events = events[:limit]
+    if not events:
+        return [], since, False
+    
+    latest = {}
+    for event in events:
+        latest[(event['collection'], event['item_id'])] = event
+    
+    items = {}
+    for collection, (table, columns, fields) in CHANGE_ITEM_QUERIES.items():
+        ids = [item_id for (event_collection, item_id) in latest if event_collection == collection]
+        for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+            chunk = ids[i:i + SQLITE_MAX_PARAMS]
+            select_sql = ', '.join(f'{columns[field]} AS {field}' for field in fields)
+            rows = conn.execute(f'''
+                SELECT {select_sql} FROM {table}
+                WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})
+            ''', [user_id] + chunk).fetchall()
+            items.update(((collection, row['id']), dict(row)) for row in rows)
+    
+    changes = []
+    for key, event in sorted(latest.items(), key=lambda entry: entry[1]['seq']):
+        item = items.get(key)
+        changes.append({
+            'seq': event['seq'],
+            'collection': event['collection'],
+            'id': event['item_id'],
+            # An item that is gone by now is reported deleted whatever happened to it before
+            'action': event['action'] if item else 'deleted',
+            'item': item
+        })
+    return changes, events[-1]['seq'], has_more
+
+def parse_since():
+    # EventSource resends the last id it saw when it reconnects
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    if since is None or not since.lstrip('-').isdigit():
+        return None
+    return int(since)
+
+@app.route('/api/changes', methods=['GET'])
+@login_required
+def get_changes():
+    # Without ?since= only the current position is returned, to start from
+    # after a full load. It is the user's own latest event, not the global
+    # sequence, which would reveal other accounts' activity. A user with no
+    # retained events starts at the floor so the cursor isn't already stale.
+    conn = get_db_connection()
+    since = parse_since()
+    if since is None:
+        last_seq = conn.execute('SELECT MAX(seq) FROM change_events WHERE user_id = ?',
+                                (session['user_id'],)).fetchone()[0]
+        if last_seq is None:
+            last_seq = change_floor(conn) - 1
+        return jsonify({'changes': [], 'last_seq': last_seq, 'has_more': False})
     
+    if since + 1 < change_floor(conn):
+        return jsonify({'error': 'Changes since this point are no longer available; reload', 'reset': True}), 410
+    
+    limit = min(max(request.args.get('limit', CHANGE_PAGE_SIZE, type=int), 1), CHANGE_PAGE_SIZE)
+    changes, last_seq, has_more = read_changes(conn, session['user_id'], since, limit)
+    if random.random() < 0.01:
+        prune_change_events(conn)
+    return jsonify({'changes': changes, 'last_seq': last_seq, 'has_more': has_more})
+
+def stream_changes(user_id, since):
     conn = get_db_connection()
-    note = conn.execute('SELECT * FROM notes WHERE id = ? AND user_id = ?', 
-                       (note_id, session['user_id'])).fetchone()
-    conn.close()
+    if since + 1 < change_floor(conn):
+        yield 'event: reset\ndata: {}\n\n'
+        return
     
-    if not note:
-        return jsonify({'error': 'Note not found'}), 404
+    # Streams end after CHANGE_STREAM_MAX_SECONDS so a worker thread isn't held
+    # forever; EventSource reconnects with Last-Event-ID and resumes
+    yield f'retry: {int(CHANGE_STREAM_POLL_SECONDS * 1000)}\n\n'
+    started = last_sent = time.monotonic()
+    while time.monotonic() - started < CHANGE_STREAM_MAX_SECONDS and not shutting_down.is_set():
+        changes, since, _ = read_changes(conn, user_id, since)
+        for change in changes:
+            yield f"id: {change['seq']}\nevent: change\ndata: {app.json.dumps(change)}\n\n"
+        if changes:
+            last_sent = time.monotonic()
+            continue
+        if time.monotonic() - last_sent >= CHANGE_STREAM_KEEPALIVE_SECONDS:
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        with change_notifier:
+            change_notifier.wait(CHANGE_STREAM_POLL_SECONDS)
+
+@app.route('/api/changes/stream', methods=['GET'])
+@login_required
+def get_change_stream():
+    since = parse_since()
+    if since is None:
+        return jsonify({'error': 'since is required'}), 400
+    if not change_stream_slots.acquire(blocking=False):
+        # The client keeps up with /api/changes after its own writes until a stream frees up
+        return Response(f'retry: {CHANGE_STREAM_BUSY_RETRY_SECONDS * 1000}\n\n', status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(CHANGE_STREAM_BUSY_RETRY_SECONDS), 'Cache-Control': 'no-cache'})
+    response = Response(stream_with_context(stream_changes(session['user_id'], since)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(change_stream_slots.release)
+    leave_request_slot()
+    return response
+
+# Search API routes
+# Highlight markers are control characters so the indexed text can be
+# HTML-escaped before they are turned into <mark> tags
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+SEARCH_QUERIES = {
+    'notes': '''
+        SELECT n.id, n.updated_at,
+               highlight(notes_fts, 1, char(2), char(3)) AS title,
+               snippet(notes_fts, 2, char(2), char(3), '…', 16) AS snippet
+        FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid
+        WHERE notes_fts MATCH ?
+        ORDER BY bm25(notes_fts, 0.0, 10.0, 1.0) LIMIT ? OFFSET ?
+    ''',
+    'todos': '''
+        SELECT t.id, t.completed, t.created_at,
+               highlight(todos_fts, 1, char(2), char(3)) AS title
+        FROM todos_fts JOIN todos t ON t.id = todos_fts.rowid
+        WHERE todos_fts MATCH ?
+        ORDER BY bm25(todos_fts, 0.0, 1.0) LIMIT ? OFFSET ?
+    ''',
+    'conversations': '''
+        SELECT m.conversation_id, m.position, m.sender, c.title, c.updated_at,
+               snippet(messages_fts, 1, char(2), char(3), '…', 16) AS snippet
+        FROM messages_fts
+        JOIN conversation_messages m ON m.id = messages_fts.rowid
+        JOIN conversations c ON c.id = m.conversation_id
+        WHERE messages_fts MATCH ?
+        ORDER BY bm25(messages_fts, 0.0, 1.0) LIMIT ? OFFSET ?
+    '''
+}
+SEARCH_COLUMNS = {'notes': '{title body}', 'todos': 'title', 'conversations': 'content'}
+HIGHLIGHTED_FIELDS = ('title', 'snippet')
+
+def build_match_query(user_id, query, columns):
+    # Every word becomes a quoted prefix term, so user input can't inject FTS syntax
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    phrase = ' '.join(f'"{term}"*' for term in terms)
+    return f'owner:"{user_id}" AND {columns} : ({phrase})'
+
+def render_highlights(text):
+    return html.escape(text or '').replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+@app.route('/api/search', methods=['GET'])
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    types = request.args.get('type', 'notes,todos,conversations').split(',')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
     
-    try:
-        # Parse rich text content
-        content_data = json.loads(note['content']) if note['content'] else {'text': '', 'html': ''}
-        
-        if format_type == 'pdf':
-            # For PDF export, return the text content
-            return jsonify({
-                'title': note['title'],
-                'content': content_data.get('text', ''),
-                'html': content_data.get('html', '')
-            })
-        elif format_type == 'html':
-            # For HTML/DOCX export
-            html_content = f"""
-<!DOCTYPE html>
+    unknown = [t for t in types if t not in SEARCH_QUERIES]
+    if unknown:
+        return jsonify({'error': f'Unknown search types: {", ".join(unknown)}'}), 400
+    
+    conn = get_db_connection()
+    results = {}
+    for search_type in types:
+        match_query = build_match_query(session['user_id'], query, SEARCH_COLUMNS[search_type])
+        rows = conn.execute(SEARCH_QUERIES[search_type], (match_query, limit, offset)).fetchall() if match_query else []
+        results[search_type] = [
+            {key: render_highlights(row[key]) if key in HIGHLIGHTED_FIELDS else row[key] for key in row.keys()}
+            for row in rows
+        ]
+    
+    return jsonify({'query': query, 'limit': limit, 'offset': offset, 'results': results})
+
+# Note rendering
+EXPORT_FORMATS = {
+    'html': ('html', 'text/html'),
+    'markdown': ('md', 'text/markdown'),
+    'text': ('txt', 'text/plain')
+}
+
+EXPORT_HTML_TEMPLATE = """<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
-    <title>{note['title']}</title>
+    <title>{title}</title>
     <style>
         body {{ font-family: Arial, sans-serif; margin: 20px; line-height: 1.6; }}
         h1 {{ margin-bottom: 20px; }}
     </style>
 </head>
 <body>
-    <h1>{note['title']}</h1>
-    {content_data.get('html', '')}
+    <h1>{title}</h1>
+    {body}
 </body>
 </html>
-            """
-            return html_content, 200, {'Content-Type': 'text/html'}
-        
+"""
+
+def note_text_and_html(content):
+    # Rich text notes store {"text", "html"}; older notes are plain text
+    try:
+        content_data = json.loads(content) if content else {'text': '', 'html': ''}
     except json.JSONDecodeError:
-        # Fallback for old plain text notes
-        if format_type == 'pdf':
-            return jsonify({
-                'title': note['title'],
-                'content': note['content'] or '',
-                'html': f'<p>{note["content"] or ""}</p>'
-            })
-        elif format_type == 'html':
-            html_content = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>{note['title']}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; line-height: 1.6; }}
-        h1 {{ margin-bottom: 20px; }}
-    </style>
-</head>
-<body>
-    <h1>{note['title']}</h1>
-    <p>{note['content'] or ''}</p>
-</body>
-</html>
-            """
-            return html_content, 200, {'Content-Type': 'text/html'}
+        content_data = None
+    if not isinstance(content_data, dict):
+        text = content or ''
+        return text, f'<p>{html.escape(text)}</p>'
+    return content_data.get('text', ''), content_data.get('html', '')
+
+def render_note(note, format_type):
+    title = note['title'] or 'Untitled Note'
+    text, body = note_text_and_html(note['content'])
+    if format_type == 'html':
+        return EXPORT_HTML_TEMPLATE.format(title=html.escape(title), body=body)
+    if format_type == 'markdown':
+        return f'# {title}\n\n{text.rstrip()}\n'
+    return f"{title}\n{'=' * len(title)}\n\n{text.rstrip()}\n"
+
+def export_filename(note, format_type):
+    slug = re.sub(r'[^\w\- ]+', '', note['title'] or '').strip()[:80] or 'note'
+    return f'{slug}.{EXPORT_FORMATS[format_type][0]}'
+
+# Export jobs
+# Exports are rendered on a small background pool and recorded in
+# export_jobs; clients poll the job and download the finished file instead
+# of holding a request open. Rendered notes are cached in EXPORT_DIR keyed
+# on note id, updated_at and format, so re-exporting a notebook only
+# renders the notes that changed since the last export. Every job owns its
+# file until EXPORT_JOB_TTL; cached renders are swept once their note is
+# gone or they haven't been used for EXPORT_JOB_TIMEOUT.
+EXPORT_DIR = os.environ.get('NOTEBUDDY_EXPORT_DIR', os.path.join(app.root_path, 'exports'))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', '2'))
+EXPORT_JOB_TTL = int(os.environ.get('EXPORT_JOB_TTL', str(24 * 3600)))
+EXPORT_JOB_TIMEOUT = int(os.environ.get('EXPORT_JOB_TIMEOUT', '3600'))
+EXPORT_FETCH_SIZE = 200
+EXPORT_RENDER_GRACE_SECONDS = 60  # a render just handed out isn't swept under a running job
+
+_export_lock = threading.Lock()
+_export_executor = None
+_export_pid = None
+
+def export_executor():
+    global _export_executor, _export_pid
+    with _export_lock:
+        # Worker threads don't survive a fork
+        if _export_pid != os.getpid():
+            _export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+            _export_pid = os.getpid()
+        return _export_executor
+
+def write_atomically(path, write):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def note_artifact(note, format_type):
+    directory = os.path.join(EXPORT_DIR, 'notes')
+    prefix = f"note-{note['id']}-"
+    suffix = f'.{format_type}.{EXPORT_FORMATS[format_type][0]}'
+    # updated_at has one-second resolution, so the title and content are hashed in too
+    version = hashlib.sha1(f"{note['updated_at']}\0{note['title']}\0{note['content']}".encode()).hexdigest()[:12]
+    path = os.path.join(directory, prefix + version + suffix)
+    if os.path.exists(path):
+        # The modification time records the last use for sweep_note_artifacts
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass  # swept meanwhile; render it again
+    
+    os.makedirs(directory, exist_ok=True)
+    rendered = render_note(note, format_type).encode()
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(rendered)
+    write_atomically(path, write)
+    return path
+
+def link_job_artifact(job_id, path, format_type):
+    # The job gets its own name for the cached render, so sweeping the
+    # cache doesn't break its download link
+    job_path = os.path.join(EXPORT_DIR, 'jobs', f'note-{job_id}.{EXPORT_FORMATS[format_type][0]}')
+    os.makedirs(os.path.dirname(job_path), exist_ok=True)
+    try:
+        os.link(path, job_path)
+    except OSError:
+        shutil.copyfile(path, job_path)
+    return job_path
+
+def sweep_note_artifacts(conn):
+    directory = os.path.join(EXPORT_DIR, 'notes')
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    note_ids = {row[0] for row in conn.execute('SELECT id FROM notes')}
+    now = time.time()
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            idle = now - os.path.getmtime(path)
+            note_id = int(name.split('-')[1])
+        except (FileNotFoundError, IndexError, ValueError):
+            continue
+        if idle > EXPORT_RENDER_GRACE_SECONDS and (note_id not in note_ids or idle > EXPORT_JOB_TIMEOUT):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def build_notebook(conn, job_id, user_id, format_type):
+    total = conn.execute('SELECT COUNT(*) FROM notes WHERE user_id = ?', (user_id,)).fetchone()[0]
+    conn.execute('UPDATE export_jobs SET total = ? WHERE id = ?', (total, job_id))
+    conn.commit()
+    
+    path = os.path.join(EXPORT_DIR, 'jobs', f'notebook-{job_id}.zip')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    
+    def write(tmp_path):
+        done = 0
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            # A separate connection keeps the cursor open across progress commits
+            reader = connect_db()
+            try:
+                cursor = reader.execute('SELECT id, title, content, updated_at FROM notes WHERE user_id = ? ORDER BY id',
+                                        (user_id,))
+                while True:
+                    notes = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                    if not notes:
+                        break
+                    for note in notes:
+                        bundle.write(note_artifact(note, format_type),
+                                     f"{note['id']:05d}-{export_filename(note, format_type)}")
+                    done += len(notes)
+                    conn.execute('UPDATE export_jobs SET progress = ? WHERE id = ?', (done, job_id))
+                    conn.commit()
+            finally:
+                reader.close()
+    write_atomically(path, write)
+    return path, 'notes.zip'
+
+def run_export_job(job_id, user_id, note_id, format_type):
+    conn = get_db_connection()
+    conn.execute("UPDATE export_jobs SET status = 'running' WHERE id = ?", (job_id,))
+    conn.commit()
+    try:
+        if note_id is None:
+            artifact, filename = build_notebook(conn, job_id, user_id, format_type)
+        else:
+            note = conn.execute('SELECT id, title, content, updated_at FROM notes WHERE id = ? AND user_id = ?',
+                                (note_id, user_id)).fetchone()
+            if not note:
+                raise LookupError('Note not found')
+            artifact = link_job_artifact(job_id, note_artifact(note, format_type), format_type)
+            filename = export_filename(note, format_type)
+    except Exception as e:
+        conn.rollback()
+        conn.execute("UPDATE export_jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                     (str(e), job_id))
+        conn.commit()
+        app.logger.exception('Export job %s failed', job_id)
+        return
+    conn.execute('''
+        UPDATE export_jobs SET status = 'done', artifact = ?, filename = ?, progress = COALESCE(total, 1),
+            finished_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (artifact, filename, job_id))
+    conn.commit()
+
+def expire_export_jobs(conn):
+    expired = conn.execute("SELECT id, artifact FROM export_jobs WHERE created_at < datetime('now', ?)",
+                           (f'-{EXPORT_JOB_TTL} seconds',)).fetchall()
+    for job in expired:
+        if job['artifact'] and os.path.exists(job['artifact']):
+            os.remove(job['artifact'])
+    conn.executemany('DELETE FROM export_jobs WHERE id = ?', [(job['id'],) for job in expired])
+    sweep_note_artifacts(conn)
+
+def process_alive(pid):
+    if os.name == 'nt':
+        return True  # os.kill would terminate it; the timeout still applies
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def fail_orphaned_export_jobs(conn, user_id):
+    # Jobs live on the executor of the process that queued them. If that
+    # process has exited (a restart, a crashed serve worker) or a job has
+    # been pending for EXPORT_JOB_TIMEOUT, it will never finish.
+    pending = conn.execute('''
+        SELECT id, worker_pid, created_at < datetime('now', ?) AS timed_out FROM export_jobs
+        WHERE user_id = ? AND status IN ('queued', 'running')
+    ''', (f'-{EXPORT_JOB_TIMEOUT} seconds', user_id)).fetchall()
+    orphaned = [(job['id'],) for job in pending
+                if job['timed_out'] or (job['worker_pid'] and not process_alive(job['worker_pid']))]
+    if orphaned:
+        conn.executemany('''
+            UPDATE export_jobs SET status = 'failed', error = 'Export was interrupted', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status IN ('queued', 'running')
+        ''', orphaned)
+        conn.commit()
+
+def export_job_json(job):
+    return {
+        'id': job['id'],
+        'note_id': job['note_id'],
+        'format': job['format'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'total': job['total'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'download_url': url_for('download_export', job_id=job['id']) if job['status'] == 'done' else None
+    }
+
+@app.route('/api/exports', methods=['POST'])
+@login_required
+def create_export():
+    data = request.get_json(silent=True) or {}
+    format_type = data.get('format', 'markdown')
+    note_id = data.get('note_id')  # Omit to export every note as a ZIP
+    
+    if format_type not in EXPORT_FORMATS:
+        return jsonify({'error': f"Format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    user_id = session['user_id']
+    conn = get_db_connection()
+    if note_id is not None and not conn.execute('SELECT 1 FROM notes WHERE id = ? AND user_id = ?',
+                                                (note_id, user_id)).fetchone():
+        return jsonify({'error': 'Note not found'}), 404
+    
+    expire_export_jobs(conn)
+    cursor = conn.execute('INSERT INTO export_jobs (user_id, note_id, format, worker_pid) VALUES (?, ?, ?, ?)',
+                          (user_id, note_id, format_type, os.getpid()))
+    job_id = cursor.lastrowid
+    conn.commit()
+    
+    export_executor().submit(run_export_job, job_id, user_id, note_id, format_type)
+    job = conn.execute('SELECT * FROM export_jobs WHERE id = ?', (job_id,)).fetchone()
+    response = jsonify(export_job_json(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('get_export', job_id=job_id)
+    return response
+
+@app.route('/api/exports/<int:job_id>', methods=['GET'])
+@login_required
+def get_export(job_id):
+    conn = get_db_connection()
+    fail_orphaned_export_jobs(conn, session['user_id'])
+    job = conn.execute('SELECT * FROM export_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    if not job:
+        return jsonify({'error': 'Export not found'}), 404
+    return jsonify(export_job_json(job))
+
+@app.route('/api/exports/<int:job_id>/download', methods=['GET'])
+@login_required
+def download_export(job_id):
+    conn = get_db_connection()
+    job = conn.execute('SELECT * FROM export_jobs WHERE id = ? AND user_id = ?', (job_id, session['user_id'])).fetchone()
+    if not job:
+        return jsonify({'error': 'Export not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': 'Export is not ready', 'status': job['status']}), 409
+    if not os.path.exists(job['artifact']):
+        return jsonify({'error': 'Export has expired'}), 410
+    
+    # send_file streams the file from disk rather than loading it into memory
+    mimetype = 'application/zip' if job['note_id'] is None else EXPORT_FORMATS[job['format']][1]
+    return send_file(job['artifact'], mimetype=mimetype, as_attachment=True, download_name=job['filename'])
+
+# Data export and import
+# A dump is NDJSON: a header line, then one {"type": <table>, ...} record
+# per row, with parents before children. As a ZIP it holds one NDJSON file
+# per table. Rows are read with fetchmany on a dedicated connection inside
+# one read transaction, so the dump is a consistent snapshot and memory
+# stays flat however many rows there are. Derived tables (search indexes,
+# counters, summaries) are rebuilt by triggers on import.
+DUMP_VERSION = 1
+DUMP_FETCH_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+
+DUMP_TABLES = [
+    ('users', 'SELECT u.id, u.username, u.email, r.name AS role, u.created_at FROM users u '
+              'LEFT JOIN roles r ON u.role_id = r.id {where} ORDER BY u.id', 'u.id'),
+    ('todos', 'SELECT id, user_id, title, completed, created_at FROM todos {where} ORDER BY id', 'user_id'),
+    ('notes', 'SELECT id, user_id, title, content, created_at, updated_at FROM notes {where} ORDER BY id', 'user_id'),
+    ('chat_messages', 'SELECT id, user_id, message, response, timestamp FROM chat_messages {where} ORDER BY id', 'user_id'),
+    ('conversations', 'SELECT id, user_id, title, created_at, updated_at FROM conversations {where} ORDER BY id', 'user_id'),
+    ('conversation_messages', 'SELECT conversation_id, user_id, position, sender, content, created_at '
+                              'FROM conversation_messages {where} ORDER BY conversation_id, position', 'user_id')
+]
+
+def dump_batches(user_id=None):
+    # Yields (table, rows) in batches of DUMP_FETCH_SIZE; user_id=None dumps every user
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN')
+        for table, query, owner_column in DUMP_TABLES:
+            if user_id is None:
+                cursor = conn.execute(query.format(where=''))
+            else:
+                cursor = conn.execute(query.format(where=f'WHERE {owner_column} = ?'), (user_id,))
+            while True:
+                rows = cursor.fetchmany(DUMP_FETCH_SIZE)
+                if not rows:
+                    break
+                rows = [dict(row) for row in rows]
+                if table == 'notes':
+                    for row in rows:
+                        row['content'] = json.loads(row['content']) if row['content'] else {}
+                yield table, rows
+        conn.rollback()
+    finally:
+        conn.close()
+
+def dump_header(user_id):
+    return {'type': 'header', 'version': DUMP_VERSION, 'user_id': user_id,
+            'exported_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z'}
+
+def dump_ndjson(user_id=None):
+    yield json.dumps(dump_header(user_id)) + '\n'
+    for table, rows in dump_batches(user_id):
+        yield ''.join(json.dumps({'type': table, **row}) + '\n' for row in rows)
+
+class ChunkBuffer:
+    # Write-only file object for ZipFile; it has no tell(), so ZipFile
+    # writes local headers with data descriptors and never seeks back
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def dump_zip(user_id=None):
+    buffer = ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        bundle.writestr('header.json', json.dumps(dump_header(user_id)))
+        member, member_table = None, None
+        for table, rows in dump_batches(user_id):
+            if table != member_table:
+                if member:
+                    member.close()
+                member = bundle.open(f'{table}.ndjson', 'w', force_zip64=True)
+                member_table = table
+            member.write(''.join(json.dumps(row) + '\n' for row in rows).encode())
+            yield buffer.take()
+        if member:
+            member.close()
+    yield buffer.take()
+
+def iter_ndjson_records(lines):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield json.loads(line)
+
+def iter_zip_records(path_or_file):
+    with zipfile.ZipFile(path_or_file) as bundle:
+        names = set(bundle.namelist())
+        for table, _, _ in DUMP_TABLES:
+            if f'{table}.ndjson' not in names:
+                continue
+            with bundle.open(f'{table}.ndjson') as member:
+                for record in iter_ndjson_records(member):
+                    record['type'] = table
+                    yield record
+
+def import_records(conn, user_id, records):
+    # Everything is imported into user_id in one transaction. Ids are
+    # reassigned; conversations are inserted one at a time to map their old
+    # ids for the messages, every other table goes through executemany.
+    insert_sql = {
+        'todos': 'INSERT INTO todos (user_id, title, completed, created_at) VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))',
+        'notes': '''INSERT INTO notes (user_id, title, content, created_at, updated_at)
+                    VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))''',
+        'chat_messages': '''INSERT INTO chat_messages (user_id, message, response, timestamp)
+                            VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''',
+        'conversation_messages': '''INSERT INTO conversation_messages (conversation_id, user_id, position, sender, content, created_at)
+                                    VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))'''
+    }
+    row_params = {
+        'todos': lambda r: (user_id, r['title'], bool(r.get('completed')), r.get('created_at')),
+        'notes': lambda r: (user_id, r['title'], note_content_json(r.get('content') or ''), r.get('created_at'),
+                            r.get('updated_at')),
+        'chat_messages': lambda r: (user_id, r['message'], r.get('response'), r.get('timestamp')),
+        'conversation_messages': lambda r: (conversation_ids[r['conversation_id']], user_id, r['position'],
+                                            r.get('sender', 'user'), r.get('content', ''), r.get('created_at'))
+    }
+    pending = {table: [] for table in insert_sql}
+    counts = {table: 0 for table in ('todos', 'notes', 'chat_messages', 'conversations', 'conversation_messages')}
+    conversation_ids = {}
+    
+    def flush(table):
+        conn.executemany(insert_sql[table], pending[table])
+        counts[table] += len(pending[table])
+        pending[table] = []
+    
+    for record in records:
+        table = record.get('type')
+        if table == 'conversations':
+            cursor = conn.execute('''
+                INSERT INTO conversations (user_id, title, messages, created_at, updated_at)
+                VALUES (?, ?, '[]', COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))
+            ''', (user_id, record['title'], record.get('created_at'), record.get('updated_at')))
+            conversation_ids[record['id']] = cursor.lastrowid
+            counts['conversations'] += 1
+        elif table == 'conversation_messages' and record['conversation_id'] not in conversation_ids:
+            continue
+        elif table in pending:
+            pending[table].append(row_params[table](record))
+            if len(pending[table]) >= IMPORT_BATCH_SIZE:
+                flush(table)
+    for table in pending:
+        flush(table)
+    return counts
+
+@app.route('/api/export/all', methods=['GET'])
+@login_required
+def export_all():
+    # Admins may pass ?user_id=<id> or ?user_id=all; everyone else gets their own data
+    target = request.args.get('user_id')
+    user_id = session['user_id']
+    if target and target != str(user_id):
+        if not is_admin():
+            return jsonify({'error': 'Access denied'}), 403
+        user_id = None if target == 'all' else request.args.get('user_id', type=int)
+        if target != 'all' and user_id is None:
+            return jsonify({'error': 'user_id must be a number or "all"'}), 400
+    
+    stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    name = f"notebuddy-{'all' if user_id is None else user_id}-{stamp}"
+    if request.args.get('format', 'ndjson') == 'zip':
+        return Response(dump_zip(user_id), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename={name}.zip'})
+    return Response(dump_ndjson(user_id), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename={name}.ndjson'})
+
+@app.route('/api/import/all', methods=['POST'])
+@login_required
+def import_all():
+    # Takes an uploaded dump (NDJSON or ZIP) as `file`, or NDJSON as the raw request body
+    upload = request.files.get('file')
+    if upload:
+        if upload.filename.lower().endswith('.zip'):
+            records = iter_zip_records(upload.stream)
+        else:
+            records = iter_ndjson_records(upload.stream)
+    elif request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        records = iter_ndjson_records(request.stream)
+    else:
+        return jsonify({'error': 'Upload a dump as file, or send NDJSON'}), 400
+    
+    conn = get_db_connection()
+    try:
+        counts = import_records(conn, session['user_id'], records)
+    except (ValueError, KeyError, TypeError, zipfile.BadZipFile) as e:
+        conn.rollback()
+        return jsonify({'error': f'Invalid dump: {e}'}), 400
+    conn.commit()
+    
+    return jsonify({'imported': counts, 'success': True})
+
+@app.cli.command('export-data')
+@click.option('--user', 'username', help='Only export this user (default: everyone).')
+@click.option('--format', 'format_type', type=click.Choice(['ndjson', 'zip']), default='ndjson')
+@click.option('--output', type=click.File('wb'), default='-', help='Output file (default: stdout).')
+def export_data_command(username, format_type, output):
+    """Stream user data as an NDJSON or ZIP dump."""
+    user_id = None
+    if username:
+        conn = connect_db()
+        user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        conn.close()
+        if not user:
+            raise click.ClickException(f'No user named {username}')
+        user_id = user['id']
+    for chunk in (dump_zip(user_id) if format_type == 'zip' else dump_ndjson(user_id)):
+        output.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+
+@app.cli.command('import-data')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='User that receives the imported data.')
+def import_data_command(path, username):
+    """Import an NDJSON or ZIP dump into a user's account."""
+    conn = connect_db()
+    user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+    if not user:
+        raise click.ClickException(f'No user named {username}')
+    try:
+        if zipfile.is_zipfile(path):
+            counts = import_records(conn, user['id'], iter_zip_records(path))
+        else:
+            with open(path, 'rb') as f:
+                counts = import_records(conn, user['id'], iter_ndjson_records(f))
+    except (ValueError, KeyError, TypeError) as e:
+        conn.rollback()
+        raise click.ClickException(f'Invalid dump: {e}')
+    conn.commit()
+    conn.close()
+    print(', '.join(f'{count} {table}' for table, count in counts.items()) + ' imported.')
+
+# File export endpoints
+@app.route('/api/notes/<int:note_id>/export/<format_type>', methods=['GET'])
+@login_required
+@conditional('notes')
+def export_note(note_id, format_type):
+    conn = get_db_connection()
+    note = conn.execute('SELECT * FROM notes WHERE id = ? AND user_id = ?', 
+                       (note_id, session['user_id'])).fetchone()
+    
+    if not note:
+        return jsonify({'error': 'Note not found'}), 404
+    
+    if format_type == 'pdf':
+        # PDFs are generated in the browser from the text content
+        text, body = note_text_and_html(note['content'])
+        return jsonify({
+            'title': note['title'],
+            'content': text,
+            'html': body
+        })
+    
+    if format_type in EXPORT_FORMATS:
+        # One note renders quickly, so it is served straight from the artifact cache
+        return send_file(note_artifact(note, format_type), mimetype=EXPORT_FORMATS[format_type][1],
+                         download_name=export_filename(note, format_type))
     
     return jsonify({'error': 'Invalid format'}), 400
 
+# Note retrieval
+# "Ask my notes" chats are prompted with the pieces of the user's notes and
+# todos that best match the message. Notes are split into chunks of about
+# RAG_CHUNK_CHARS and embedded with Ollama's embeddings endpoint
+# (RAG_EMBED_MODEL) or, when Ollama can't embed, a built-in hashing
+# embedder. The vectors live in a float32 file per user in VECTOR_INDEX_DIR
+# and vector_chunks maps each file row to its chunk. A user's index is built
+# on their first "ask my notes" chat and then follows change_events, so every
+# write path keeps it current and only chunks whose text changed are
+# embedded again. Replaced chunks leave dead rows in the file until it is
+# compacted into a new generation. In auto mode a hashing index is a
+# fallback, rebuilt with Ollama once Ollama can embed again.
+RAG_EMBEDDER = os.environ.get('RAG_EMBEDDER', 'auto')  # auto, ollama or hashing
+RAG_EMBED_MODEL = os.environ.get('RAG_EMBED_MODEL', 'nomic-embed-text')
+RAG_EMBED_RETRY_SECONDS = int(os.environ.get('RAG_EMBED_RETRY_SECONDS', '300'))
+RAG_HASHING_DIMS = 512
+RAG_CHUNK_CHARS = int(os.environ.get('RAG_CHUNK_CHARS', '800'))
+RAG_TOP_K = int(os.environ.get('RAG_TOP_K', '6'))
+RAG_CONTEXT_TOKENS = int(os.environ.get('RAG_CONTEXT_TOKENS', '768'))
+RAG_INLINE_ITEMS = 200  # bigger catch-ups run in the background while the chat uses the index as it is
+RAG_SYNC_BATCH = 100
+RAG_EMBED_BATCH = 32
+RAG_CACHED_USERS = 32
+VECTOR_INDEX_DIR = os.environ.get('NOTEBUDDY_VECTOR_DIR', os.path.join(app.root_path, 'vector_index'))
+RAG_WORDS = re.compile(r'\w+')
+
+# Writes under these paths can change notes or todos
+INDEXED_PATHS = ('/api/notes', '/api/todos', '/api/import')
+
+class EmbeddingUnavailable(Exception):
+    pass
+
+def hashing_embed(texts, dims):
+    # Signed feature hashing of words and word pairs, with log-scaled counts
+    vectors = numpy.zeros((len(texts), dims), dtype=numpy.float32)
+    for i, text in enumerate(texts):
+        words = RAG_WORDS.findall(text.lower())
+        features = Counter(words + [f'{a} {b}' for a, b in zip(words, words[1:])])
+        for feature, count in features.items():
+            h = zlib.crc32(feature.encode())
+            vectors[i, h % dims] += (1 + math.log(count)) * (1 if h & 0x80000000 else -1)
+    return vectors
+
+def ollama_embed(texts):
+    try:
+        with ollama_client.post('/api/embed', {'model': RAG_EMBED_MODEL, 'input': texts}) as response:
+            if response.status_code == 200:
+                return numpy.array(response.json()['embeddings'], dtype=numpy.float32)
+            if response.status_code != 404:
+                raise EmbeddingUnavailable(f'Ollama returned {response.status_code}')
+        # Ollama before 0.2 only embeds one prompt per request
+        vectors = []
+        for text in texts:
+            with ollama_client.post('/api/embeddings', {'model': RAG_EMBED_MODEL, 'prompt': text}) as response:
+                if response.status_code != 200:
+                    raise EmbeddingUnavailable(f'Ollama returned {response.status_code}')
+                vectors.append(response.json()['embedding'])
+        return numpy.array(vectors, dtype=numpy.float32)
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        raise EmbeddingUnavailable(str(e))
+
+_embed_failed_at = None
+
+def ollama_embed_dims():
+    # None when Ollama can't embed. A failure is remembered for
+    # RAG_EMBED_RETRY_SECONDS so auto mode doesn't ask again on every chat.
+    global _embed_failed_at
+    if _embed_failed_at is not None and time.monotonic() - _embed_failed_at < RAG_EMBED_RETRY_SECONDS:
+        return None
+    try:
+        dims = ollama_embed(['dimensions'])[0].size
+    except EmbeddingUnavailable:
+        _embed_failed_at = time.monotonic()
+        return None
+    _embed_failed_at = None
+    return dims
+
+def configured_embedder():
+    # Returns (embedder, dims) for a new index
+    if RAG_EMBEDDER == 'ollama':
+        return f'ollama:{RAG_EMBED_MODEL}', ollama_embed(['dimensions'])[0].size
+    dims = None if RAG_EMBEDDER == 'hashing' else ollama_embed_dims()
+    if dims:
+        return f'ollama:{RAG_EMBED_MODEL}', dims
+    return f'hashing:{RAG_HASHING_DIMS}', RAG_HASHING_DIMS
+
+def embedder_current(embedder):
+    # An Ollama index is kept in auto mode even while Ollama is down
+    if embedder.startswith('ollama:'):
+        return RAG_EMBEDDER != 'hashing' and embedder == f'ollama:{RAG_EMBED_MODEL}'
+    if embedder != f'hashing:{RAG_HASHING_DIMS}' or RAG_EMBEDDER == 'ollama':
+        return False
+    # In auto mode a hashing index is the fallback
+    return RAG_EMBEDDER == 'hashing' or not ollama_embed_dims()
+
+def embed(index, texts):
+    # Unit-length rows, so a dot product is the cosine similarity
+    if not texts:
+        return numpy.zeros((0, index['dims']), dtype=numpy.float32)
+    batches = []
+    for start in range(0, len(texts), RAG_EMBED_BATCH):
+        batch = texts[start:start + RAG_EMBED_BATCH]
+        if index['embedder'].startswith('ollama:'):
+            batches.append(ollama_embed(batch))
+        else:
+            batches.append(hashing_embed(batch, index['dims']))
+    vectors = numpy.vstack(batches)
+    if vectors.shape[1] != index['dims']:
+        raise EmbeddingUnavailable(f"{index['embedder']} returned {vectors.shape[1]} dimensions, expected {index['dims']}")
+    return vectors / numpy.maximum(numpy.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+def split_text(text):
+    # Paragraphs packed into pieces of at most RAG_CHUNK_CHARS; longer
+    # paragraphs are cut at a space
+    pieces = []
+    current = ''
+    for paragraph in text.split('\n'):
+        paragraph = paragraph.strip()
+        while len(paragraph) > RAG_CHUNK_CHARS:
+            cut = paragraph.rfind(' ', 0, RAG_CHUNK_CHARS)
+            if cut <= 0:
+                cut = RAG_CHUNK_CHARS
+            if current:
+                pieces.append(current)
+                current = ''
+            pieces.append(paragraph[:cut])
+            paragraph = paragraph[cut:].strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 1 > RAG_CHUNK_CHARS:
+            pieces.append(current)
+            current = ''
+        current = f'{current}\n{paragraph}' if current else paragraph
+    if current:
+        pieces.append(current)
+    return pieces
+
+def item_chunks(conn, user_id, source, item_id):
+    # Chunk texts for a note or todo; none once it's deleted
+    if source == 'notes':
+        note = conn.execute('SELECT title, content FROM notes WHERE id = ? AND user_id = ?',
+                            (item_id, user_id)).fetchone()
+        if not note:
+            return []
+        text, _ = note_text_and_html(note['content'])
+        # The title goes with every chunk so a match can be placed
+        return [f"{note['title']}\n{piece}" for piece in split_text(text)] or [note['title']]
+    todo = conn.execute('SELECT title, completed FROM todos WHERE id = ? AND user_id = ?',
+                        (item_id, user_id)).fetchone()
+    if not todo:
+        return []
+    return [f"Todo ({'done' if todo['completed'] else 'open'}): {todo['title']}"]
+
+def chunk_digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def vector_path(user_id, generation):
+    return os.path.join(VECTOR_INDEX_DIR, f'{user_id}.{generation}.f32')
+
+def remove_vector_files(user_id, keep=None):
+    prefix = f'{user_id}.'
+    if not os.path.isdir(VECTOR_INDEX_DIR):
+        return
+    for name in os.listdir(VECTOR_INDEX_DIR):
+        if name.startswith(prefix) and name.endswith('.f32') and name != keep:
+            os.remove(os.path.join(VECTOR_INDEX_DIR, name))
+
+def sync_items(conn, index, items):
+    # Embeds the items' new chunk texts outside the write transaction, then
+    # swaps their chunk rows and appends the vectors inside it. Returns False
+    # when the index was compacted or reset meanwhile.
+    user_id = index['user_id']
+    wanted = {item: item_chunks(conn, user_id, *item) for item in items}
+    known = set()
+    for source, item_id in items:
+        known.update(row['digest'] for row in conn.execute(
+            'SELECT digest FROM vector_chunks WHERE user_id = ? AND source = ? AND item_id = ?',
+            (user_id, source, item_id)))
+    pending = {}
+    for texts in wanted.values():
+        for text in texts:
+            digest = chunk_digest(text)
+            if digest not in known:
+                pending[digest] = text
+    vectors = dict(zip(pending, embed(index, list(pending.values()))))
+    
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = conn.execute('SELECT generation, rows FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone()
+        if not current or current['generation'] != index['generation']:
+            conn.rollback()
+            return False
+        next_row = current['rows']
+        appended = []
+        dead = []
+        for (source, item_id), texts in wanted.items():
+            existing = {row['digest']: row['row'] for row in conn.execute(
+                'SELECT row, digest FROM vector_chunks WHERE user_id = ? AND source = ? AND item_id = ?',
+                (user_id, source, item_id))}
+            kept = set()
+            for text in texts:
+                digest = chunk_digest(text)
+                if digest in existing:
+                    kept.add(digest)
+                elif digest in vectors:
+                    conn.execute('INSERT INTO vector_chunks (user_id, row, source, item_id, digest, text) VALUES (?, ?, ?, ?, ?, ?)',
+                                 (user_id, next_row, source, item_id, digest, text))
+                    existing[digest] = next_row
+                    kept.add(digest)
+                    appended.append(vectors[digest])
+                    next_row += 1
+            dead.extend((user_id, row) for digest, row in existing.items() if digest not in kept)
+        conn.executemany('DELETE FROM vector_chunks WHERE user_id = ? AND row = ?', dead)
+        if appended:
+            os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+            path = vector_path(user_id, index['generation'])
+            # Written at the committed row count, over whatever a crashed writer left behind
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                f.seek(current['rows'] * index['dims'] * 4)
+                numpy.asarray(appended, dtype=numpy.float32).tofile(f)
+                f.truncate()
+        conn.execute('UPDATE vector_indexes SET rows = ? WHERE user_id = ?', (next_row, user_id))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
+
+def compact_index(conn, index):
+    # Copies the live rows into the next generation's file and renumbers them
+    user_id = index['user_id']
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        index = conn.execute('SELECT * FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone()
+        live = [row['row'] for row in conn.execute(
+            'SELECT row FROM vector_chunks WHERE user_id = ? ORDER BY row', (user_id,))]
+        matrix = numpy.fromfile(vector_path(user_id, index['generation']), dtype=numpy.float32,
+                                count=index['rows'] * index['dims']).reshape(-1, index['dims'])
+        generation = index['generation'] + 1
+        write_atomically(vector_path(user_id, generation), lambda path: matrix[live].tofile(path))
+        # Ascending order never moves a row onto one that is still in use
+        conn.executemany('UPDATE vector_chunks SET row = ? WHERE user_id = ? AND row = ?',
+                         [(new, user_id, old) for new, old in enumerate(live) if new != old])
+        conn.execute('UPDATE vector_indexes SET generation = ?, rows = ? WHERE user_id = ?',
+                     (generation, len(live), user_id))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    remove_vector_files(user_id, keep=os.path.basename(vector_path(user_id, generation)))
+
+def reset_index(conn, user_id, embedder, dims):
+    conn.execute('DELETE FROM vector_chunks WHERE user_id = ?', (user_id,))
+    conn.execute('''
+        UPDATE vector_indexes SET embedder = ?, dims = ?, generation = generation + 1, rows = 0, last_seq = NULL
+        WHERE user_id = ?
+    ''', (embedder, dims, user_id))
+    conn.commit()
+    remove_vector_files(user_id)
+
+_index_guard = threading.Lock()
+_index_locks = {}
+_index_pending = set()
+_index_executor = None
+_index_pid = None
+
+def index_lock(user_id):
+    with _index_guard:
+        return _index_locks.setdefault(user_id, threading.Lock())
+
+def update_index(user_id, max_items=None):
+    # Applies the user's note and todo changes since the index was last
+    # updated. Returns False without doing anything when more than max_items
+    # items changed.
+    with index_lock(user_id):
+        conn = get_db_connection()
+        index = conn.execute('SELECT * FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone()
+        if not index:
+            return True
+        if not embedder_current(index['embedder']):
+            reset_index(conn, user_id, *configured_embedder())
+            index = conn.execute('SELECT * FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone()
+        
+        target = conn.execute('SELECT MAX(seq) FROM change_events').fetchone()[0] or 0
+        if index['last_seq'] is None or index['last_seq'] + 1 < change_floor(conn):
+            # Nothing to catch up from: index everything, and drop whatever no longer exists
+            items = {(row['source'], row['item_id']) for row in conn.execute(
+                'SELECT DISTINCT source, item_id FROM vector_chunks WHERE user_id = ?', (user_id,))}
+            items.update(('notes', row[0]) for row in conn.execute('SELECT id FROM notes WHERE user_id = ?', (user_id,)))
+            items.update(('todos', row[0]) for row in conn.execute('SELECT id FROM todos WHERE user_id = ?', (user_id,)))
+        else:
+            items = conn.execute('''
+                SELECT DISTINCT collection, item_id FROM change_events
+                WHERE user_id = ? AND seq > ? AND seq <= ? AND collection IN ('notes', 'todos')
+            ''', (user_id, index['last_seq'], target)).fetchall()
+        items = sorted((source, item_id) for source, item_id in items)
+        if max_items is not None and len(items) > max_items:
+            return False
+        
+        for start in range(0, len(items), RAG_SYNC_BATCH):
+            if not sync_items(conn, index, items[start:start + RAG_SYNC_BATCH]):
+                return True
+        conn.execute('UPDATE vector_indexes SET last_seq = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?',
+                     (target, user_id))
+        conn.commit()
+        
+        index = conn.execute('SELECT * FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone()
+        live = conn.execute('SELECT COUNT(*) FROM vector_chunks WHERE user_id = ?', (user_id,)).fetchone()[0]
+        if index['rows'] - live > max(live, 1000):
+            compact_index(conn, index)
+        return True
+
+def index_executor():
+    global _index_executor, _index_pid
+    with _index_guard:
+        # Worker threads don't survive a fork
+        if _index_pid != os.getpid():
+            _index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vector-index')
+            _index_pending.clear()
+            _index_pid = os.getpid()
+        return _index_executor
+
+def run_index_update(user_id):
+    with _index_guard:
+        _index_pending.discard(user_id)
+    try:
+        update_index(user_id)
+    except EmbeddingUnavailable as e:
+        app.logger.warning('Could not update the notes index for user %s: %s', user_id, e)
+    except Exception:
+        app.logger.exception('Notes index update failed for user %s', user_id)
+
+def schedule_index_update(user_id):
+    executor = index_executor()
+    with _index_guard:
+        # Changes made while an update runs get one more run after it
+        if user_id in _index_pending:
+            return
+        _index_pending.add(user_id)
+    executor.submit(run_index_update, user_id)
+
+@app.after_request
+def update_notes_index(response):
+    if (numpy is not None and request.method in ('POST', 'PUT', 'DELETE') and response.status_code < 400
+            and request.path.startswith(INDEXED_PATHS) and 'user_id' in session):
+        user_id = session['user_id']
+        if get_db_connection().execute('SELECT 1 FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone():
+            schedule_index_update(user_id)
+    return response
+
+# Vector files are read once per process and then only their new rows
+_vector_cache = OrderedDict()
+_vector_cache_lock = threading.Lock()
+
+def load_vectors(index):
+    user_id, generation, rows, dims = index['user_id'], index['generation'], index['rows'], index['dims']
+    with _vector_cache_lock:
+        cached = _vector_cache.get(user_id)
+        if cached and cached[0] == generation and len(cached[1]) == rows:
+            _vector_cache.move_to_end(user_id)
+            return cached[1]
+    path = vector_path(user_id, generation)
+    if not rows:
+        matrix = numpy.zeros((0, dims), dtype=numpy.float32)
+    elif cached and cached[0] == generation and len(cached[1]) < rows:
+        have = len(cached[1])
+        tail = numpy.fromfile(path, dtype=numpy.float32, count=(rows - have) * dims, offset=have * dims * 4)
+        matrix = numpy.vstack([cached[1], tail.reshape(-1, dims)])
+    else:
+        matrix = numpy.fromfile(path, dtype=numpy.float32, count=rows * dims).reshape(-1, dims)
+    with _vector_cache_lock:
+        _vector_cache[user_id] = (generation, matrix)
+        _vector_cache.move_to_end(user_id)
+        while len(_vector_cache) > RAG_CACHED_USERS:
+            _vector_cache.popitem(last=False)
+    return matrix
+
+def retrieve_chunks(user_id, query):
+    # Best matching chunks, most similar first, within RAG_CONTEXT_TOKENS
+    conn = get_db_connection()
+    if not conn.execute('SELECT 1 FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone():
+        embedder, dims = configured_embedder()
+        conn.execute('INSERT OR IGNORE INTO vector_indexes (user_id, embedder, dims) VALUES (?, ?, ?)',
+                     (user_id, embedder, dims))
+        conn.commit()
+    if not update_index(user_id, max_items=RAG_INLINE_ITEMS):
+        schedule_index_update(user_id)
+    
+    index = conn.execute('SELECT * FROM vector_indexes WHERE user_id = ?', (user_id,)).fetchone()
+    query_vector = embed(index, [query])[0]
+    started = time.perf_counter()
+    matrix = load_vectors(index)
+    if not len(matrix):
+        return []
+    scores = matrix @ query_vector
+    # Extra candidates make up for rows of replaced chunks
+    count = min(len(scores), RAG_TOP_K * 4)
+    candidates = numpy.argpartition(-scores, count - 1)[:count]
+    candidates = candidates[numpy.argsort(-scores[candidates])].tolist()
+    placeholders = ','.join('?' * len(candidates))
+    chunks = {row['row']: row for row in conn.execute(
+        f'SELECT row, source, item_id, text FROM vector_chunks WHERE user_id = ? AND row IN ({placeholders})',
+        [user_id] + candidates)}
+    
+    budget = RAG_CONTEXT_TOKENS * CHARS_PER_TOKEN
+    picked = []
+    for row in candidates:
+        chunk = chunks.get(row)
+        if chunk is None or len(chunk['text']) > budget:
+            continue
+        picked.append(chunk)
+        budget -= len(chunk['text'])
+        if len(picked) == RAG_TOP_K:
+            break
+    metrics.observe('rag_search_seconds', time.perf_counter() - started)
+    return picked
+
+def chunk_sources(user_id, chunks):
+    # The notes and todos an answer drew on, for the client to link to
+    conn = get_db_connection()
+    sources = []
+    for source, item_id in dict.fromkeys((chunk['source'], chunk['item_id']) for chunk in chunks):
+        row = conn.execute(f'SELECT title FROM {source} WHERE id = ? AND user_id = ?', (item_id, user_id)).fetchone()
+        if row:
+            sources.append({'type': source[:-1], 'id': item_id, 'title': row['title']})
+    return sources
+
+def notes_prompt(message, chunks):
+    if not chunks:
+        return message
+    excerpts = '\n\n'.join(f'[{number}] {chunk["text"]}' for number, chunk in enumerate(chunks, 1))
+    return ("Answer using these excerpts from my notes and todos where they are relevant, "
+            "and say so if they don't cover the question.\n\n"
+            f"{excerpts}\n\nQuestion: {message}")
+
+def with_notes(generate, user_id, sources, message, *args):
+    # Runs on the gateway worker ahead of generate; sources is filled in
+    # for the response. Without an index the chat goes ahead unaided.
+    try:
+        chunks = retrieve_chunks(user_id, message)
+    except (EmbeddingUnavailable, OSError) as e:
+        # OSError: the vector file was compacted away mid-read
+        app.logger.warning('Notes search unavailable: %s', e)
+        chunks = []
+    sources.extend(chunk_sources(user_id, chunks))
+    return generate(notes_prompt(message, chunks), *args)
+
+# Serving
+# `flask --app app serve` runs a pre-fork server: the parent applies pending
+# migrations, opens the listening socket and forks WORKERS processes that
+# accept on it, each handling requests on a fixed pool of THREADS threads.
+# A worker only accepts a connection when it has a free thread, so busy
+# workers leave new connections to idle ones. Change streams and chats move
+# to separate budgets of CHANGE_STREAMS_PER_WORKER and CHAT_REQUESTS_PER_WORKER
+# threads once they start, so open browser tabs and slow generations can't
+# take every request thread. On SIGTERM or SIGINT workers
+# stop accepting, close change streams (EventSource reconnects to another
+# worker), and give in-flight requests, chat streams included, up to
+# SHUTDOWN_GRACE_SECONDS to finish. Workers that die are replaced.
+SHUTDOWN_GRACE_SECONDS = float(os.environ.get('SHUTDOWN_GRACE_SECONDS', '30'))
+READYZ_REQUIRE_OLLAMA = os.environ.get('READYZ_REQUIRE_OLLAMA', '0') == '1'
+READYZ_OLLAMA_TIMEOUT = float(os.environ.get('READYZ_OLLAMA_TIMEOUT', '2'))
+
+shutting_down = threading.Event()
+request_slot = threading.local()
+
+def leave_request_slot():
+    # Gives this thread's request slot back so the worker can accept another connection
+    release = getattr(request_slot, 'release', None)
+    request_slot.release = None
+    if release is not None:
+        release()
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Ready when the schema is current, and Ollama answers if READYZ_REQUIRE_OLLAMA is set
+    checks = {'database': False, 'ollama': bool(ollama_client.reachable(READYZ_OLLAMA_TIMEOUT))}
+    try:
+        row = get_db_connection().execute('SELECT MAX(version) FROM schema_version').fetchone()
+        checks['database'] = row[0] == max(version for version, _, _ in MIGRATIONS)
+    except sqlite3.Error:
+        pass
+    if shutting_down.is_set():
+        status = 'draining'
+    elif checks['database'] and (checks['ollama'] or not READYZ_REQUIRE_OLLAMA):
+        status = 'ready'
+    else:
+        status = 'unavailable'
+    return jsonify({'status': status, **checks}), 200 if status == 'ready' else 503
+
+class ServeRequestHandler(WSGIRequestHandler):
+    # One request per connection, so an idle keep-alive client can't hold a thread
+    protocol_version = 'HTTP/1.0'
+    timeout = 60
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, listener, threads):
+        host, port = listener.getsockname()[:2]
+        super().__init__(host, port, app, handler=ServeRequestHandler, fd=listener.fileno())
+        self.pool = ThreadPoolExecutor(max_workers=threads + CHANGE_STREAMS_PER_WORKER + CHAT_REQUESTS_PER_WORKER,
+                                       thread_name_prefix='http')
+        self.slots = threading.BoundedSemaphore(threads)
+        self.in_flight = 0
+        self.idle = threading.Condition()
+
+    def get_request(self):
+        # Don't accept until a thread can take the connection
+        self.slots.acquire()
+        try:
+            return super().get_request()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def process_request(self, request, client_address):
+        with self.idle:
+            self.in_flight += 1
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        request_slot.release = self.slots.release
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            leave_request_slot()
+            with self.idle:
+                self.in_flight -= 1
+                self.idle.notify_all()
+
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.idle:
+            while self.in_flight and time.monotonic() < deadline:
+                self.idle.wait(deadline - time.monotonic())
+            return self.in_flight
+
+def run_worker(listener, threads):
+    # The server accepts on its own duplicate of the socket, closed when it stops
+    server = PooledWSGIServer(listener, threads)
+    listener.close()
+
+    def stop(signum, frame):
+        if shutting_down.is_set():
+            return
+        shutting_down.set()
+        with change_notifier:
+            change_notifier.notify_all()
+        # shutdown() waits for serve_forever(), which this handler interrupted
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    remaining = server.drain(SHUTDOWN_GRACE_SECONDS)
+    if remaining:
+        app.logger.warning('Worker %d exiting with %d requests still running', os.getpid(), remaining)
+    if _hash_executor is not None and _hash_pid == os.getpid():
+        _hash_executor.shutdown(cancel_futures=True)
+
+def fork_worker(listener, threads):
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        run_worker(listener, threads)
+    except BaseException:
+        app.logger.exception('Worker %d crashed', os.getpid())
+        status = 1
+    finally:
+        # Skip the parent's atexit handlers and buffered output
+        os._exit(status)
+
+@app.cli.command('serve', with_appcontext=False)
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=8000, show_default=True)
+@click.option('--workers', type=int, envvar='WEB_WORKERS', default=lambda: os.cpu_count() or 1,
+              help='Worker processes (default: one per CPU).')
+@click.option('--threads', type=int, envvar='WEB_THREADS', default=16, show_default=True,
+              help='Request threads per worker.')
+def serve_command(host, port, workers, threads):
+    """Serve the app with pre-forked worker processes."""
+    if not hasattr(os, 'fork'):
+        raise click.ClickException('serve needs fork(); use `python app.py` on this platform')
+    init_db()
+    share_hash_budget(workers)
+    try:
+        listener = socket.create_server((host, port), backlog=1024)
+    except OSError as e:
+        raise click.ClickException(f'Cannot listen on {host}:{port}: {e.strerror}')
+    # Non-blocking, so workers that lose the race for a connection go back to waiting
+    listener.setblocking(False)
+    children = {fork_worker(listener, threads) for _ in range(workers)}
+    print(f'Serving on http://{host}:{port} with {workers} workers x {threads} threads (pid {os.getpid()})')
+
+    deadline = None
+
+    def stop(signum, frame):
+        nonlocal deadline
+        if deadline is None:
+            deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS + 5
+            # New connections are refused once the workers close their copies too
+            listener.close()
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            if deadline is not None and time.monotonic() > deadline:
+                for pid in children:
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.2)
+            continue
+        children.discard(pid)
+        if deadline is None:
+            app.logger.warning('Worker %d exited with status %d, starting a new one', pid, os.waitstatus_to_exitcode(status))
+            time.sleep(1)
+            children.add(fork_worker(listener, threads))
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
@@ -0,0 +1,114 @@
+# python -m benchmark: seed a throwaway database, start the Ollama stub,
+# run the scenarios and print/save the results.
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark.stub import OllamaStub
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Benchmark the NoteBuddy API.')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--notes', type=int, default=200, help='notes per user')
+    parser.add_argument('--todos', type=int, default=100, help='todos per user')
+    parser.add_argument('--conversations', type=int, default=20, help='conversations per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per conversation')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios', help='comma-separated subset of scenarios (default: all)')
+    parser.add_argument('--transport', choices=['client', 'http'], default='client',
+                        help="Flask test client in-process, or a local threaded HTTP server")
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='stub prompt evaluation time in seconds')
+    parser.add_argument('--token-delay', type=float, default=0.005, help='stub seconds per generated token')
+    parser.add_argument('--tokens', type=int, default=50, help='stub tokens per reply')
+    parser.add_argument('--db', help='database to use; an existing file is reused without seeding')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against results saved earlier with --output')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed p95/throughput regression (0.10 = 10%%)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='notebuddy-bench-')
+    database = args.db or os.path.join(workdir, 'bench.db')
+    reuse = os.path.exists(database)
+
+    stub = OllamaStub(args.llm_latency, args.token_delay, args.tokens).start()
+    # app reads its settings at import time
+    os.environ['NOTEBUDDY_DB'] = database
+    os.environ['NOTEBUDDY_EXPORT_DIR'] = os.path.join(workdir, 'exports')
+    os.environ['NOTEBUDDY_VECTOR_DIR'] = os.path.join(workdir, 'vector_index')
+    os.environ['OLLAMA_URL'] = stub.url
+    os.environ.pop('OLLAMA_URLS', None)
+    os.environ.setdefault('LLM_MAX_QUEUE_PER_USER', str(max(args.concurrency, 4)))
+    os.environ.setdefault('LLM_MAX_QUEUE', str(max(args.concurrency * 4, 32)))
+    # Every scenario logs the seeded users in again, all from the same address
+    os.environ.setdefault('LOGIN_IP_BURST', '1000000')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as notebuddy
+    from benchmark import runner
+    from benchmark.seed import seed_database
+
+    conn = notebuddy.connect_db()
+    notebuddy.migrate(conn)
+    if reuse:
+        usernames = [row[0] for row in conn.execute("SELECT username FROM users WHERE username LIKE 'bench%'")]
+        print(f'Reusing {database} ({len(usernames)} benchmark users)', file=sys.stderr)
+    else:
+        started = time.perf_counter()
+        usernames = seed_database(conn, args.users, args.notes, args.todos, args.conversations, args.messages, args.seed)
+        print(f'Seeded {database} in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+    conn.close()
+    if not usernames:
+        sys.exit('No benchmark users in the database')
+
+    names = args.scenarios.split(',') if args.scenarios else list(runner.SCENARIOS)
+    unknown = [name for name in names if name not in runner.SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    contexts = runner.worker_contexts(database, usernames)
+    transport = runner.HttpTransport(notebuddy.app) if args.transport == 'http' else runner.ClientTransport(notebuddy.app)
+    results = {}
+    try:
+        for name in names:
+            results[name] = runner.run_scenario(transport, name, contexts, args.requests, args.concurrency, args.seed)
+            result = results[name]
+            print(f"{name:<20} {result['throughput_rps']:>9} req/s  p50 {result['p50_ms']:>9} ms  "
+                  f"p95 {result['p95_ms']:>9} ms  p99 {result['p99_ms']:>9} ms  errors {result['errors']}")
+    finally:
+        transport.close()
+        stub.stop()
+        if not args.db:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'environment': runner.environment(),
+        'results': results
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = runner.compare(results, json.load(f), args.threshold)
+        report['comparison'] = comparison
+        for row in comparison:
+            flag = 'REGRESSED' if row['regressed'] else 'ok'
+            print(f"{row['scenario']:<20} p95 {row['baseline_p95_ms']} -> {row['p95_ms']} ms "
+                  f"({row['p95_change']:+.1%}), throughput {row['throughput_change']:+.1%}  {flag}")
+        if any(row['regressed'] for row in comparison):
+            exit_code = 1
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# Runs each scenario with a fixed number of requests spread over
+# concurrent workers, either in-process through Flask's test client or
+# over HTTP against a local threaded server, and summarizes latencies.
+import math
+import platform
+import sqlite3
+import threading
+import time
+import random
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmark.seed import PASSWORD, VOCABULARY
+
+ADMIN = ('admin', 'admin123')
+
+# name -> (needs admin, request builder); builders get the worker's context
+SCENARIOS = {
+    'notes_summary': (False, lambda ctx, rng: ('GET', '/api/notes?view=summary', None)),
+    'notes_full': (False, lambda ctx, rng: ('GET', '/api/notes?limit=50', None)),
+    'note_get': (False, lambda ctx, rng: ('GET', f"/api/notes/{rng.choice(ctx['note_ids'])}", None)),
+    'note_update': (False, lambda ctx, rng: ('PUT', f"/api/notes/{rng.choice(ctx['note_ids'])}",
+                                             {'title': 'Benchmark edit', 'content': {'text': 'edited', 'html': '<p>edited</p>'}})),
+    'todos_list': (False, lambda ctx, rng: ('GET', '/api/todos', None)),
+    'todo_create': (False, lambda ctx, rng: ('POST', '/api/todos', {'title': 'benchmark todo'})),
+    'conversations_list': (False, lambda ctx, rng: ('GET', '/api/conversations', None)),
+    'conversation_get': (False, lambda ctx, rng: ('GET', f"/api/conversations/{rng.choice(ctx['conversation_ids'])}", None)),
+    'search': (False, lambda ctx, rng: ('GET', f'/api/search?q={rng.choice(VOCABULARY)}', None)),
+    'chat': (False, lambda ctx, rng: ('POST', '/api/chat', {'message': f'benchmark {rng.random()}', 'cache': False})),
+    'chat_stream': (False, lambda ctx, rng: ('POST', '/api/chat', {'message': f'benchmark {rng.random()}',
+                                                                   'cache': False, 'stream': True})),
+    'chat_notes': (False, lambda ctx, rng: ('POST', '/api/chat', {'message': ' '.join(rng.sample(VOCABULARY, 3)),
+                                                                  'notes': True})),
+    'admin_stats': (True, lambda ctx, rng: ('GET', '/api/admin/stats', None))
+}
+
+class ClientTransport:
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        client = self.app.test_client()
+
+        def send(method, path, json=None, data=None):
+            response = client.open(path, method=method, json=json, data=data)
+            # Closing runs the response's close callbacks, as a real server does
+            with response:
+                return response.status_code, response.get_data()
+        return send
+
+    def close(self):
+        pass
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+class HttpTransport:
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def session(self):
+        http = requests.Session()
+
+        def send(method, path, json=None, data=None):
+            response = http.request(method, self.base_url + path, json=json, data=data, allow_redirects=False)
+            return response.status_code, response.content
+        return send
+
+    def close(self):
+        self.server.shutdown()
+
+def worker_contexts(database, usernames):
+    conn = sqlite3.connect(database)
+    contexts = []
+    for username in usernames:
+        user_id = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()[0]
+        contexts.append({
+            'username': username,
+            'note_ids': [row[0] for row in conn.execute('SELECT id FROM notes WHERE user_id = ?', (user_id,))] or [0],
+            'conversation_ids': [row[0] for row in conn.execute('SELECT id FROM conversations WHERE user_id = ?',
+                                                                (user_id,))] or [0]
+        })
+    conn.close()
+    return contexts
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+def summarize(latencies, statuses, wall_seconds):
+    latencies = sorted(latencies)
+    errors = sum(count for status, count in statuses.items() if status >= 400)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput_rps': round(len(latencies) / wall_seconds, 2) if wall_seconds else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else None
+    }
+
+def run_scenario(transport, name, contexts, requests_count, concurrency, seed):
+    needs_admin, build = SCENARIOS[name]
+    remaining = [requests_count]
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    # Logins (password hashing) happen before the clock starts
+    ready = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        context = contexts[index % len(contexts)]
+        send = transport.session()
+        username, password = ADMIN if needs_admin else (context['username'], PASSWORD)
+        # Logins beyond the server's password hashing queue get a 503 and are retried
+        while send('POST', '/login', data={'username': username, 'password': password})[0] == 503:
+            time.sleep(1)
+        ready.wait()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            method, path, body = build(context, rng)
+            started = time.perf_counter()
+            status, _ = send(method, path, json=body)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform()
+    }
+
+def compare(results, baseline, threshold):
+    # A scenario regresses when its p95 or throughput is worse than the baseline by more than threshold
+    rows = []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous.get('p95_ms') or not current.get('p95_ms'):
+            continue
+        p95_change = current['p95_ms'] / previous['p95_ms'] - 1
+        throughput_change = (current['throughput_rps'] / previous['throughput_rps'] - 1
+                             if previous.get('throughput_rps') else 0.0)
+        rows.append({
+            'scenario': name,
+            'baseline_p95_ms': previous['p95_ms'],
+            'p95_ms': current['p95_ms'],
+            'p95_change': round(p95_change, 4),
+            'throughput_change': round(throughput_change, 4),
+            'regressed': p95_change > threshold or throughput_change < -threshold
+        })
+    return rows
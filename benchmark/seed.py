@@ -0,0 +1,57 @@
+# Fills a NoteBuddy database with users and content of realistic sizes.
+# Note, message and title lengths are drawn from skewed distributions so
+# most items are short and a few are long, like real notebooks.
+import json
+import random
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'benchmark'
+VOCABULARY = ('meeting', 'project', 'deadline', 'review', 'draft', 'budget', 'design', 'release', 'customer',
+              'research', 'weekly', 'summary', 'follow', 'up', 'idea', 'notes', 'plan', 'travel', 'recipe', 'book',
+              'python', 'database', 'index', 'query', 'latency', 'garden', 'invoice', 'call', 'email', 'report')
+
+def words(rng, count):
+    return ' '.join(rng.choice(VOCABULARY) for _ in range(max(count, 1)))
+
+def skewed(rng, median, cap):
+    return min(int(rng.lognormvariate(0, 0.9) * median) + 1, cap)
+
+def note_content(rng):
+    paragraphs = [words(rng, skewed(rng, 40, 400)) for _ in range(skewed(rng, 3, 30))]
+    text = '\n'.join(paragraphs) + '\n'
+    return json.dumps({
+        'delta': {'ops': [{'insert': text}]},
+        'html': ''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs),
+        'text': text
+    }, separators=(',', ':'))
+
+def seed_database(conn, users=20, notes=200, todos=100, conversations=20, messages=20, seed=1):
+    # Counts other than users are per user; returns the created user names
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(PASSWORD)
+    usernames = [f'bench{i:04d}' for i in range(users)]
+    
+    for username in usernames:
+        cursor = conn.execute('INSERT INTO users (username, email, password_hash, role_id) VALUES (?, ?, ?, 2)',
+                              (username, f'{username}@bench.local', password_hash))
+        user_id = cursor.lastrowid
+        
+        conn.executemany('INSERT INTO notes (user_id, title, content) VALUES (?, ?, ?)',
+                         [(user_id, words(rng, skewed(rng, 4, 12)).title(), note_content(rng)) for _ in range(notes)])
+        conn.executemany('INSERT INTO todos (user_id, title, completed) VALUES (?, ?, ?)',
+                         [(user_id, words(rng, skewed(rng, 5, 15)), rng.random() < 0.3) for _ in range(todos)])
+        conn.executemany('INSERT INTO chat_messages (user_id, message, response) VALUES (?, ?, ?)',
+                         [(user_id, words(rng, skewed(rng, 10, 60)), words(rng, skewed(rng, 80, 600)))
+                          for _ in range(conversations * messages // 2)])
+        for _ in range(conversations):
+            cursor = conn.execute("INSERT INTO conversations (user_id, title, messages) VALUES (?, ?, '[]')",
+                                  (user_id, words(rng, 5)))
+            conn.executemany('''
+                INSERT INTO conversation_messages (conversation_id, user_id, position, sender, content)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(cursor.lastrowid, user_id, position, 'user' if position % 2 == 0 else 'ai',
+                   words(rng, skewed(rng, 12, 80) if position % 2 == 0 else skewed(rng, 80, 600)))
+                  for position in range(messages)])
+        conn.commit()
+    
+    return usernames
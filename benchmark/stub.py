@@ -0,0 +1,113 @@
+# Minimal stand-in for the Ollama HTTP API with configurable latency, so
+# the chat path can be measured without a model
+import json
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ('the', 'note', 'todo', 'plan', 'meeting', 'idea', 'draft', 'review', 'today', 'later')
+EMBEDDING_DIMS = 64
+
+def embedding(text):
+    # Hashed bag of words: deterministic, and texts sharing words score as similar
+    vector = [0.0] * EMBEDDING_DIMS
+    for word in text.lower().split():
+        vector[zlib.crc32(word.encode()) % EMBEDDING_DIMS] += 1.0
+    return vector
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The app's pooled connections close whenever they like; that isn't worth a traceback
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+class OllamaStub:
+    def __init__(self, latency=0.05, token_delay=0.005, tokens=50, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = StubServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._send_json({'models': [{'name': 'stub'}]})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                with stub._lock:
+                    stub.requests += 1
+
+                if self.path == '/api/embed':
+                    texts = payload.get('input', [])
+                    texts = [texts] if isinstance(texts, str) else texts
+                    self._send_json({'embeddings': [embedding(text) for text in texts]})
+                    return
+                if self.path == '/api/embeddings':
+                    self._send_json({'embedding': embedding(payload.get('prompt', ''))})
+                    return
+
+                # Prompt evaluation, then one token per token_delay
+                time.sleep(stub.latency)
+                tokens = [f'{WORDS[i % len(WORDS)]} ' for i in range(stub.tokens)]
+                done = {'done': True, 'context': list(range(len(payload.get('prompt', '')) // 4 + stub.tokens)),
+                        'eval_count': stub.tokens, 'eval_duration': int(stub.token_delay * stub.tokens * 1e9)}
+                if not payload.get('stream'):
+                    time.sleep(stub.token_delay * stub.tokens)
+                    self._send_json({'response': ''.join(tokens), **done})
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for token in tokens:
+                    time.sleep(stub.token_delay)
+                    self._write_chunk({'response': token, 'done': False})
+                self._write_chunk({'response': '', **done})
+                self.wfile.write(b'0\r\n\r\n')
+
+            def _write_chunk(self, data):
+                line = (json.dumps(data) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                self.wfile.flush()
+
+            def _send_json(self, data):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
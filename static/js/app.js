@@ -9,10 +9,14 @@ let isAIPanelHidden = false;
 const todoInput = document.getElementById('todo-input');
 const addTodoBtn = document.getElementById('add-todo-btn');
 const todosList = document.getElementById('todos-list');
+const clearCompletedBtn = document.getElementById('clear-completed-btn');
 const addNoteBtn = document.getElementById('add-note-btn');
 const notesList = document.getElementById('notes-list');
+const noteSearchInput = document.getElementById('note-search-input');
+const exportNotesBtn = document.getElementById('export-notes-btn');
 const chatInput = document.getElementById('chat-input');
 const sendChatBtn = document.getElementById('send-chat-btn');
+const askNotesToggle = document.getElementById('ask-notes-toggle');
 const chatMessages = document.getElementById('chat-messages');
 const conversationSelect = document.getElementById('conversation-select');
 const themeToggleBtn = document.getElementById('theme-toggle-btn');
@@ -25,6 +29,9 @@ const saveNoteBtn = document.getElementById('save-note-btn');
 const cancelNoteBtn = document.getElementById('cancel-note-btn');
 const closeModalBtn = document.querySelector('.close-modal');
 const modalTitle = document.getElementById('modal-title');
+const noteHistoryBtn = document.getElementById('note-history-btn');
+const noteHistoryPanel = document.getElementById('note-history-panel');
+const noteSaveStatus = document.getElementById('note-save-status');
 
 // Tab switching
 const tabBtns = document.querySelectorAll('.tab-btn');
@@ -42,9 +49,7 @@ document.addEventListener('DOMContentLoaded', function() {
         initializeRichTextEditor();
     }, 100);
     
-    loadTodos();
-    loadNotes();
-    loadConversations();
+    loadData();
     loadChatHistory();
     
     // Initial responsive setup
@@ -101,11 +106,15 @@ function setupEventListeners() {
     todoInput.addEventListener('keypress', (e) => {
         if (e.key === 'Enter') addTodo();
     });
+    clearCompletedBtn.addEventListener('click', clearCompletedTodos);
     
     // Note functionality
     addNoteBtn.addEventListener('click', () => openNoteModal());
+    noteSearchInput.addEventListener('input', scheduleNoteSearch);
+    exportNotesBtn.addEventListener('click', exportAllNotes);
     saveNoteBtn.addEventListener('click', saveNote);
     cancelNoteBtn.addEventListener('click', closeNoteModal);
+    noteHistoryBtn.addEventListener('click', toggleNoteHistory);
     closeModalBtn.addEventListener('click', closeNoteModal);
     
     // Chat functionality
@@ -139,20 +148,129 @@ function switchTab(tabName) {
     document.getElementById(`${tabName}-tab`).classList.add('active');
 }
 
+// Fetch every page of a paginated list endpoint by following X-Next-Cursor
+async function fetchAllPages(url) {
+    let items = [];
+    let cursor = null;
+    do {
+        const separator = url.includes('?') ? '&' : '?';
+        const pageUrl = cursor ? `${url}${separator}after=${encodeURIComponent(cursor)}` : url;
+        const response = await fetch(pageUrl);
+        if (!response.ok) {
+            throw new Error(`Request failed with status ${response.status}`);
+        }
+        items = items.concat(await response.json());
+        cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    return items;
+}
+
+// Change sync
+// Lists are loaded once, then kept current by applying change events
+// from the server instead of refetching them after every write
+let lastChangeSeq = 0;
+let changeStream = null;
+
+async function loadData() {
+    // Take the change position first so nothing written during the load is missed
+    try {
+        const response = await fetch('/api/changes');
+        lastChangeSeq = (await response.json()).last_seq;
+    } catch (error) {
+        console.error('Error loading change position:', error);
+    }
+    
+    await Promise.all([loadTodos(), loadNotes(), loadConversations()]);
+    openChangeStream();
+}
+
+function openChangeStream() {
+    if (changeStream) changeStream.close();
+    if (!window.EventSource) return;
+    
+    changeStream = new EventSource(`/api/changes/stream?since=${lastChangeSeq}`);
+    changeStream.addEventListener('change', (event) => applyChange(JSON.parse(event.data)));
+    changeStream.addEventListener('reset', () => {
+        // Too far behind for a catch-up; start over from a full load
+        changeStream.close();
+        loadData();
+    });
+    changeStream.addEventListener('error', () => {
+        // EventSource gives up when the server is out of streams; try again later
+        if (changeStream.readyState === EventSource.CLOSED) setTimeout(openChangeStream, 30000);
+    });
+}
+
+// Catch up right after our own writes, in case the stream is unavailable
+async function syncChanges() {
+    try {
+        let hasMore = true;
+        while (hasMore) {
+            const response = await fetch(`/api/changes?since=${lastChangeSeq}`);
+            if (response.status === 410) {
+                await loadData();
+                return;
+            }
+            const data = await response.json();
+            data.changes.forEach(applyChange);
+            lastChangeSeq = Math.max(lastChangeSeq, data.last_seq);
+            hasMore = data.has_more;
+        }
+    } catch (error) {
+        console.error('Error syncing changes:', error);
+    }
+}
+
+function applyChange(change) {
+    if (change.seq <= lastChangeSeq) return;
+    lastChangeSeq = change.seq;
+    
+    if (change.collection === 'todos') {
+        todos = upsertItem(todos, change, false);
+        renderTodos();
+    } else if (change.collection === 'notes') {
+        notes = upsertItem(notes, change, true);
+        // Leave search results on screen while a search is active
+        if (!noteSearchInput.value.trim()) renderNotes();
+    } else if (change.collection === 'conversations') {
+        conversations = upsertItem(conversations, change, true);
+        const selected = conversationSelect.value;
+        renderConversationSelect();
+        conversationSelect.value = conversations.some(c => String(c.id) === selected) ? selected : 'current';
+        updateDeleteButtonVisibility();
+    }
+}
+
+// Lists sorted by last update move changed items to the top
+function upsertItem(items, change, moveToTop) {
+    const index = items.findIndex(item => item.id === change.id);
+    if (change.action === 'deleted') {
+        return index === -1 ? items : items.filter(item => item.id !== change.id);
+    }
+    if (index === -1) {
+        return [change.item, ...items];
+    }
+    if (moveToTop) {
+        return [change.item, ...items.filter(item => item.id !== change.id)];
+    }
+    const updated = items.slice();
+    updated[index] = change.item;
+    return updated;
+}
+
 // Todo functionality
 async function loadTodos() {
     try {
-        const response = await fetch('/api/todos');
-        if (response.ok) {
-            todos = await response.json();
-            renderTodos();
-        }
+        todos = await fetchAllPages('/api/todos');
+        renderTodos();
     } catch (error) {
         console.error('Error loading todos:', error);
     }
 }
 
 function renderTodos() {
+    clearCompletedBtn.style.display = todos.some(t => t.completed) ? 'inline-block' : 'none';
+    
     if (todos.length === 0) {
         todosList.innerHTML = '<div class="empty-state"><p>No todos yet. Add one above!</p></div>';
         return;
@@ -229,14 +347,39 @@ async function deleteTodo(todoId) {
     }
 }
 
-// Notes functionality
-async function loadNotes() {
+// Delete all completed todos in one batch request
+async function clearCompletedTodos() {
+    const completed = todos.filter(t => t.completed);
+    if (completed.length === 0) return;
+    
     try {
-        const response = await fetch('/api/notes');
+        const response = await fetch('/api/todos/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                operations: completed.map(t => ({ op: 'delete', id: t.id }))
+            })
+        });
+        
         if (response.ok) {
-            notes = await response.json();
-            renderNotes();
+            const data = await response.json();
+            const removed = new Set(data.results.filter(r => r.status !== 'error').map(r => r.id));
+            todos = todos.filter(t => !removed.has(t.id));
+            renderTodos();
         }
+    } catch (error) {
+        console.error('Error clearing completed todos:', error);
+    }
+}
+
+// Notes functionality
+async function loadNotes() {
+    try {
+        // Summaries only; full content is fetched when a note is opened
+        notes = await fetchAllPages('/api/notes?view=summary');
+        renderNotes();
     } catch (error) {
         console.error('Error loading notes:', error);
     }
@@ -251,17 +394,7 @@ function renderNotes() {
     notesList.innerHTML = notes.map(note => {
         const date = new Date(note.updated_at).toLocaleDateString();
         
-        let preview = 'No content';
-        if (note.content) {
-            try {
-                // Try to parse rich text content
-                const parsedContent = JSON.parse(note.content);
-                preview = parsedContent.text ? parsedContent.text.substring(0, 100) + '...' : 'No content';
-            } catch {
-                // Fallback to plain text
-                preview = note.content.substring(0, 100) + '...';
-            }
-        }
+        const preview = note.snippet && note.snippet.trim() ? note.snippet.substring(0, 100) + '...' : 'No content';
         
         return `
             <div class="note-item" onclick="openNoteModal(${note.id})">
@@ -275,6 +408,52 @@ function renderNotes() {
     }).join('');
 }
 
+// Note search (server-side full-text search)
+let noteSearchTimeout;
+function scheduleNoteSearch() {
+    clearTimeout(noteSearchTimeout);
+    noteSearchTimeout = setTimeout(searchNotes, 250);
+}
+
+async function searchNotes() {
+    const query = noteSearchInput.value.trim();
+    if (!query) {
+        renderNotes();
+        return;
+    }
+    
+    try {
+        const response = await fetch(`/api/search?type=notes&q=${encodeURIComponent(query)}`);
+        if (response.ok) {
+            const data = await response.json();
+            renderNoteSearchResults(data.results.notes);
+        }
+    } catch (error) {
+        console.error('Error searching notes:', error);
+    }
+}
+
+function renderNoteSearchResults(results) {
+    if (results.length === 0) {
+        notesList.innerHTML = '<div class="empty-state"><p>No matching notes.</p></div>';
+        return;
+    }
+    
+    // Titles and snippets come back HTML-escaped with <mark> highlights
+    notesList.innerHTML = results.map(result => {
+        const date = new Date(result.updated_at).toLocaleDateString();
+        return `
+            <div class="note-item" onclick="openNoteModal(${result.id})">
+                <div class="note-header">
+                    <span class="note-title">${result.title}</span>
+                    <span class="note-date">${date}</span>
+                </div>
+                <div class="note-preview">${result.snippet}</div>
+            </div>
+        `;
+    }).join('');
+}
+
 // Rich Text Editor Management
 function initializeRichTextEditor() {
     // Initialize Quill editor
@@ -288,6 +467,9 @@ function initializeRichTextEditor() {
     
     // Update word count on text change
     quillEditor.on('text-change', updateWordCount);
+    quillEditor.on('text-change', (delta, oldDelta, source) => {
+        if (source === 'user') scheduleNoteSave();
+    });
     
     // Setup custom toolbar
     setupCustomToolbar();
@@ -410,32 +592,25 @@ function updateWordCount() {
     document.getElementById('word-count').textContent = `${wordCount} words`;
 }
 
-function openNoteModal(noteId = null) {
+async function openNoteModal(noteId = null) {
     currentNoteId = noteId;
     
     if (noteId) {
-        const note = notes.find(n => n.id === noteId);
-        if (note) {
-            modalTitle.textContent = 'Edit Note';
-            noteTitleInput.value = note.title;
-            
-            // Set content in Quill editor
-            if (note.content) {
-                try {
-                    // Try to parse as rich text JSON
-                    const parsedContent = JSON.parse(note.content);
-                    if (parsedContent.delta) {
-                        quillEditor.setContents(parsedContent.delta);
-                    } else {
-                        quillEditor.setText(parsedContent.text || note.content);
-                    }
-                } catch {
-                    // Fallback to plain text
-                    quillEditor.setText(note.content);
-                }
-            } else {
-                quillEditor.setText('');
-            }
+        const note = await fetchNote(noteId);
+        if (!note) {
+            currentNoteId = null;
+            return;
+        }
+        
+        modalTitle.textContent = 'Edit Note';
+        noteTitleInput.value = note.title;
+        
+        // Set content in Quill editor; content is a {delta, html, text} object
+        const content = note.content || {};
+        if (content.delta) {
+            quillEditor.setContents(content.delta);
+        } else {
+            quillEditor.setText(content.text || '');
         }
     } else {
         modalTitle.textContent = 'New Note';
@@ -443,36 +618,53 @@ function openNoteModal(noteId = null) {
         quillEditor.setText('');
     }
     
+    noteHistoryPanel.style.display = 'none';
+    noteHistoryBtn.style.display = noteId ? '' : 'none';
+    noteSaveStatus.textContent = '';
     noteModal.style.display = 'block';
     noteTitleInput.focus();
     updateWordCount();
     updateToolbarState();
 }
 
+async function fetchNote(noteId) {
+    try {
+        const response = await fetch(`/api/notes/${noteId}`);
+        if (response.ok) {
+            return await response.json();
+        }
+    } catch (error) {
+        console.error('Error loading note:', error);
+    }
+    showActionFeedback('Error loading note', 'error');
+    return null;
+}
+
 function closeNoteModal() {
+    cancelNoteAutoSave();
     noteModal.style.display = 'none';
     currentNoteId = null;
 }
 
-async function saveNote() {
-    const title = noteTitleInput.value.trim();
-    
-    // Get rich text content from Quill editor
-    const delta = quillEditor.getContents();
-    const htmlContent = quillEditor.root.innerHTML;
-    
+function noteEditorContent() {
     // Store both delta (for editing) and HTML (for preview)
-    const content = JSON.stringify({
-        delta: delta,
-        html: htmlContent,
+    return {
+        delta: quillEditor.getContents(),
+        html: quillEditor.root.innerHTML,
         text: quillEditor.getText()
-    });
+    };
+}
+
+async function saveNote() {
+    const title = noteTitleInput.value.trim();
+    const content = noteEditorContent();
     
     if (!title) {
         alert('Please enter a title for your note.');
         return;
     }
     
+    cancelNoteAutoSave();
     try {
         let response;
         if (currentNoteId) {
@@ -497,7 +689,7 @@ async function saveNote() {
         
         if (response.ok) {
             closeNoteModal();
-            loadNotes(); // Reload notes to get updated data
+            syncChanges(); // Pick up the saved note
             showActionFeedback('Note saved successfully!');
         }
     } catch (error) {
@@ -552,16 +744,25 @@ async function sendMessage() {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message })
+            body: JSON.stringify({ message, stream: true, conversation_id: currentConversationId, notes: askNotesToggle.checked })
         });
         
         if (response.ok) {
-            const data = await response.json();
-            removeTypingIndicator(typingIndicator);
-            appendMessage(data.response, 'ai');
+            const responseText = await readChatStream(response, typingIndicator);
+            await trackMessage(responseText, 'ai');
             
             // Auto-save conversation after every AI response
             await autoSaveConversation();
+        } else if (response.status === 429) {
+            // Chat queue is full; show a notice without saving it to the conversation
+            removeTypingIndicator(typingIndicator);
+            const retryAfter = response.headers.get('Retry-After') || 'a few';
+            appendMessageToUI(`The assistant is busy right now. Please try again in ${retryAfter} seconds.`, 'ai');
+        } else if (response.status === 503) {
+            // "Ask my notes" isn't available on this server
+            removeTypingIndicator(typingIndicator);
+            const data = await response.json();
+            appendMessageToUI(data.error, 'ai');
         } else {
             removeTypingIndicator(typingIndicator);
             appendMessage('Sorry, there was an error processing your message.', 'ai');
@@ -576,6 +777,70 @@ async function sendMessage() {
     }
 }
 
+// Render streamed NDJSON chunks from /api/chat into a live AI message
+async function readChatStream(response, typingIndicator) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let text = '';
+    let sources = null;
+    let messageDiv = null;
+    
+    const applyLine = (line) => {
+        if (!line.trim()) return;
+        const chunk = JSON.parse(line);
+        if (chunk.token) {
+            text += chunk.token;
+        } else if (chunk.done) {
+            text = chunk.response;
+            sources = chunk.sources || null;
+        } else {
+            return;
+        }
+        
+        if (!messageDiv) {
+            removeTypingIndicator(typingIndicator);
+            messageDiv = appendMessageToUI(text, 'ai');
+        } else {
+            updateMessageContent(messageDiv, text, 'ai', false);
+        }
+    };
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(applyLine);
+    }
+    applyLine(buffer);
+    
+    if (messageDiv) {
+        // Highlight code blocks once the full response is in
+        updateMessageContent(messageDiv, text, 'ai');
+    } else {
+        removeTypingIndicator(typingIndicator);
+        messageDiv = appendMessageToUI(text, 'ai');
+    }
+    if (sources && sources.length) {
+        appendMessageSources(messageDiv, sources);
+    }
+    return text;
+}
+
+// List the notes and todos an "ask my notes" answer was based on
+function appendMessageSources(messageDiv, sources) {
+    const list = document.createElement('div');
+    list.className = 'message-sources';
+    list.innerHTML = 'Sources: ' + sources.map(source => source.type === 'note'
+        ? `<a href="#" onclick="openNoteModal(${source.id}); return false;">${escapeHtml(source.title || 'Untitled Note')}</a>`
+        : `<span>${escapeHtml(source.title)} (todo)</span>`).join(', ');
+    messageDiv.appendChild(list);
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
 // Format AI responses with markdown and code support
 function formatAIResponse(text) {
     // First escape HTML to prevent XSS
@@ -652,15 +917,13 @@ function removeTypingIndicator(indicator) {
 let currentConversationId = null;
 let conversations = [];
 let currentSessionMessages = []; // Track messages in current session
+let savedMessageCount = 0; // How many of currentSessionMessages the server already has
 let isCurrentSession = true; // Track if we're in current session
 
 async function loadConversations() {
     try {
-        const response = await fetch('/api/conversations');
-        if (response.ok) {
-            conversations = await response.json();
-            renderConversationSelect();
-        }
+        conversations = await fetchAllPages('/api/conversations');
+        renderConversationSelect();
     } catch (error) {
         console.error('Error loading conversations:', error);
     }
@@ -742,6 +1005,11 @@ async function autoSaveConversation() {
         return; // Wait until we have at least one exchange
     }
     
+    if (currentConversationId) {
+        await appendConversationMessages();
+        return;
+    }
+    
     // Generate a title based on the first user message
     const firstUserMessage = currentSessionMessages.find(m => m.sender === 'user');
     const title = firstUserMessage ? 
@@ -749,37 +1017,62 @@ async function autoSaveConversation() {
         `Chat ${new Date().toLocaleDateString()}`;
     
     try {
+        const messages = currentSessionMessages.slice();
         const response = await fetch('/api/conversations', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ 
-                title, 
-                messages: currentSessionMessages,
-                conversation_id: currentConversationId 
-            })
+            body: JSON.stringify({ title, messages })
         });
         
         if (response.ok) {
             const data = await response.json();
-            if (!currentConversationId) {
-                // First save - switch to this conversation
-                currentConversationId = data.id;
-                isCurrentSession = false;
-                
-                // Add to conversation list and select it
-                await loadConversations();
-                conversationSelect.value = currentConversationId;
-                
-                showActionFeedback(`Conversation auto-saved: ${title}`);
-            }
+            // First save - switch to this conversation
+            currentConversationId = data.id;
+            savedMessageCount = messages.length;
+            isCurrentSession = false;
+            
+            // Add to conversation list and select it
+            await syncChanges();
+            conversationSelect.value = currentConversationId;
+            updateDeleteButtonVisibility();
+            
+            showActionFeedback(`Conversation auto-saved: ${title}`);
         }
     } catch (error) {
         console.error('Error auto-saving conversation:', error);
     }
 }
 
+// Send only the messages the server doesn't have yet
+async function appendConversationMessages() {
+    const start = savedMessageCount;
+    const messages = currentSessionMessages.slice(start);
+    if (messages.length === 0) {
+        return;
+    }
+    
+    // Claim these messages up front so an overlapping save doesn't resend them
+    savedMessageCount = currentSessionMessages.length;
+    try {
+        const response = await fetch(`/api/conversations/${currentConversationId}/messages`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ messages, start })
+        });
+        
+        if (!response.ok) {
+            savedMessageCount = Math.min(savedMessageCount, start);
+        }
+    } catch (error) {
+        savedMessageCount = Math.min(savedMessageCount, start);
+        console.error('Error auto-saving conversation:', error);
+    }
+}
+
 async function loadSelectedConversation() {
     const selectedValue = conversationSelect.value;
     
@@ -790,12 +1083,12 @@ async function loadSelectedConversation() {
     }
     
     try {
-        const response = await fetch(`/api/conversations/${selectedValue}`);
-        if (response.ok) {
-            const conversation = await response.json();
+        const conversation = await fetchConversation(selectedValue);
+        if (conversation) {
             currentConversationId = conversation.id;
             isCurrentSession = false;
             currentSessionMessages = [...conversation.messages]; // Copy existing messages
+            savedMessageCount = currentSessionMessages.length;
             
             // Clear all messages and load saved conversation
             clearAllMessages();
@@ -815,10 +1108,32 @@ async function loadSelectedConversation() {
     }
 }
 
+// Load a conversation with all of its messages, following pagination
+async function fetchConversation(conversationId) {
+    let conversation = null;
+    let after = null;
+    do {
+        const url = after === null ? `/api/conversations/${conversationId}` : `/api/conversations/${conversationId}?after=${after}`;
+        const response = await fetch(url);
+        if (!response.ok) {
+            return null;
+        }
+        const page = await response.json();
+        if (conversation) {
+            conversation.messages = conversation.messages.concat(page.messages);
+        } else {
+            conversation = page;
+        }
+        after = page.next_after;
+    } while (after !== null);
+    return conversation;
+}
+
 function startNewCurrentSession() {
     currentConversationId = null;
     isCurrentSession = true;
     currentSessionMessages = [];
+    savedMessageCount = 0;
     showEmptyState();
 }
 
@@ -847,17 +1162,23 @@ function appendMessageToUI(content, sender, animate = true) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `${sender}-message${animate ? ' fade-in' : ''}`;
     
+    chatMessages.appendChild(messageDiv);
+    updateMessageContent(messageDiv, content, sender);
+    
+    return messageDiv;
+}
+
+// Replace the content of a rendered message (used while a response streams in)
+function updateMessageContent(messageDiv, content, sender, highlight = true) {
     // Format AI responses differently than user messages
     const formattedContent = sender === 'ai' ? formatAIResponse(content) : `<p>${escapeHtml(content)}</p>`;
     
     // Create message content without any whitespace
     messageDiv.innerHTML = `<div class="message-content">${formattedContent}</div>`;
-    
-    chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
     
     // Apply syntax highlighting to any code blocks
-    if (sender === 'ai' && window.Prism) {
+    if (highlight && sender === 'ai' && window.Prism) {
         const codeBlocks = messageDiv.querySelectorAll('code[class*="language-"]');
         codeBlocks.forEach(block => {
             Prism.highlightElement(block);
@@ -869,7 +1190,11 @@ function appendMessageToUI(content, sender, animate = true) {
 async function appendMessage(content, sender, animate = true) {
     // Display the message in UI
     appendMessageToUI(content, sender, animate);
-    
+    await trackMessage(content, sender);
+}
+
+// Track a displayed message for saving
+async function trackMessage(content, sender) {
     // Track messages for current session
     if (isCurrentSession) {
         currentSessionMessages.push({ content, sender });
@@ -965,24 +1290,112 @@ function handleFetchError(error, action) {
     }, 3000);
 }
 
-// Auto-save for notes (save draft every 30 seconds)
+// Auto-save for notes: saves an open note once typing pauses for
+// NOTE_AUTOSAVE_DELAY, and at least every NOTE_AUTOSAVE_MAX_WAIT while typing
+// continues. The editor stays open; the server folds saves that arrive
+// close together into one revision.
+const NOTE_AUTOSAVE_DELAY = 2000;
+const NOTE_AUTOSAVE_MAX_WAIT = 30000;
 let noteSaveTimeout;
+let noteSaveDeadline;
 function scheduleNoteSave() {
+    if (!currentNoteId) return;
     clearTimeout(noteSaveTimeout);
-    noteSaveTimeout = setTimeout(() => {
-        if (noteModal.style.display === 'block' && currentNoteId) {
-            const title = noteTitleInput.value.trim();
-            const content = noteContentInput.value.trim();
-            
-            if (title && (title !== '' || content !== '')) {
-                saveNote();
-            }
+    const now = Date.now();
+    if (!noteSaveDeadline) noteSaveDeadline = now + NOTE_AUTOSAVE_MAX_WAIT;
+    noteSaveTimeout = setTimeout(autoSaveNote, Math.min(NOTE_AUTOSAVE_DELAY, noteSaveDeadline - now));
+}
+
+function cancelNoteAutoSave() {
+    clearTimeout(noteSaveTimeout);
+    noteSaveDeadline = null;
+}
+
+async function autoSaveNote() {
+    noteSaveDeadline = null;
+    const noteId = currentNoteId;
+    const title = noteTitleInput.value.trim();
+    if (!noteId || !title || noteModal.style.display !== 'block') return;
+    
+    try {
+        const response = await fetch(`/api/notes/${noteId}`, {
+            method: 'PUT',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ title, content: noteEditorContent() })
+        });
+        if (response.ok && noteId === currentNoteId) {
+            noteSaveStatus.textContent = 'Saved';
         }
-    }, 30000);
+    } catch (error) {
+        console.error('Error auto-saving note:', error);
+        noteSaveStatus.textContent = 'Not saved';
+    }
 }
 
 noteTitleInput.addEventListener('input', scheduleNoteSave);
-noteContentInput.addEventListener('input', scheduleNoteSave);
+
+// Note revision history
+async function toggleNoteHistory() {
+    if (noteHistoryPanel.style.display === 'block') {
+        noteHistoryPanel.style.display = 'none';
+        return;
+    }
+    noteHistoryPanel.style.display = 'block';
+    await loadNoteHistory();
+}
+
+async function loadNoteHistory() {
+    if (!currentNoteId) return;
+    noteHistoryPanel.innerHTML = '<div class="note-history-empty">Loading...</div>';
+    try {
+        const response = await fetch(`/api/notes/${currentNoteId}/revisions`);
+        const revisions = response.ok ? await response.json() : [];
+        if (revisions.length === 0) {
+            noteHistoryPanel.innerHTML = '<div class="note-history-empty">No earlier versions yet</div>';
+            return;
+        }
+        noteHistoryPanel.innerHTML = revisions.map((revision, i) => `
+            <div class="note-history-item">
+                <span class="note-history-date">${formatDate(revision.updated_at)}</span>
+                <span class="note-history-title">${escapeHtml(revision.title)}</span>
+                ${i === 0 ? '<span class="note-history-current">Current</span>'
+                          : `<button class="toolbar-btn" onclick="restoreNoteRevision(${revision.id})">Restore</button>`}
+            </div>
+        `).join('');
+    } catch (error) {
+        console.error('Error loading note history:', error);
+        noteHistoryPanel.innerHTML = '<div class="note-history-empty">Could not load history</div>';
+    }
+}
+
+async function restoreNoteRevision(revisionId) {
+    if (!confirm('Replace the note with this version? The current version stays in the history.')) {
+        return;
+    }
+    cancelNoteAutoSave();
+    try {
+        const response = await fetch(`/api/notes/${currentNoteId}/revisions/${revisionId}/restore`, {
+            method: 'POST'
+        });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const note = await response.json();
+        noteTitleInput.value = note.title;
+        if (note.content.delta) {
+            quillEditor.setContents(note.content.delta);
+        } else {
+            quillEditor.setText(note.content.text || '');
+        }
+        updateWordCount();
+        syncChanges();
+        await loadNoteHistory();
+        showActionFeedback('Note restored');
+    } catch (error) {
+        console.error('Error restoring note:', error);
+        showActionFeedback('Error restoring note', 'error');
+    }
+}
 
 // Advanced Document Editor Features
 function showFindReplaceDialog() {
@@ -1064,6 +1477,42 @@ function exportToDocx() {
     showActionFeedback('Document exported successfully!');
 }
 
+// Export every note as a Markdown ZIP; the server builds it in the background
+async function exportAllNotes() {
+    exportNotesBtn.disabled = true;
+    exportNotesBtn.textContent = 'Preparing export...';
+    
+    try {
+        const response = await fetch('/api/exports', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ format: 'markdown' })
+        });
+        let job = await response.json();
+        if (!response.ok) throw new Error(job.error);
+        
+        while (job.status === 'queued' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            if (job.total) {
+                exportNotesBtn.textContent = `Preparing export... ${job.progress}/${job.total}`;
+            }
+            job = await (await fetch(`/api/exports/${job.id}`)).json();
+        }
+        
+        if (job.status !== 'done') throw new Error(job.error);
+        window.location.href = job.download_url;
+        showActionFeedback('Notes exported successfully!');
+    } catch (error) {
+        console.error('Error exporting notes:', error);
+        showActionFeedback('Error exporting notes', 'error');
+    } finally {
+        exportNotesBtn.disabled = false;
+        exportNotesBtn.textContent = 'Export all notes';
+    }
+}
+
 function printDocument() {
     const title = noteTitleInput.value.trim() || 'Untitled Note';
     const htmlContent = quillEditor.root.innerHTML;
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app reads its settings at import time
+_workdir = tempfile.mkdtemp(prefix='notebuddy-tests-')
+os.environ.update({
+    'NOTEBUDDY_DB': os.path.join(_workdir, 'notebuddy.db'),
+    'NOTEBUDDY_EXPORT_DIR': os.path.join(_workdir, 'exports'),
+    'NOTEBUDDY_VECTOR_DIR': os.path.join(_workdir, 'vector_index'),
+    'OLLAMA_URL': 'http://127.0.0.1:9',  # nothing listens; chats get the fallback reply
+    'HASH_WORKERS': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as notebuddy_app
+
+ADMIN = ('admin', 'admin123')
+
+def close_connections():
+    with notebuddy_app._db_pool_lock:
+        for conn in notebuddy_app._db_pool:
+            conn.close()
+        notebuddy_app._db_pool.clear()
+    conn = getattr(notebuddy_app._db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        notebuddy_app._db_local.conn = None
+
+@pytest.fixture
+def notebuddy(tmp_path, monkeypatch):
+    # A fresh database and rate limits for each test
+    monkeypatch.setattr(notebuddy_app, 'DATABASE', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(notebuddy_app, 'auth_buckets', notebuddy_app.MemoryBuckets(notebuddy_app.RATE_LIMIT_MAX_KEYS))
+    notebuddy_app._identity_cache.clear()
+    close_connections()
+    notebuddy_app.init_db()
+    yield notebuddy_app
+    close_connections()
+
+@pytest.fixture
+def client(notebuddy):
+    client = notebuddy.app.test_client()
+    client.post('/login', data={'username': ADMIN[0], 'password': ADMIN[1]})
+    return client
@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+def wait_for_children(count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while len(multiprocessing.active_children()) > count and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return len(multiprocessing.active_children())
+
+def test_hash_timeout_stops_the_pool_processes(notebuddy, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'HASH_WORKERS', 2)
+    monkeypatch.setattr(notebuddy, 'HASH_TIMEOUT', 0.5)
+    before = len(multiprocessing.active_children())
+    try:
+        for _ in range(3):
+            with pytest.raises(notebuddy.HashingBusy):
+                notebuddy.run_hashing(time.sleep, 30)
+        assert wait_for_children(before) == before
+        # The next caller gets a working pool
+        assert notebuddy.run_hashing(sum, [1, 2]) == 3
+    finally:
+        if notebuddy._hash_executor is not None:
+            notebuddy.discard_hash_executor(notebuddy._hash_executor)
+    assert wait_for_children(before) == before
+
+def test_hash_slots_are_shared_between_processes(notebuddy, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'HASH_WORKERS', 1)
+    monkeypatch.setattr(notebuddy, 'HASH_TIMEOUT', 0.5)
+    ready, done = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # Another worker process busy hashing
+        notebuddy.take_hash_slot()
+        os.write(done, b'x')
+        time.sleep(30)
+        os._exit(0)
+    try:
+        os.read(ready, 1)
+        with pytest.raises(notebuddy.HashingBusy):
+            notebuddy.run_hashing(sum, [1, 2])
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    # Its slot is freed when it dies
+    monkeypatch.setattr(notebuddy, 'HASH_TIMEOUT', 30)
+    try:
+        assert notebuddy.run_hashing(sum, [1, 2]) == 3
+    finally:
+        notebuddy.discard_hash_executor(notebuddy._hash_executor)
+
+def login(client, username, password, ip):
+    return client.post('/login', data={'username': username, 'password': password}, environ_base={'REMOTE_ADDR': ip})
+
+def test_successful_logins_do_not_use_up_the_username_limit(notebuddy):
+    client = notebuddy.app.test_client()
+    burst = notebuddy.AUTH_RATE_LIMITS['login_user'][0]
+    for i in range(burst * 3):
+        assert login(client, 'admin', 'admin123', f'10.0.0.{i}').status_code == 302
+
+def test_failed_logins_are_limited_per_username_and_address(notebuddy):
+    client = notebuddy.app.test_client()
+    burst = notebuddy.AUTH_RATE_LIMITS['login_user'][0]
+    for _ in range(burst):
+        assert login(client, 'admin', 'wrong', '10.0.1.1').status_code == 200
+    response = login(client, 'Admin', 'wrong', '10.0.1.1')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    # The owner still gets in from their own address
+    assert login(client, 'admin', 'admin123', '10.0.2.1').status_code == 302
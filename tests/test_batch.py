@@ -0,0 +1,8 @@
+import pytest
+
+@pytest.mark.parametrize('collection', ['todos', 'notes'])
+@pytest.mark.parametrize('body', ['[]', '"x"', '1', 'null'])
+def test_batch_body_must_be_an_object(client, collection, body):
+    response = client.post(f'/api/{collection}/batch', data=body, content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'operations must be a non-empty list'
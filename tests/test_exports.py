@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+@pytest.fixture
+def exports(notebuddy, tmp_path, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'EXPORT_DIR', str(tmp_path / 'exports'))
+    monkeypatch.setattr(notebuddy, 'export_executor', InlineExecutor)
+    return tmp_path / 'exports'
+
+def export(client, note_id):
+    job = client.post('/api/exports', json={'note_id': note_id, 'format': 'markdown'}).get_json()
+    assert client.get(f'/api/exports/{job["id"]}').get_json()['status'] == 'done'
+    return job['id']
+
+def test_earlier_exports_stay_downloadable_after_the_note_changes(client, exports):
+    note_id = client.post('/api/notes', json={'title': 'Plan', 'content': 'first draft'}).get_json()['id']
+    first = export(client, note_id)
+    client.put(f'/api/notes/{note_id}', json={'title': 'Plan', 'content': 'second draft'})
+    second = export(client, note_id)
+
+    assert b'first draft' in client.get(f'/api/exports/{first}/download').data
+    assert b'second draft' in client.get(f'/api/exports/{second}/download').data
+
+def test_renders_of_deleted_notes_are_swept(client, notebuddy, exports, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'EXPORT_RENDER_GRACE_SECONDS', -1)
+    kept = client.post('/api/notes', json={'title': 'Kept', 'content': 'stays'}).get_json()['id']
+    deleted = client.post('/api/notes', json={'title': 'Gone', 'content': 'goes'}).get_json()['id']
+    job = export(client, deleted)
+    client.delete(f'/api/notes/{deleted}')
+
+    # Cleanup runs when the next export is created
+    export(client, kept)
+    renders = os.listdir(exports / 'notes')
+    assert [name for name in renders if name.startswith(f'note-{deleted}-')] == []
+    assert [name for name in renders if name.startswith(f'note-{kept}-')]
+    # The finished job still has its own copy until it expires
+    assert client.get(f'/api/exports/{job}/download').status_code == 200
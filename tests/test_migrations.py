@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+from conftest import close_connections
+
+@pytest.fixture
+def empty_db(notebuddy, tmp_path, monkeypatch):
+    # Nothing migrated yet, not even schema_version
+    monkeypatch.setattr(notebuddy, 'DATABASE', str(tmp_path / 'migrate.db'))
+    close_connections()
+    conn = notebuddy.connect_db()
+    yield conn
+    conn.close()
+
+def schema(conn):
+    return set(conn.execute('SELECT type, name FROM sqlite_master'))
+
+def test_each_migration_stays_inside_its_transaction(notebuddy, empty_db, monkeypatch):
+    migrations = sorted(notebuddy.MIGRATIONS, key=lambda m: m[0])
+    for i, (version, _, apply) in enumerate(migrations):
+        # Run everything before this migration, then this one and roll it back
+        monkeypatch.setattr(notebuddy, 'MIGRATIONS', migrations[:i])
+        notebuddy.migrate(empty_db)
+        before = schema(empty_db)
+        empty_db.execute('BEGIN IMMEDIATE')
+        apply(empty_db.cursor())
+        assert empty_db.in_transaction, f'migration {version} committed early'
+        empty_db.rollback()
+        assert schema(empty_db) == before
+
+def test_failed_migration_leaves_nothing_behind(notebuddy, empty_db, monkeypatch):
+    migrations = list(notebuddy.MIGRATIONS)
+    version, description, apply = next(m for m in migrations if m[0] == 12)
+
+    def fail_after(cursor):
+        apply(cursor)
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(notebuddy, 'MIGRATIONS', [m for m in migrations if m[0] < 12] + [(version, description, fail_after)])
+    with pytest.raises(sqlite3.OperationalError):
+        notebuddy.migrate(empty_db)
+    assert not any(name.startswith('changes_') for _, name in schema(empty_db))
+
+    # The next start applies it and the ones after it
+    monkeypatch.setattr(notebuddy, 'MIGRATIONS', migrations)
+    notebuddy.migrate(empty_db)
+    assert empty_db.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] == max(m[0] for m in migrations)
@@ -0,0 +1,31 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+def index_embedder(notebuddy):
+    with notebuddy.app.app_context():
+        return notebuddy.get_db_connection().execute('SELECT embedder FROM vector_indexes').fetchone()['embedder']
+
+def ask(notebuddy, query):
+    with notebuddy.app.app_context():
+        return notebuddy.retrieve_chunks(1, query)
+
+def test_fallback_index_is_rebuilt_once_ollama_can_embed(client, notebuddy, tmp_path, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'VECTOR_INDEX_DIR', str(tmp_path / 'vector_index'))
+    monkeypatch.setattr(notebuddy, '_embed_failed_at', None)
+    client.post('/api/notes', json={'title': 'Garden', 'content': 'plant the tomatoes in spring'})
+
+    def unavailable(texts):
+        raise notebuddy.EmbeddingUnavailable('connection refused')
+    monkeypatch.setattr(notebuddy, 'ollama_embed', unavailable)
+    assert ask(notebuddy, 'tomatoes')
+    assert index_embedder(notebuddy) == f'hashing:{notebuddy.RAG_HASHING_DIMS}'
+
+    # Ollama is back, but isn't asked again until the retry interval has passed
+    monkeypatch.setattr(notebuddy, 'ollama_embed', lambda texts: numpy.ones((len(texts), 8), dtype=numpy.float32))
+    ask(notebuddy, 'tomatoes')
+    assert index_embedder(notebuddy).startswith('hashing:')
+
+    monkeypatch.setattr(notebuddy, 'RAG_EMBED_RETRY_SECONDS', 0)
+    assert ask(notebuddy, 'tomatoes')
+    assert index_embedder(notebuddy) == f'ollama:{notebuddy.RAG_EMBED_MODEL}'
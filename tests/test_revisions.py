@@ -0,0 +1,24 @@
+def revision_contents(client, note_id):
+    revisions = client.get(f'/api/notes/{note_id}/revisions').get_json()
+    return [client.get(f'/api/notes/{note_id}/revisions/{revision["id"]}').get_json()['content']['text'] for revision in revisions]
+
+def test_batch_updates_are_recorded_as_revisions(client):
+    note_id = client.post('/api/notes', json={'title': 'Plan', 'content': 'first draft'}).get_json()['id']
+
+    response = client.post('/api/notes/batch', json={'operations': [
+        {'op': 'update', 'id': note_id, 'content': 'second draft'},
+    ]})
+    assert response.get_json()['results'][0]['status'] == 'updated'
+
+    assert client.get(f'/api/notes/{note_id}').get_json()['content']['text'] == 'second draft'
+    assert revision_contents(client, note_id) == ['second draft', 'first draft']
+
+def test_batch_title_only_update_keeps_the_content(client):
+    note_id = client.post('/api/notes', json={'title': 'Plan', 'content': 'first draft'}).get_json()['id']
+
+    client.post('/api/notes/batch', json={'operations': [{'op': 'update', 'id': note_id, 'title': 'Renamed'}]})
+
+    note = client.get(f'/api/notes/{note_id}').get_json()
+    assert (note['title'], note['content']['text']) == ('Renamed', 'first draft')
+    revisions = client.get(f'/api/notes/{note_id}/revisions').get_json()
+    assert [revision['title'] for revision in revisions] == ['Renamed', 'Plan']
@@ -0,0 +1,118 @@
+import http.client
+import socket
+import json
+import threading
+import time
+
+import pytest
+
+from conftest import ADMIN
+
+@pytest.fixture
+def server(notebuddy):
+    listener = socket.create_server(('127.0.0.1', 0))
+    server = notebuddy.PooledWSGIServer(listener, 2)
+    listener.close()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    notebuddy.shutting_down.set()
+    with notebuddy.change_notifier:
+        notebuddy.change_notifier.notify_all()
+    server.shutdown()
+    server.drain(10)
+    server.server_close()
+    notebuddy.shutting_down.clear()
+
+def connect(server):
+    return http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+
+def login(server):
+    conn = connect(server)
+    conn.request('POST', '/login', f'username={ADMIN[0]}&password={ADMIN[1]}',
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    assert response.status == 302
+    return response.getheader('Set-Cookie').split(';')[0]
+
+def open_stream(server, cookie):
+    conn = connect(server)
+    conn.request('GET', '/api/changes/stream?since=0', headers={'Cookie': cookie})
+    response = conn.getresponse()
+    if response.status == 200:
+        assert response.readline().startswith(b'retry:')
+    return conn, response
+
+def test_open_change_streams_leave_request_threads_free(server):
+    cookie = login(server)
+    streams = [open_stream(server, cookie) for _ in range(4)]
+    assert all(response.status == 200 for _, response in streams)
+
+    conn = connect(server)
+    conn.request('GET', '/api/notes', headers={'Cookie': cookie})
+    assert conn.getresponse().status == 200
+    for conn, _ in streams:
+        conn.close()
+
+def test_change_streams_past_the_limit_are_turned_away(server, notebuddy, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'change_stream_slots', threading.BoundedSemaphore(2))
+    cookie = login(server)
+    streams = [open_stream(server, cookie) for _ in range(2)]
+    conn, response = open_stream(server, cookie)
+    assert response.status == 503
+    assert response.getheader('Retry-After') == str(notebuddy.CHANGE_STREAM_BUSY_RETRY_SECONDS)
+    assert response.read().startswith(b'retry:')
+    for conn, _ in streams:
+        conn.close()
+
+def post_chat(server, cookie, message, results):
+    conn = connect(server)
+    conn.timeout = 30
+    conn.request('POST', '/api/chat', json.dumps({'message': message, 'cache': False}),
+                 {'Cookie': cookie, 'Content-Type': 'application/json'})
+    results.append(conn.getresponse().status)
+
+@pytest.fixture
+def slow_model(notebuddy, monkeypatch):
+    # Generations block until the test releases them
+    release = threading.Event()
+    monkeypatch.setattr(notebuddy, 'ollama_generate', lambda prompt, *args, **kwargs: release.wait(30) and 'ok')
+    yield release
+    release.set()
+
+def start_chats(server, notebuddy, cookie, count, results):
+    threads = [threading.Thread(target=post_chat, args=(server, cookie, f'question {i}', results)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 10
+    while notebuddy.llm_gateway._queued + notebuddy.llm_gateway._active < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return threads
+
+def test_waiting_chats_leave_request_threads_free(server, notebuddy, slow_model):
+    cookie = login(server)
+    results = []
+    chats = start_chats(server, notebuddy, cookie, 4, results)
+
+    conn = connect(server)
+    conn.request('GET', '/api/notes', headers={'Cookie': cookie})
+    assert conn.getresponse().status == 200
+
+    slow_model.set()
+    for thread in chats:
+        thread.join()
+    assert results == [200] * 4
+
+def test_chats_past_the_limit_are_turned_away(server, notebuddy, slow_model, monkeypatch):
+    monkeypatch.setattr(notebuddy, 'chat_slots', threading.BoundedSemaphore(1))
+    cookie = login(server)
+    results = []
+    chats = start_chats(server, notebuddy, cookie, 1, results)
+
+    post_chat(server, cookie, 'one more', results)
+    assert results == [503]
+
+    slow_model.set()
+    for thread in chats:
+        thread.join()
+    assert results == [503, 200]